@@ -0,0 +1,101 @@
+'''
+Compare the label fusion of `combine_classes` (LabelFuser) against the historical get_fdata() implementation.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_fusion --shape 512 512 200 --classes 25
+
+Every implementation runs in its own process, so the reported peak RSS is not polluted by the other one.
+'''
+
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import nibabel as nib
+import numpy as np
+
+from benchmarks.synthetic import make_case
+from utils.fusion import LabelFuser
+
+
+def legacy_fusion(class_paths):
+    # The implementation combine_classes used before LabelFuser
+    first_nifti = nib.load(class_paths[0])
+    combined_classes = np.zeros(first_nifti.shape, dtype=np.int16)
+    for idx, class_path in enumerate(class_paths):
+        class_data = nib.load(class_path).get_fdata()
+        combined_classes[class_data > 0] = idx + 1
+    return combined_classes
+
+
+def label_fuser_fusion(class_paths):
+    class_niftis = [nib.load(class_path) for class_path in class_paths]
+    fuser = LabelFuser('last')
+    combined = fuser.fuse((img.dataobj for img in class_niftis), range(1, len(class_niftis) + 1), class_niftis[0].shape)
+    fuser.check()
+    return combined
+
+
+IMPLEMENTATIONS = {'legacy': legacy_fusion, 'label_fuser': label_fuser_fusion}
+
+
+def write_masks(folder, shape, n_classes, ext, seed=0):
+    _, masks = make_case(shape, n_classes, np.random.default_rng(seed))
+    class_paths = []
+    for idx, mask in enumerate(masks):
+        path = os.path.join(folder, f'class_{idx:02d}{ext}')
+        nib.save(nib.Nifti1Image(mask, np.eye(4)), path)
+        class_paths.append(path)
+    return class_paths
+
+
+def run_implementation(name, class_paths, repeat):
+    # Executed in a fresh child process
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        combined = IMPLEMENTATIONS[name](class_paths)
+        timings.append(time.perf_counter() - start)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'implementation': name,
+        'best_seconds': min(timings),
+        'mean_seconds': sum(timings) / len(timings),
+        'peak_rss_mb': peak_rss / 1024,
+        'peak_rss_increase_mb': (peak_rss - baseline_rss) / 1024,
+        'output_dtype': str(combined.dtype),
+        'checksum': int(np.bincount(combined.ravel().astype(np.int64)).dot(np.arange(combined.max() + 1))),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=3, default=[256, 256, 200])
+    parser.add_argument('--classes', type=int, default=25)
+    parser.add_argument('--ext', default='.nii.gz', choices=['.nii', '.nii.gz'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        class_paths = write_masks(folder, tuple(args.shape), args.classes, args.ext)
+        results = []
+        for name in IMPLEMENTATIONS:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results.append(executor.submit(run_implementation, name, class_paths, args.repeat).result())
+
+    report = {'shape': args.shape, 'classes': args.classes, 'ext': args.ext, 'results': results}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+Frame time of the spine scene at every level of detail of the mesh cache (see `LOD_LEVELS` in `demos/mesh_cache.py`):
+the camera turns by 2 degrees per frame like the rotation of the Qt demo, and every frame is rendered offscreen.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_lod --frames 180
+
+Software rendering (e.g. a remote desktop) can be reproduced with `LIBGL_ALWAYS_SOFTWARE=1` when vtk renders
+through Mesa.
+'''
+
+import argparse
+import glob
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+
+STL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'demos', 'assets', 'stls')
+
+
+def frame_times(paths, level, cache_dir, frames, window_size):
+    import vtkmodules.vtkRenderingOpenGL2  # noqa: F401, registers the render window
+    from vtkmodules.vtkRenderingCore import vtkActor, vtkPolyDataMapper, vtkRenderer, vtkRenderWindow
+    from demos.mesh_cache import load_mesh
+
+    renderer = vtkRenderer()
+    triangles = 0
+    for path in paths:
+        polydata = load_mesh(path, cache_dir, level)
+        triangles += polydata.GetNumberOfCells()
+        mapper = vtkPolyDataMapper()
+        mapper.SetInputData(polydata)
+        actor = vtkActor()
+        actor.SetMapper(mapper)
+        renderer.AddActor(actor)
+    renderer.ResetCamera()
+
+    window = vtkRenderWindow()
+    window.SetOffScreenRendering(1)
+    window.SetSize(*window_size)
+    window.AddRenderer(renderer)
+    # The first frame uploads the meshes to the GPU, it is not a rotation frame
+    window.Render()
+
+    times = []
+    camera = renderer.GetActiveCamera()
+    for _ in range(frames):
+        start = time.perf_counter()
+        camera.Azimuth(2)
+        window.Render()
+        times.append(time.perf_counter() - start)
+    window.Finalize()
+    return triangles, np.array(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stl-dir', default=STL_DIR)
+    parser.add_argument('--frames', type=int, default=180)
+    parser.add_argument('--window-size', type=int, nargs=2, default=[1500, 1000])
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    from demos.mesh_cache import LOD_LEVELS
+
+    paths = sorted(glob.glob(os.path.join(args.stl_dir, '*.stl')))
+    summary = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for level in LOD_LEVELS:
+            triangles, times = frame_times(paths, level, cache_dir, args.frames, args.window_size)
+            summary[f'{level:g}'] = {
+                'triangles': triangles,
+                'mean_frame_ms': 1000 * times.mean(),
+                'p95_frame_ms': 1000 * np.percentile(times, 95),
+                'fps': 1 / times.mean(),
+            }
+
+    report = {'files': len(paths), 'frames': args.frames, 'window_size': args.window_size, 'summary': summary}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+'''
+Payload and time to first frame of the web demos with one actor per STL (what the demos do by default) and with all
+the meshes appended into one polydata colored by a categorical lookup table (`--merged`, see `demos/mesh_cache.py`).
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_merged_mesh --repeat 3
+
+Every mode runs in a fresh process with a warm mesh cache and renders its first frame offscreen. The payload is the
+size of the datasets serialized as zlib compressed VTK XML, close to what the web views send to the browser.
+'''
+
+import argparse
+import glob
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+STL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'demos', 'assets', 'stls')
+MODES = ['actors', 'merged']
+
+
+def serialized_size(polydata):
+    from vtkmodules.vtkIOXML import vtkXMLPolyDataWriter
+
+    writer = vtkXMLPolyDataWriter()
+    writer.SetInputData(polydata)
+    writer.SetDataModeToBinary()
+    writer.SetCompressorTypeToZLib()
+    writer.WriteToOutputStringOn()
+    writer.Write()
+    return len(writer.GetOutputString())
+
+
+def run_mode(name, paths, cache_dir, window_size):
+    # Executed in a fresh child process
+    import vtkmodules.vtkRenderingOpenGL2  # noqa: F401, registers the render window
+    from vtkmodules.vtkRenderingCore import vtkActor, vtkPolyDataMapper, vtkRenderer, vtkRenderWindow
+    from demos.mesh_cache import label_lookup_table, load_mesh, merged_polydata
+
+    start = time.perf_counter()
+    if name == 'merged':
+        datasets = [merged_polydata(paths, cache_dir)]
+    else:
+        datasets = [load_mesh(path, cache_dir) for path in paths]
+
+    renderer = vtkRenderer()
+    for polydata in datasets:
+        mapper = vtkPolyDataMapper()
+        mapper.SetInputData(polydata)
+        if name == 'merged':
+            mapper.SetLookupTable(label_lookup_table([(1.0, 0.8, 0.0)] * len(paths)))
+            mapper.SetScalarModeToUseCellData()
+            mapper.UseLookupTableScalarRangeOn()
+        actor = vtkActor()
+        actor.SetMapper(mapper)
+        renderer.AddActor(actor)
+    renderer.ResetCamera()
+    setup_seconds = time.perf_counter() - start
+
+    window = vtkRenderWindow()
+    window.SetOffScreenRendering(1)
+    window.SetSize(*window_size)
+    window.AddRenderer(renderer)
+    start = time.perf_counter()
+    window.Render()
+    first_frame_seconds = time.perf_counter() - start
+
+    return {
+        'mode': name,
+        'datasets': len(datasets),
+        'draw_calls': renderer.GetActors().GetNumberOfItems(),
+        'payload_bytes': sum(serialized_size(polydata) for polydata in datasets),
+        'setup_seconds': setup_seconds,
+        'first_frame_seconds': first_frame_seconds,
+        'time_to_first_frame_seconds': setup_seconds + first_frame_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stl-dir', default=STL_DIR)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--window-size', type=int, nargs=2, default=[1500, 1000])
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    from demos.mesh_cache import mesh_arrays
+
+    paths = sorted(glob.glob(os.path.join(args.stl_dir, '*.stl')))
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # The cache is built once, the modes only differ by the scene they send
+        for path in paths:
+            mesh_arrays(path, cache_dir)
+        for _ in range(args.repeat):
+            for name in MODES:
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    results.append(executor.submit(run_mode, name, paths, cache_dir, args.window_size).result())
+
+    summary = {}
+    for name in MODES:
+        runs = [result for result in results if result['mode'] == name]
+        summary[name] = {
+            'datasets': runs[0]['datasets'],
+            'draw_calls': runs[0]['draw_calls'],
+            'payload_megabytes': runs[0]['payload_bytes'] / 1024 ** 2,
+            'best_time_to_first_frame_seconds': min(run['time_to_first_frame_seconds'] for run in runs),
+            'best_first_frame_seconds': min(run['first_frame_seconds'] for run in runs),
+        }
+
+    report = {'files': len(paths), 'summary': summary, 'runs': results}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
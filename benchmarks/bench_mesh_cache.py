@@ -0,0 +1,78 @@
+'''
+Startup time of the demos: load all the STL files of `demos/assets/stls` with vtkSTLReader (what the demos did) and
+through the binary mesh cache of `demos/mesh_cache.py`, the first time (the cache is built) and the next times.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_mesh_cache --repeat 3
+
+Every scenario runs in a fresh process, like a launch of a demo, the time to import vtk is reported separately.
+'''
+
+import argparse
+import glob
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+STL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'demos', 'assets', 'stls')
+SCENARIOS = ['stl_reader', 'cache_first_load', 'cache']
+
+
+def run_scenario(name, paths, cache_dir):
+    # Executed in a fresh child process
+    start = time.perf_counter()
+    from vtkmodules.vtkIOGeometry import vtkSTLReader
+    from demos.mesh_cache import load_mesh
+    import_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    points = 0
+    for path in paths:
+        if name == 'stl_reader':
+            reader = vtkSTLReader()
+            reader.SetFileName(path)
+            reader.Update()
+            polydata = reader.GetOutput()
+        else:
+            polydata = load_mesh(path, cache_dir)
+        points += polydata.GetNumberOfPoints()
+    return {'scenario': name, 'import_seconds': import_seconds, 'load_seconds': time.perf_counter() - start, 'points': points}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stl-dir', default=STL_DIR)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.stl_dir, '*.stl')))
+    results = []
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for name in SCENARIOS:
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    results.append(executor.submit(run_scenario, name, paths, cache_dir).result())
+
+    summary = {}
+    for name in SCENARIOS:
+        runs = [result for result in results if result['scenario'] == name]
+        summary[name] = {
+            'best_load_seconds': min(run['load_seconds'] for run in runs),
+            'best_import_seconds': min(run['import_seconds'] for run in runs),
+            'points': runs[0]['points'],
+        }
+
+    report = {'files': len(paths), 'megabytes': sum(os.path.getsize(path) for path in paths) / 1024 ** 2, 'summary': summary, 'runs': results}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+'''
+Random patch reads from the array store (`utils/store.py`) against the NIfTI baseline: a patch sampler picks a case
+and a random cube of `--patch` voxels and reads it, from the `.nii.gz` (decompressed up to the patch), from an
+uncompressed `.nii` (memory-mapped by nibabel) and from the memory-mapped `.npy` of the store.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_store --cases 4 --shape 512 512 200 --patches 50
+
+The files are freshly written, so they are in the page cache for every format: the numbers compare the decoding
+work, a cold disk makes the gap between the compressed and the uncompressed formats larger.
+'''
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+
+from benchmarks.synthetic import make_case
+from utils.store import ArrayStore, ArrayStoreExporter
+
+
+FORMATS = ['nifti_gz', 'nifti', 'store']
+
+
+def write_cases(root, n_cases, shape, seed=0):
+    rng = np.random.default_rng(seed)
+    for ext in ('.nii.gz', '.nii'):
+        os.makedirs(os.path.join(root, ext, 'volumes'), exist_ok=True)
+        os.makedirs(os.path.join(root, ext, 'segmentations'), exist_ok=True)
+    for case in range(n_cases):
+        volume, masks = make_case(tuple(shape), 3, rng)
+        labels = np.zeros(shape, dtype=np.uint8)
+        for idx, mask in enumerate(masks):
+            labels[mask > 0] = idx + 1
+        for ext in ('.nii.gz', '.nii'):
+            nib.save(nib.Nifti1Image(volume, np.eye(4)), os.path.join(root, ext, 'volumes', f'case_{case:03d}{ext}'))
+            nib.save(nib.Nifti1Image(labels, np.eye(4)), os.path.join(root, ext, 'segmentations', f'case_{case:03d}{ext}'))
+
+
+def read_patches(name, root, rois):
+    # Every read opens its file like a sampler picking a random case would
+    if name == 'store':
+        store = ArrayStore(os.path.join(root, 'store'))
+        read = lambda case, roi: store.read_roi(case, roi)[0]
+    else:
+        ext = '.nii.gz' if name == 'nifti_gz' else '.nii'
+        read = lambda case, roi: np.asarray(nib.load(os.path.join(root, ext, 'volumes', f'{case}{ext}')).dataobj[roi])
+
+    times = []
+    checksum = 0
+    for case, roi in rois:
+        start = time.perf_counter()
+        patch = read(case, roi)
+        times.append(time.perf_counter() - start)
+        checksum += int(patch.astype(np.int64).sum())
+    return np.array(times), checksum
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', type=int, default=4)
+    parser.add_argument('--shape', type=int, nargs=3, default=[512, 512, 200])
+    parser.add_argument('--patch', type=int, nargs=3, default=[96, 96, 64])
+    parser.add_argument('--patches', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    cases = [f'case_{case:03d}' for case in range(args.cases)]
+    rois = []
+    for _ in range(args.patches):
+        start = [int(rng.integers(0, size - patch + 1)) for size, patch in zip(args.shape, args.patch)]
+        rois.append((cases[rng.integers(len(cases))], tuple(slice(s, s + p) for s, p in zip(start, args.patch))))
+
+    summary = {}
+    with tempfile.TemporaryDirectory() as root:
+        write_cases(root, args.cases, args.shape, args.seed)
+        start = time.perf_counter()
+        ArrayStoreExporter(os.path.join(root, '.nii.gz', 'volumes'), os.path.join(root, '.nii.gz', 'segmentations'), os.path.join(root, 'store')).run()
+        export_seconds = time.perf_counter() - start
+
+        checksums = set()
+        patch_megabytes = np.prod(args.patch) * 2 / 1024 ** 2
+        for name in FORMATS:
+            times, checksum = read_patches(name, root, rois)
+            checksums.add(checksum)
+            summary[name] = {
+                'mean_patch_ms': 1000 * times.mean(),
+                'p95_patch_ms': 1000 * np.percentile(times, 95),
+                'patches_per_second': 1 / times.mean(),
+                'megabytes_per_second': patch_megabytes / times.mean(),
+            }
+        if len(checksums) != 1:
+            raise RuntimeError('The formats did not read the same patches')
+
+    report = {
+        'cases': args.cases, 'shape': args.shape, 'patch': args.patch, 'patches': args.patches,
+        'export_seconds': export_seconds, 'summary': summary,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
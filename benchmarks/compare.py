@@ -0,0 +1,44 @@
+'''
+Compare two JSON reports of `benchmarks.run`, e.g. from two commits:
+
+    python -m benchmarks.compare base.json new.json
+
+A ratio above 1 means the new report is slower (time) or uses more memory (RSS).
+'''
+
+import argparse
+import json
+
+
+METRICS = ['seconds', 'mb_per_second', 'peak_rss_mb', 'output_mb']
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report, {result['utility']: result for result in report['results']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('new')
+    args = parser.parse_args()
+
+    base_report, base = load(args.base)
+    new_report, new = load(args.new)
+    if base_report['config'] != new_report['config']:
+        print(f"Warning: different configurations\n  base: {base_report['config']}\n  new:  {new_report['config']}")
+
+    print(f"{'utility':<10}" + ''.join(f'{metric:>28}' for metric in METRICS))
+    for utility in [name for name in base if name in new]:
+        cells = []
+        for metric in METRICS:
+            old_value, new_value = base[utility][metric], new[utility][metric]
+            ratio = new_value / old_value if old_value else float('nan')
+            cells.append(f'{old_value:9.2f} -> {new_value:9.2f} ({ratio:4.2f}x)')
+        print(f'{utility:<10}' + ''.join(f'{cell:>28}' for cell in cells))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+'''
+Benchmark the dataset utilities on synthetic data and report the results as JSON.
+
+Run from the root of the repository, it only needs the CPU and no network:
+
+    python -m benchmarks.run --cases 8 --shape 128 128 100 --classes 25 --output bench.json
+    python -m benchmarks.compare old_bench.json bench.json
+
+The utilities run one after the other on the outputs of the previous one, like in the guidelines:
+merger -> metadata -> splitter -> renamer, plus the single-pass builder on the raw inputs. Every utility runs in a
+fresh process so its peak RSS is its own, the RSS of its worker processes is reported separately.
+'''
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from benchmarks.synthetic import class_names, make_dataset
+
+
+UTILITIES = ['merger', 'metadata', 'splitter', 'renamer', 'builder']
+
+
+def directory_size(paths):
+    total = 0
+    for path in paths:
+        for root, _, files in os.walk(path):
+            total += sum(os.path.getsize(os.path.join(root, f)) for f in files if not os.path.islink(os.path.join(root, f)))
+    return total
+
+
+def run_utility(name, workdir, volume_dir, class_dirs, args):
+    # Return the input and output directories of the utility and run it
+    from utils import DataRenamer, DatasetBuilder, DataSplitter, MetadataCopier, MultiClassNiftiMerger
+
+    if name == 'merger':
+        MultiClassNiftiMerger.process_directories(volume_dir, class_dirs, os.path.join(workdir, 'merged'), move_volumes=True, workers=args['workers'])
+        return [volume_dir] + class_dirs, [os.path.join(workdir, 'merged')]
+
+    if name == 'metadata':
+        merged = os.path.join(workdir, 'merged')
+        corrected = os.path.join(workdir, 'corrected')
+        copier = MetadataCopier(os.path.join(merged, 'volumes'), os.path.join(merged, 'segmentations'),
+                                os.path.join(corrected, 'volumes'), os.path.join(corrected, 'segmentations'))
+        copier.load_and_copy_metadata()
+        return [merged], [corrected]
+
+    if name == 'splitter':
+        corrected = os.path.join(workdir, 'corrected')
+        split = os.path.join(workdir, 'split')
+        splitter = DataSplitter(os.path.join(corrected, 'volumes'), os.path.join(corrected, 'segmentations'), split,
+                                0.7, 0.2, 0.1, link_mode=args['link_mode'])
+        splitter.run()
+        return [corrected], [split]
+
+    if name == 'renamer':
+        split = os.path.join(workdir, 'split')
+        raw = os.path.join(workdir, 'raw')
+        DataRenamer(split, raw, 100, 'SPINE', link_mode=args['link_mode']).run()
+        return [split], [raw]
+
+    if name == 'builder':
+        built = os.path.join(workdir, 'built')
+        builder = DatasetBuilder(volume_dir, class_dirs, built, 100, 'SPINE', label_names=class_names(len(class_dirs)), workers=args['workers'])
+        builder.run()
+        return [volume_dir] + class_dirs, [built]
+
+    raise ValueError(f'Unknown utility {name}')
+
+
+def measure(name, workdir, volume_dir, class_dirs, args):
+    # Executed in a fresh child process
+    from utils import configure_gzip
+    configure_gzip(compresslevel=args['compresslevel'])
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    inputs, outputs = run_utility(name, workdir, volume_dir, class_dirs, args)
+    seconds = time.perf_counter() - start
+
+    input_bytes = directory_size(inputs)
+    return {
+        'utility': name,
+        'seconds': seconds,
+        'cases_per_second': args['cases'] / seconds,
+        'input_mb': input_bytes / 1024 ** 2,
+        'output_mb': directory_size(outputs) / 1024 ** 2,
+        'mb_per_second': input_bytes / 1024 ** 2 / seconds,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_rss_increase_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss) / 1024,
+        'peak_rss_workers_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', type=int, default=4)
+    parser.add_argument('--shape', type=int, nargs=3, default=[128, 128, 100])
+    parser.add_argument('--classes', type=int, default=25)
+    parser.add_argument('--ext', default='.nii.gz', choices=['.nii', '.nii.gz'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--link-mode', default='copy', choices=['copy', 'hardlink', 'reflink', 'symlink', 'auto'])
+    parser.add_argument('--compresslevel', type=int, default=1)
+    parser.add_argument('--utilities', nargs='+', default=UTILITIES, choices=UTILITIES)
+    parser.add_argument('--workdir', help='Keep the data in this directory instead of a temporary one')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    config = {
+        'cases': args.cases,
+        'shape': args.shape,
+        'classes': args.classes,
+        'ext': args.ext,
+        'workers': args.workers,
+        'link_mode': args.link_mode,
+        'compresslevel': args.compresslevel,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        volume_dir, class_dirs = make_dataset(os.path.join(workdir, 'inputs'), args.cases, args.shape, args.classes, args.ext)
+
+        results = []
+        for name in args.utilities:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results.append(executor.submit(measure, name, workdir, volume_dir, class_dirs, config).result())
+
+    report = {'environment': environment(), 'config': config, 'results': results}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+'''
+Synthetic CT-like volumes and per-vertebra class masks for the benchmarks.
+
+Every case is a int16 volume in Hounsfield units (air, an elliptic body of soft tissue and a column of bone along z)
+with one binary mask per vertebra: the column is cut into `n_classes` blocks stacked along z, like the 25 vertebra
+directories of `prepare.py`. The masks carry a real spacing/origin while the volumes have an identity affine, so
+`MetadataCopier` has a geometry to copy.
+'''
+
+import os
+
+import nibabel as nib
+import numpy as np
+
+
+VERTEBRAE = ['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7',
+             'T1', 'T2', 'T3', 'T4', 'T5', 'T6', 'T7', 'T8', 'T9', 'T10', 'T11', 'T12',
+             'L1', 'L2', 'L3', 'L4', 'L5', 'S1']
+
+
+def class_names(n_classes):
+    if n_classes <= len(VERTEBRAE):
+        return [f'vertebrae_{name}' for name in VERTEBRAE[:n_classes]]
+    return [f'class_{idx + 1}' for idx in range(n_classes)]
+
+
+def make_case(shape, n_classes, rng):
+    '''
+    Return the int16 volume and the list of uint8 masks of one case.
+    '''
+    x, y = np.ogrid[:shape[0], :shape[1]]
+    cx, cy = shape[0] / 2, shape[1] / 2
+    body = ((x - cx) / (0.4 * shape[0])) ** 2 + ((y - cy) / (0.3 * shape[1])) ** 2 <= 1
+    spine = ((x - cx) / (0.06 * shape[0])) ** 2 + ((y - cy - 0.15 * shape[1]) / (0.06 * shape[1])) ** 2 <= 1
+
+    volume = np.full(shape, -1000, dtype=np.int16)
+    volume[body] = 40
+    volume[spine] = 700
+    volume += (rng.standard_normal(shape, dtype=np.float32) * 20).astype(np.int16)
+
+    masks = []
+    bounds = np.linspace(0, shape[2], n_classes + 1).astype(int)
+    for idx in range(n_classes):
+        mask = np.zeros(shape, dtype=np.uint8)
+        # One slice of overlap with the next vertebra, like real annotations
+        mask[..., bounds[idx]: min(bounds[idx + 1] + 1, shape[2])][spine] = 1
+        masks.append(mask)
+    return volume, masks
+
+
+def make_dataset(root, n_cases=4, shape=(128, 128, 100), n_classes=25, ext='.nii.gz', seed=0):
+    '''
+    Write `n_cases` synthetic cases in `root` with the layout of the raw dataset:
+    `root/volumes/case_XXX{ext}` and `root/{class name}/segmentations/case_XXX{ext}`.
+    Return the volume directory and the list of class directories.
+    '''
+    rng = np.random.default_rng(seed)
+    volume_dir = os.path.join(root, 'volumes')
+    class_dirs = [os.path.join(root, name, 'segmentations') for name in class_names(n_classes)]
+    for directory in [volume_dir] + class_dirs:
+        os.makedirs(directory, exist_ok=True)
+
+    mask_affine = np.diag([0.8, 0.8, 1.5, 1.0])
+    mask_affine[:3, 3] = [-50.0, -60.0, 100.0]
+
+    for case in range(n_cases):
+        filename = f'case_{case:03d}{ext}'
+        volume, masks = make_case(tuple(shape), n_classes, rng)
+        nib.save(nib.Nifti1Image(volume, np.eye(4)), os.path.join(volume_dir, filename))
+        for class_dir, mask in zip(class_dirs, masks):
+            nib.save(nib.Nifti1Image(mask, mask_affine), os.path.join(class_dir, filename))
+
+    return volume_dir, class_dirs
@@ -0,0 +1,29 @@
+import argparse
+import sys
+
+from utils import DatasetScanner
+from utils.integrity import DATASET_JSON
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check the pairing and the headers of the volumes and segmentations of a dataset')
+    parser.add_argument('volume_dir', help='the volumes, e.g. imagesTr')
+    parser.add_argument('segmentation_dir', help='the segmentations, e.g. labelsTr')
+    parser.add_argument('--dataset-json', default=DATASET_JSON, help='the dataset.json giving the labels')
+    parser.add_argument('--channel-suffix', help="suffix of the volume names, '_0000' for the nnUNet layout")
+    parser.add_argument('--tolerance', type=float, default=1e-3, help='largest difference allowed between the affines, in mm')
+    parser.add_argument('--deep-sample', type=float, default=0, help='fraction (<= 1) or number of segmentations whose labels are read')
+    parser.add_argument('--workers', type=int, default=16, help='number of threads reading the headers')
+    parser.add_argument('--output', help='write the report to this file (.csv or .json)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    deep_sample = int(args.deep_sample) if args.deep_sample > 1 else args.deep_sample
+    scanner = DatasetScanner(args.volume_dir, args.segmentation_dir, args.dataset_json, args.channel_suffix,
+                             args.tolerance, deep_sample, args.workers)
+    ok = scanner.run()
+    if args.output:
+        scanner.write(args.output)
+    sys.exit(0 if ok else 1)
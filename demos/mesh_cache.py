@@ -0,0 +1,280 @@
+'''
+Binary cache of the STL meshes used by the demos.
+
+The first time an STL file is loaded it is parsed once by vtk (which merges the duplicated vertices of the STL
+triangles) and its points (float32) and triangles (int32) are saved as `.npy` files in the cache directory. The
+next loads memory-map these files and hand them to vtk without parsing anything. A cache entry is keyed by the
+absolute path, the mtime and the size of the STL, so an edited STL is converted again.
+
+Decimated levels of detail (`LOD_LEVELS`, the fraction of the triangles kept) are computed once from the full mesh
+and cached the same way, the viewers draw a coarse level while the camera moves.
+
+```Python
+from mesh_cache import load_mesh
+
+mapper.SetInputData(load_mesh('assets/stls/SPINE_000_06.stl'))  # vtk
+mesh = pv.wrap(load_mesh(path))  # pyvista
+coarse = load_mesh(path, level=0.05)  # 5 % of the triangles
+```
+
+`MeshMemoryCache` keeps the loaded meshes in memory for a long running server (e.g. shared by all the sessions of the
+streamlit demo), with LRU eviction once their total size exceeds a budget.
+
+`merged_polydata` appends several meshes into one polydata with a `label` cell array, rendered in a single draw call
+with the colors of `label_lookup_table`; `set_label_visibility` hides a mesh by making its color transparent.
+'''
+
+import hashlib
+import os
+import pathlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from vtkmodules.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+from vtkmodules.vtkCommonCore import vtkLookupTable, vtkPoints
+from vtkmodules.vtkCommonDataModel import vtkCellArray, vtkPolyData
+from vtkmodules.vtkFiltersCore import vtkQuadricDecimation
+from vtkmodules.vtkIOGeometry import vtkSTLReader
+
+
+CACHE_DIR = pathlib.Path(__file__).resolve().parent / 'assets' / '.mesh_cache'
+
+# Fractions of the triangles kept by the levels of detail, from the full mesh to the coarsest
+LOD_LEVELS = (1.0, 0.25, 0.05)
+
+
+def cache_key(path):
+    stat = os.stat(path)
+    key = f'{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}'
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def cache_paths(path, cache_dir=None, level=1.0):
+    cache_dir = pathlib.Path(cache_dir or CACHE_DIR)
+    prefix = cache_dir / f'{pathlib.Path(path).stem}-{cache_key(path)}'
+    if level != 1.0:
+        prefix = prefix.with_name(prefix.name + f'.lod{round(level * 100):02d}')
+    return prefix.with_name(prefix.name + '.points.npy'), prefix.with_name(prefix.name + '.faces.npy')
+
+
+def read_stl(path):
+    '''
+    Parse an STL file (ASCII or binary) with vtk and return its points (float32, N x 3) and triangles (int32, M x 3).
+    '''
+    reader = vtkSTLReader()
+    reader.SetFileName(str(path))
+    reader.MergingOn()
+    reader.Update()
+    polydata = reader.GetOutput()
+    if polydata.GetNumberOfPoints() == 0:
+        raise ValueError(f'No mesh could be read from {path}')
+
+    points = vtk_to_numpy(polydata.GetPoints().GetData()).astype(np.float32)
+    faces = vtk_to_numpy(polydata.GetPolys().GetConnectivityArray()).astype(np.int32).reshape(-1, 3)
+    return points, faces
+
+
+def save_array(path, array):
+    # Written to a temporary file and renamed, so concurrent loads never see a partial file
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp.npy')
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def decimate(points, faces, level):
+    '''
+    Reduce a mesh to about `level` (e.g. 0.25) of its triangles with quadric decimation, return its points and
+    triangles. A mesh too small to be decimated is returned as it is.
+    '''
+    decimator = vtkQuadricDecimation()
+    decimator.SetInputData(to_polydata(points, faces))
+    decimator.SetTargetReduction(1.0 - level)
+    decimator.VolumePreservationOn()
+    decimator.Update()
+    polydata = decimator.GetOutput()
+    if polydata.GetNumberOfCells() == 0:
+        return points, faces
+
+    points = vtk_to_numpy(polydata.GetPoints().GetData()).astype(np.float32)
+    faces = vtk_to_numpy(polydata.GetPolys().GetConnectivityArray()).astype(np.int32).reshape(-1, 3)
+    return points, faces
+
+
+def mesh_arrays(path, cache_dir=None, level=1.0):
+    '''
+    Return the points and the triangles of the STL `path` at the level of detail `level` (see `LOD_LEVELS`),
+    memory-mapped from the cache (converted or decimated first if needed).
+    '''
+    points_path, faces_path = cache_paths(path, cache_dir, level)
+    if not (points_path.exists() and faces_path.exists()):
+        if level != 1.0:
+            points, faces = decimate(*mesh_arrays(path, cache_dir), level)
+        else:
+            points, faces = read_stl(path)
+            points_path.parent.mkdir(parents=True, exist_ok=True)
+
+            # The entries of the previous versions of this STL are stale
+            stem = pathlib.Path(path).stem
+            current = f'{stem}-{cache_key(path)}.'
+            for old in points_path.parent.glob(f'{stem}-*.npy'):
+                if old.name.rsplit('-', 1)[0] == stem and not old.name.startswith(current):
+                    old.unlink(missing_ok=True)
+
+        save_array(faces_path, faces)
+        save_array(points_path, points)
+
+    # Copy-on-write maps: vtk gets writable buffers, the cache files are never modified
+    return np.load(points_path, mmap_mode='c'), np.load(faces_path, mmap_mode='c')
+
+
+def to_polydata(points, faces):
+    '''
+    Build a vtkPolyData on top of the numpy arrays, without copying them (the arrays are kept alive by vtk).
+    '''
+    vtk_points = vtkPoints()
+    vtk_points.SetData(numpy_to_vtk(points))
+
+    offsets = np.arange(0, faces.size + 1, 3, dtype=faces.dtype)
+    cells = vtkCellArray()
+    cells.SetData(numpy_to_vtk(offsets), numpy_to_vtk(faces.reshape(-1)))
+
+    polydata = vtkPolyData()
+    polydata.SetPoints(vtk_points)
+    polydata.SetPolys(cells)
+    return polydata
+
+
+def load_mesh(path, cache_dir=None, level=1.0):
+    '''
+    Return the STL `path` as a vtkPolyData, from the binary cache.
+    '''
+    return to_polydata(*mesh_arrays(path, cache_dir, level))
+
+
+def merged_arrays(paths, cache_dir=None, level=1.0):
+    '''
+    Append the meshes of `paths` into one: the points, the triangles (renumbered) and the label of every triangle,
+    1 for the first file, 2 for the second and so on.
+    '''
+    meshes = [mesh_arrays(path, cache_dir, level) for path in paths]
+    if not meshes:
+        return np.zeros((0, 3), np.float32), np.zeros((0, 3), np.int32), np.zeros(0, np.uint16)
+
+    first_point = np.cumsum([0] + [len(points) for points, _ in meshes[:-1]])
+    points = np.concatenate([points for points, _ in meshes])
+    faces = np.concatenate([faces + offset for (_, faces), offset in zip(meshes, first_point)]).astype(np.int32)
+    labels = np.repeat(np.arange(1, len(meshes) + 1), [len(faces) for _, faces in meshes])
+    # Not uint8: single-byte scalars are taken as colors by vtk and vtk.js instead of going through the lookup table
+    return points, faces, labels.astype(np.uint16)
+
+
+def merged_polydata(paths, cache_dir=None, level=1.0):
+    '''
+    Return the meshes of `paths` as a single vtkPolyData whose `label` cell array (the active scalars) tells which
+    file every triangle comes from, see `merged_arrays`.
+    '''
+    points, faces, labels = merged_arrays(paths, cache_dir, level)
+    polydata = to_polydata(points, faces)
+    label_array = numpy_to_vtk(labels)
+    label_array.SetName('label')
+    polydata.GetCellData().SetScalars(label_array)
+    return polydata
+
+
+def label_lookup_table(colors):
+    '''
+    Categorical lookup table of the labels 1 to `len(colors)` of `merged_polydata`, `colors` being RGB triplets in
+    [0, 1]. The mapper must use the cell scalars and the range of the table:
+
+    ```Python
+    mapper.SetLookupTable(lut)
+    mapper.SetScalarModeToUseCellData()
+    mapper.UseLookupTableScalarRangeOn()
+    ```
+    '''
+    lut = vtkLookupTable()
+    # One entry per label value, 0 is not used
+    lut.SetNumberOfTableValues(len(colors) + 1)
+    lut.SetTableRange(0, len(colors))
+    lut.Build()
+    lut.SetTableValue(0, 0.0, 0.0, 0.0, 0.0)
+    for label, color in enumerate(colors, start=1):
+        lut.SetTableValue(label, *color[:3], 1.0)
+    return lut
+
+
+def set_label_visibility(lut, label, visible):
+    '''
+    Show or hide the triangles of `label` through the opacity of its color, the geometry is not touched.
+    '''
+    lut.SetTableValue(label, *lut.GetTableValue(label)[:3], 1.0 if visible else 0.0)
+    lut.Modified()
+
+
+class MeshMemoryCache:
+    '''
+    Thread-safe in-memory cache of vtkPolyData, evicting the least recently used meshes once their total size exceeds
+    `max_megabytes`. An entry is keyed by the source files with their mtime and size, so an edited STL is loaded again
+    and its previous version is dropped. The meshes are shared by all the callers and must not be modified.
+
+    ### Params
+    - max_megabytes: the memory budget, default=512
+    - cache_dir: the directory of the binary cache, see `CACHE_DIR`.
+
+    ### Example of usage
+
+    ```Python
+    @st.cache_resource
+    def meshes():
+        return MeshMemoryCache(max_megabytes=1024)  # one per process, shared by the sessions
+
+    mesh = pv.wrap(meshes().mesh(path))
+    merged = pv.wrap(meshes().merged(paths))
+    ```
+    '''
+    def __init__(self, max_megabytes=512, cache_dir=None):
+        self.max_bytes = int(max_megabytes * 1024 ** 2)
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def mesh(self, path, level=1.0):
+        return self.get((path,), level, lambda: load_mesh(path, self.cache_dir, level))
+
+    def merged(self, paths, level=1.0):
+        return self.get(tuple(paths), level, lambda: merged_polydata(paths, self.cache_dir, level))
+
+    def get(self, paths, level, build):
+        name = (tuple(os.path.abspath(path) for path in paths), level)
+        key = (name, tuple(cache_key(path) for path in paths))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+
+        # Built outside of the lock, two sessions asking for the same new mesh may both build it
+        polydata = build()
+        nbytes = polydata.GetActualMemorySize() * 1024
+
+        with self.lock:
+            for old_key in [old_key for old_key in self.entries if old_key[0] == name and old_key != key]:
+                self.drop(old_key)
+            if key not in self.entries:
+                self.entries[key] = (polydata, nbytes)
+                self.nbytes += nbytes
+            self.entries.move_to_end(key)
+            # The newest mesh is kept even if it exceeds the budget alone
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                self.drop(next(iter(self.entries)))
+            return self.entries[key][0]
+
+    def drop(self, key):
+        _, nbytes = self.entries.pop(key)
+        self.nbytes -= nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
@@ -5,14 +5,15 @@ script_path = pathlib.Path(__file__).resolve()
 ASSETS = script_path.parent / 'assets'
 
 
+import os
 import sys
 import pathlib
-from PyQt5.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, QWidget, QLabel, QPushButton, QGridLayout, QCheckBox, QScrollArea
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, QWidget, QLabel, QPushButton, QGridLayout, QCheckBox, QScrollArea, QProgressBar
 from PyQt5.QtGui import QPixmap, QFont
-from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
 import vtkmodules.all as vtk
 from vtkmodules.vtkCommonColor import vtkNamedColors
-from vtkmodules.vtkIOGeometry import vtkSTLReader
 from vtkmodules.vtkRenderingCore import (
     vtkActor,
     vtkPolyDataMapper,
@@ -20,14 +21,28 @@ from vtkmodules.vtkRenderingCore import (
 )
 from vtkmodules.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 from glob import glob
+from mesh_cache import LOD_LEVELS, mesh_arrays, to_polydata
+
+# Level of detail drawn while the camera moves (rotation or mouse interaction), the full mesh is drawn once it stops
+MOVING_LOD = LOD_LEVELS[-1]
 
 class VTKVisualizer(QWidget):
+    # Emitted from the loading threads, delivered in the GUI thread: path, {level: (points, faces)} (or None and the error)
+    mesh_loaded = pyqtSignal(str, object, object)
+    progress = pyqtSignal(int, int)
+
     def __init__(self, stl_files, spine_colors, parent=None):
         super(VTKVisualizer, self).__init__(parent)
         self.colors = vtkNamedColors()
         self.stl_files = stl_files
-        self.spine_colors = spine_colors
+        self.spine_colors = {file: spine_colors[i % len(spine_colors)] for i, file in enumerate(stl_files)}
         self.actors = {}
+        self.lods = {}
+        self.level = 1.0
+        self.interacting = False
+        self.visible = {file: True for file in stl_files}
+        self.loaded = 0
+        self.closing = False
 
         self.vl = QVBoxLayout()
 
@@ -38,28 +53,64 @@ class VTKVisualizer(QWidget):
         self.ren.SetBackground(self.colors.GetColor3d('White'))  # Set background to white
         self.vtk_widget.GetRenderWindow().AddRenderer(self.ren)
         self.iren = self.vtk_widget.GetRenderWindow().GetInteractor()
+        self.iren.AddObserver('StartInteractionEvent', lambda obj, event: self.set_interacting(True))
+        self.iren.AddObserver('EndInteractionEvent', lambda obj, event: self.set_interacting(False))
 
         self.setLayout(self.vl)
         self.setStyleSheet("background-color: #2c3e50; border-radius: 10px;")
 
-        self.load_models()
-
         self.rotating = False
         self.rotation_timer = QTimer()
         self.rotation_timer.timeout.connect(self.rotate_camera)
 
-    def load_models(self):
-        self.ren.RemoveAllViewProps()
-        for i, file in enumerate(self.stl_files):
-            actor = self.create_actor(file, self.spine_colors[i])
-            self.actors[file] = actor
+        self.mesh_loaded.connect(self.add_mesh)
+        self.executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+        self.load_models()
 
-    def create_actor(self, filename, color):
-        reader = vtkSTLReader()
-        reader.SetFileName(filename)
+    def load_models(self):
+        # The files are read in the background, the window shows up at once and the meshes appear as they arrive
+        for file in self.stl_files:
+            self.executor.submit(self.read_mesh, file)
+
+    def read_mesh(self, filename):
+        # Runs in a loading thread. On a cold cache the STL reader and the decimation run vtk filters here, they stay
+        # private to the thread and only their numpy arrays leave it: the vtk objects of the scene (polydata, mappers,
+        # actors) are made in the GUI thread. The next launches load the arrays from the binary cache
+        if self.closing:
+            return
+        try:
+            levels, error = {level: mesh_arrays(filename, level=level) for level in (1.0, MOVING_LOD)}, None
+        except Exception as e:
+            levels, error = None, f'{type(e).__name__}: {e}'
+        if self.closing:
+            return
+        try:
+            self.mesh_loaded.emit(filename, levels, error)
+        except RuntimeError:
+            # The widget was deleted while the mesh was loading
+            pass
+
+    def add_mesh(self, filename, levels, error):
+        if self.closing:
+            return
+        self.loaded += 1
+        if levels is None:
+            print(f"Could not load {filename}: {error}")
+        else:
+            self.lods[filename] = {level: to_polydata(points, faces) for level, (points, faces) in levels.items()}
+            actor = self.create_actor(self.lods[filename][self.level], self.spine_colors[filename])
+            actor.SetVisibility(self.visible[filename])
+            self.actors[filename] = actor
+            # Added once, the checkboxes only change its visibility
+            self.ren.AddActor(actor)
+            if len(self.actors) == 1 or self.loaded == len(self.stl_files):
+                self.ren.ResetCamera()
+            self.vtk_widget.GetRenderWindow().Render()
+        self.progress.emit(self.loaded, len(self.stl_files))
 
+    def create_actor(self, polydata, color):
         mapper = vtkPolyDataMapper()
-        mapper.SetInputConnection(reader.GetOutputPort())
+        mapper.SetInputData(polydata)
 
         actor = vtkActor()
         actor.SetMapper(mapper)
@@ -71,11 +122,28 @@ class VTKVisualizer(QWidget):
 
         return actor
 
-    def update_models(self, selected_files):
-        self.ren.RemoveAllViewProps()
-        for file in selected_files:
-            self.ren.AddActor(self.actors[file])
-        self.vtk_widget.GetRenderWindow().Render()
+    def set_visible(self, filename, visible):
+        # Remembered for the meshes that are still loading
+        self.visible[filename] = visible
+        actor = self.actors.get(filename)
+        if actor is not None:
+            actor.SetVisibility(visible)
+            self.vtk_widget.GetRenderWindow().Render()
+
+    def set_interacting(self, interacting):
+        self.interacting = interacting
+        self.update_detail()
+
+    def update_detail(self):
+        # Coarse meshes while the camera moves, the switch only changes the input of the mappers
+        level = MOVING_LOD if self.rotating or self.interacting else 1.0
+        if level == self.level:
+            return
+        self.level = level
+        for filename, actor in self.actors.items():
+            actor.GetMapper().SetInputData(self.lods[filename][level])
+        if level == 1.0:
+            self.vtk_widget.GetRenderWindow().Render()
 
     def rotate_camera(self):
         if self.rotating:
@@ -88,9 +156,16 @@ class VTKVisualizer(QWidget):
         else:
             self.rotation_timer.start(30)  # Adjusted timer interval for smoother rotation
         self.rotating = not self.rotating
+        self.update_detail()
 
-    def closeEvent(self, event):
+    def stop_loading(self):
+        # The pending loads are cancelled, the running ones finish without touching the widget
+        self.closing = True
         self.rotation_timer.stop()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def closeEvent(self, event):
+        self.stop_loading()
         super(VTKVisualizer, self).closeEvent(event)
 
 class MainWindow(QMainWindow):
@@ -121,6 +196,7 @@ class MainWindow(QMainWindow):
                         "LavenderBlush", "LightSalmon", "YellowGreen", "MidnightBlue", "MintCream", "Olive", "PapayaWhip", "Pink"]
 
         vtk_visualizer = VTKVisualizer(stl_files, spine_colors, self)
+        self.vtk_visualizer = vtk_visualizer
 
         # Create a scrollable area for the checkboxes
         scroll_area = QScrollArea()
@@ -130,14 +206,23 @@ class MainWindow(QMainWindow):
         checkbox_widget.setLayout(checkbox_layout)
         scroll_area.setWidget(checkbox_widget)
 
-        checkboxes = []
+        # Each checkbox is bound to its STL file, a toggle only shows or hides that mesh
+        self.checkboxes = {}
         for stl_file in stl_files:
             checkbox = QCheckBox(pathlib.Path(stl_file).stem)
             checkbox.setChecked(True)
             checkbox.setStyleSheet("color: white;")
-            checkbox.stateChanged.connect(lambda state, file=stl_file: self.update_visualizer(state, file, vtk_visualizer))
+            checkbox.stateChanged.connect(lambda state, file=stl_file: vtk_visualizer.set_visible(file, state == Qt.Checked))
             checkbox_layout.addWidget(checkbox)
-            checkboxes.append(checkbox)
+            self.checkboxes[stl_file] = checkbox
+
+        # Loading progress, hidden once all the meshes are shown
+        progress_bar = QProgressBar()
+        progress_bar.setRange(0, len(stl_files))
+        progress_bar.setFormat("Loading meshes %v/%m")
+        progress_bar.setStyleSheet("color: white;")
+        progress_bar.setVisible(bool(stl_files))
+        vtk_visualizer.progress.connect(lambda loaded, total: self.update_progress(progress_bar, loaded, total))
 
         # Start/Stop Rotation button
         rotation_button = QPushButton("Start/Stop Rotation")
@@ -162,12 +247,18 @@ class MainWindow(QMainWindow):
         main_layout.addWidget(scroll_area, 1, 0)
         main_layout.addWidget(rotation_button, 2, 0)
         main_layout.addWidget(vtk_visualizer, 1, 1, 2, 1)
-        main_layout.addLayout(footer_layout, 3, 0, 1, 2)
+        main_layout.addWidget(progress_bar, 3, 1)
+        main_layout.addLayout(footer_layout, 4, 0, 1, 2)
 
-    def update_visualizer(self, state, file, vtk_visualizer):
-        selected_files = [checkbox.text() + '.stl' for checkbox in self.findChildren(QCheckBox) if checkbox.isChecked()]
-        selected_files = [str(pathlib.Path(file).with_name(name)) for name in selected_files]
-        vtk_visualizer.update_models(selected_files)
+    def update_progress(self, progress_bar, loaded, total):
+        progress_bar.setValue(loaded)
+        if loaded == total:
+            progress_bar.hide()
+
+    def closeEvent(self, event):
+        # The viewer is a child widget, it does not get a close event of its own
+        self.vtk_visualizer.stop_loading()
+        super().closeEvent(event)
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -10,6 +10,7 @@ import streamlit as st
 from stpyvista import stpyvista
 from glob import glob
 import platform
+from mesh_cache import LOD_LEVELS, MeshMemoryCache
 
 if platform.system() == 'Linux':
     pv.start_xvfb()
@@ -26,29 +27,45 @@ hex_colors = [
 
 
 def delmodel():
-    del st.session_state.fileuploader
+    st.session_state.pop('fileuploader', None)
+
+
+@st.cache_resource
+def mesh_memory_cache():
+    # One cache per server process, shared by all the sessions and the reruns
+    return MeshMemoryCache(max_megabytes=1024)
 
 
 ## Streamlit layout
 st.sidebar.image(str(ASSETS / 'logo_pycad.png'), width=100)
 st.sidebar.header("Streamlit Demo - by PYCAD Team")
+merged = st.sidebar.checkbox("Single merged mesh", help="Send all the vertebrae as one mesh colored by label")
+level = st.sidebar.select_slider("Level of detail", options=LOD_LEVELS[::-1], value=1.0, format_func=lambda level: f"{level:.0%}",
+                                 help="Fraction of the triangles sent to the browser, lower levels rotate faster on slow machines")
 
 placeholder = st.empty()
 
 
 # paths = ['sinus.stl', 'airway_green.stl', 'jaws.stl']
 colors = hex_colors # ["#ffc800", "#31de5f", "3145de"]
-paths = glob(str(ASSETS / 'stls' / '*.stl'))
+paths = sorted(glob(str(ASSETS / 'stls' / '*.stl')))
 
-## Initialize pyvista reader and plotter
+## Only the plotter is built per session, the meshes come from the shared cache
+meshes = mesh_memory_cache()
 plotter = pv.Plotter(border=False, window_size=[1500, 1000])
 plotter.background_color = "#000000"
 
-for i, path in enumerate(paths):
-    reader = pv.STLReader(path)
-    mesh = reader.read() 
-    plotter.add_mesh(mesh, color=colors[i])
-    
+if merged:
+    # One dataset with a `label` cell array and one color per label: a single payload and draw call
+    mesh = pv.wrap(meshes.merged(paths, level))
+    plotter.add_mesh(mesh, scalars='label', cmap=colors[:len(paths)], clim=[1, len(paths)], n_colors=len(paths),
+                     categories=True, show_scalar_bar=False)
+else:
+    for i, path in enumerate(paths):
+        # The STL is parsed only once, the next runs and sessions reuse the loaded mesh
+        mesh = pv.wrap(meshes.mesh(path, level))
+        plotter.add_mesh(mesh, color=colors[i])
+
 
 plotter.view_isometric()
 
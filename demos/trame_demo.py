@@ -14,20 +14,18 @@ from vtkmodules.vtkRenderingCore import (
     vtkRenderWindow
 )
 from vtkmodules.vtkCommonColor import vtkNamedColors
-from vtkmodules.vtkIOGeometry import vtkSTLReader
 from glob import glob
+from mesh_cache import LOD_LEVELS, label_lookup_table, load_mesh, merged_polydata, set_label_visibility
 
 spine_colors = ["AliceBlue", "Aquamarine", "Beige", "BlueViolet", "Burlywood", "Carrot", "Cornflower", "Darkgreen", "Darkmagenta", "Magenta", "Gold",
                 "LavenderBlush", "LightSalmon", "YellowGreen", "MidnightBlue", "MintCream", "Olive", "PapayaWhip", "Pink"]
 
 filenames = sorted(glob(str(ASSETS / 'stls' / '*.stl')))
 
-def load_stl(filename, color):
-    reader = vtkSTLReader()
-    reader.SetFileName(filename)
-
+def load_stl(filename, color, level=1.0):
+    # The STL is parsed only once, the next launches load it from the binary cache
     mapper = vtkPolyDataMapper()
-    mapper.SetInputConnection(reader.GetOutputPort())
+    mapper.SetInputData(load_mesh(filename, level=level))
 
     actor = vtkActor()
     actor.SetMapper(mapper)
@@ -38,8 +36,30 @@ def load_stl(filename, color):
 
     return actor
 
+def load_merged(filenames, colors, level=1.0):
+    # All the vertebrae in one dataset colored by its label: one payload for the browser and one draw call
+    mapper = vtkPolyDataMapper()
+    mapper.SetInputData(merged_polydata(filenames, level=level))
+    lut = label_lookup_table(colors)
+    mapper.SetLookupTable(lut)
+    mapper.SetScalarModeToUseCellData()
+    mapper.UseLookupTableScalarRangeOn()
+
+    actor = vtkActor()
+    actor.SetMapper(mapper)
+    actor.GetProperty().SetDiffuse(0.8)
+    actor.GetProperty().SetSpecular(0.3)
+    actor.GetProperty().SetSpecularPower(60.0)
+
+    return actor, lut
+
 server = get_server(client_type="vue2")
-ctrl = server.controller
+state, ctrl = server.state, server.controller
+server.cli.add_argument("--merged", action="store_true", help="Send all the vertebrae as a single mesh")
+# The browser renders what it receives, a decimated level keeps the rotation smooth on slow clients
+server.cli.add_argument("--lod", type=float, choices=LOD_LEVELS, default=1.0, help="Fraction of the triangles sent")
+args = server.cli.parse_known_args()[0]
+merged = args.merged
 
 colors = vtkNamedColors()
 
@@ -48,14 +68,30 @@ ren = vtkRenderer()
 renderWindow = vtkRenderWindow()
 renderWindow.AddRenderer(ren)
 
-for i, filename in enumerate(filenames):
-    color = colors.GetColor3d(spine_colors[i])
-    actor = load_stl(filename, color)
+names = [pathlib.Path(filename).stem for filename in filenames]
+actors = {}
+if merged:
+    actor, lut = load_merged(filenames, [colors.GetColor3d(spine_colors[i]) for i in range(len(filenames))], args.lod)
     ren.AddActor(actor)
+else:
+    for i, filename in enumerate(filenames):
+        color = colors.GetColor3d(spine_colors[i])
+        actors[names[i]] = load_stl(filename, color, args.lod)
+        ren.AddActor(actors[names[i]])
 
 ren.SetBackground(colors.GetColor3d('WhiteSmoke'))
 ren.ResetCamera()
 
+@state.change("visible_vertebrae")
+def update_visibility(visible_vertebrae, **kwargs):
+    # Only the colors (merged mode) or the visibility flags of the actors change, the meshes are not sent again
+    for label, name in enumerate(names, start=1):
+        if merged:
+            set_label_visibility(lut, label, name in visible_vertebrae)
+        else:
+            actors[name].SetVisibility(name in visible_vertebrae)
+    ctrl.view_update()
+
 with SinglePageLayout(server) as layout:
     layout.title.set_text("Spine STL Viewer")
     layout.icon.clickable = False
@@ -63,6 +99,15 @@ with SinglePageLayout(server) as layout:
 
     with layout.toolbar:
         vuetify.VSpacer()
+        vuetify.VSelect(
+            v_model=("visible_vertebrae", names),
+            items=("vertebrae", names),
+            multiple=True,
+            dense=True,
+            hide_details=True,
+            label="Vertebrae",
+            style="max-width: 300px",
+        )
         vuetify.VImg(src=str(ASSETS / 'logo_pycad.png'), max_height=50, max_width=50)
         vuetify.VSpacer()
         vuetify.VToolbarTitle("Built by PYCAD Team")
@@ -73,6 +118,7 @@ with SinglePageLayout(server) as layout:
             classes="pa-0 fill-height",
         ):
             html_view = vtk.VtkLocalView(renderWindow)  # client side rendering
+            ctrl.view_update = html_view.update
             ctrl.on_server_ready.add(html_view.update)
 
 if __name__ == "__main__":
@@ -0,0 +1,23 @@
+import argparse
+
+from utils import SegmentationEvaluator
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Per-vertebra Dice, volume difference, ASSD and HD95 of nnUNet predictions')
+    parser.add_argument('reference_dir', help='the reference segmentations, e.g. labelsTs')
+    parser.add_argument('prediction_dir', help='the predictions')
+    parser.add_argument('output_dir', help='where per_case.csv, summary.csv and summary.json are written')
+    parser.add_argument('-djfile', '--dataset-json', help='the dataset.json of the dataset, for the labels and their names')
+    parser.add_argument('--labels', type=int, nargs='+', help='the labels to evaluate, those of dataset.json by default')
+    parser.add_argument('--ignore-label', type=int, help='the voxels with this label in the reference are not counted')
+    parser.add_argument('--no-surface', action='store_true', help='skip the surface distances (ASSD and HD95)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, all the cores by default')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    evaluator = SegmentationEvaluator(args.reference_dir, args.prediction_dir, args.labels, args.dataset_json,
+                                      args.ignore_label, not args.no_surface, args.workers)
+    evaluator.run(args.output_dir)
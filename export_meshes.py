@@ -0,0 +1,24 @@
+import argparse
+import os
+
+from utils import MeshExporter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Write one STL per label of segmentations or nnUNet predictions')
+    parser.add_argument('input', help='a NIfTI file or a directory of NIfTI files')
+    parser.add_argument('output_dir', help='where the {case}_{label}.stl files are written')
+    parser.add_argument('--labels', type=int, nargs='+', help='the labels to export, all the labels present by default')
+    parser.add_argument('--smoothing-iterations', type=int, default=0, help='windowed sinc smoothing iterations, none by default')
+    parser.add_argument('--decimation', type=float, default=0.0, help='fraction of the triangles to remove, e.g. 0.5')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, all the cores by default')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    exporter = MeshExporter(args.output_dir, args.labels, args.smoothing_iterations, args.decimation, args.workers)
+    if os.path.isdir(args.input):
+        exporter.export_directory(args.input)
+    else:
+        exporter.export(args.input)
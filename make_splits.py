@@ -0,0 +1,22 @@
+import argparse
+
+from utils import SplitGenerator
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write the cross-validation splits of an nnUNet dataset (splits_final.json) without touching the images")
+    parser.add_argument('labels_dir', help='the labelsTr directory of the dataset')
+    parser.add_argument('output', help='the splits_final.json to write, in nnUNet_preprocessed/DatasetXXX_NAME')
+    parser.add_argument('--folds', type=int, default=5, help='number of folds')
+    parser.add_argument('--holdout', type=float, help='write a single split keeping this ratio of the cases for validation instead of the folds')
+    parser.add_argument('--seed', type=int, default=12345, help='seed of the split')
+    parser.add_argument('--stratify', choices=['coverage', 'size'], help='spread the cases over the folds by vertebra coverage or by scan size')
+    parser.add_argument('--stats', help='the label_stats.npz of the dataset, needed by --stratify')
+    parser.add_argument('--case-mapping', help='the case_mapping.json of the dataset, by default the one next to labels_dir')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    generator = SplitGenerator(args.labels_dir, args.folds, args.holdout, args.seed, args.stratify, args.stats, args.case_mapping)
+    generator.write(args.output)
@@ -0,0 +1,22 @@
+import argparse
+
+from utils import ComponentFilter, Manifest
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Keep the largest connected component of every label of nnUNet predictions')
+    parser.add_argument('prediction_dir', help='the predictions')
+    parser.add_argument('output_dir', help='where the cleaned predictions and postprocessing.csv are written')
+    parser.add_argument('--labels', type=int, nargs='+', help='the labels to clean, all of them by default')
+    parser.add_argument('--min-voxels', type=int, help='keep the components of at least this number of voxels instead of only the largest')
+    parser.add_argument('--connectivity', type=int, choices=[1, 2, 3], default=1, help='1: faces, 2: faces and edges, 3: faces, edges and corners')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, all the cores by default')
+    parser.add_argument('--incremental', action='store_true', help='skip the predictions cleaned by a previous run (manifest.json in output_dir)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    manifest = Manifest(f'{args.output_dir}/manifest.json') if args.incremental else None
+    cleaner = ComponentFilter(args.prediction_dir, args.output_dir, args.labels, args.min_voxels, args.connectivity, args.workers, manifest)
+    cleaner.run()
@@ -1,40 +1,145 @@
-from utils import MultiClassNiftiMerger, MetadataCopier
-
-def merge_nifties():
-    volume_dir = 'datasets/volumes'
-    class_dirs = ['datasets/vertebrae_C11225/segmentations', 
-                'datasets/vertebrae_C21225/segmentations',
-                'datasets/vertebrae_C31225/segmentations',
-                'datasets/vertebrae_C41225/segmentations',
-                'datasets/vertebrae_C51225/segmentations',
-                'datasets/vertebrae_C61225/segmentations',
-                'datasets/vertebrae_C71225/segmentations',
-                'datasets/vertebrae_T11225/segmentations',
-                'datasets/vertebrae_T21225/segmentations',
-                'datasets/vertebrae_T31225/segmentations',
-                'datasets/vertebrae_T41225/segmentations',
-                'datasets/vertebrae_T51225/segmentations',
-                'datasets/vertebrae_T61225/segmentations',
-                'datasets/vertebrae_T71225/segmentations',
-                'datasets/vertebrae_T81225/segmentations',
-                'datasets/vertebrae_T91225/segmentations',
-                'datasets/vertebrae_T101225/segmentations',
-                'datasets/vertebrae_T111225/segmentations',
-                'datasets/vertebrae_T121225/segmentations',
-                'datasets/vertebrae_L11225/segmentations',
-                'datasets/vertebrae_L21225/segmentations',
-                'datasets/vertebrae_L31225/segmentations',
-                'datasets/vertebrae_L41225/segmentations',
-                'datasets/vertebrae_L51225/segmentations',
-                'datasets/vertebrae_S11225/segmentations']
+import argparse
+import glob
+import json
+import os
 
+from utils import DatasetBuilder, ForegroundCropper, LabelStatsIndex, Manifest, MultiClassNiftiMerger, MetadataCopier, RunReport
+from utils.scheduler import shard_path
+
+VOLUME_DIR = 'datasets/volumes'
+CLASS_DIRS = ['datasets/vertebrae_C11225/segmentations', 
+              'datasets/vertebrae_C21225/segmentations',
+              'datasets/vertebrae_C31225/segmentations',
+              'datasets/vertebrae_C41225/segmentations',
+              'datasets/vertebrae_C51225/segmentations',
+              'datasets/vertebrae_C61225/segmentations',
+              'datasets/vertebrae_C71225/segmentations',
+              'datasets/vertebrae_T11225/segmentations',
+              'datasets/vertebrae_T21225/segmentations',
+              'datasets/vertebrae_T31225/segmentations',
+              'datasets/vertebrae_T41225/segmentations',
+              'datasets/vertebrae_T51225/segmentations',
+              'datasets/vertebrae_T61225/segmentations',
+              'datasets/vertebrae_T71225/segmentations',
+              'datasets/vertebrae_T81225/segmentations',
+              'datasets/vertebrae_T91225/segmentations',
+              'datasets/vertebrae_T101225/segmentations',
+              'datasets/vertebrae_T111225/segmentations',
+              'datasets/vertebrae_T121225/segmentations',
+              'datasets/vertebrae_L11225/segmentations',
+              'datasets/vertebrae_L21225/segmentations',
+              'datasets/vertebrae_L31225/segmentations',
+              'datasets/vertebrae_L41225/segmentations',
+              'datasets/vertebrae_L51225/segmentations',
+              'datasets/vertebrae_S11225/segmentations']
+
+
+def merge_nifties(args):
     output_dir = 'datasets/corrected'
-    MultiClassNiftiMerger.process_directories(volume_dir, class_dirs, output_dir, move_volumes=True)
+    manifest = make_manifest(shard_path(os.path.join(output_dir, 'manifest.json'), args.shard), args)
+    run_report = make_run_report(args)
+    stats_path = shard_path(os.path.join(output_dir, 'label_stats.npz'), args.shard) if args.stats else None
+    MultiClassNiftiMerger.process_directories(VOLUME_DIR, CLASS_DIRS, output_dir, move_volumes=True, workers=args.workers, manifest=manifest,
+                                              run_report=run_report, stats_path=stats_path, label_names=read_label_names(),
+                                              memory_budget=args.memory_budget, shard=args.shard)
+    write_run_report(run_report, 'merge', args)
 
-def correct_metadata():
-    copier = MetadataCopier('datasets/corrected/volumes', 'datasets/corrected/segmentations', 'datasets/spine_segmentation_nnunet_v2/volumes', 'datasets/spine_segmentation_nnunet_v2/segmentations')
+def correct_metadata(args):
+    manifest = make_manifest(shard_path('datasets/spine_segmentation_nnunet_v2/manifest.json', args.shard), args)
+    run_report = make_run_report(args)
+    copier = MetadataCopier('datasets/corrected/volumes', 'datasets/corrected/segmentations', 'datasets/spine_segmentation_nnunet_v2/volumes', 'datasets/spine_segmentation_nnunet_v2/segmentations', manifest=manifest, run_report=run_report,
+                            workers=args.workers, memory_budget=args.memory_budget, shard=args.shard)
     copier.load_and_copy_metadata()
+    write_run_report(run_report, 'metadata', args)
+
+def crop_foreground(args):
+    # The crops.json written next to the segmentations folder is needed to paste the predictions back, see utils.uncrop
+    output_dir = 'datasets/spine_segmentation_nnunet_v2_cropped'
+    manifest = make_manifest(os.path.join(output_dir, 'manifest.json'), args)
+    cropper = ForegroundCropper('datasets/spine_segmentation_nnunet_v2/volumes', 'datasets/spine_segmentation_nnunet_v2/segmentations',
+                                os.path.join(output_dir, 'volumes'), os.path.join(output_dir, 'segmentations'), margin=args.crop_margin, workers=args.workers, manifest=manifest)
+    cropper.run()
+
+def build_dataset(args):
+    # Single pass: merge, fix the metadata, split and write the nnUNet layout with its dataset.json
+    dataset_dir = os.path.join(args.nnunet_raw, 'Dataset100_SPINE')
+    manifest = make_manifest(os.path.join(dataset_dir, 'manifest.json'), args)
+    run_report = make_run_report(args)
+    stats_path = os.path.join(dataset_dir, 'label_stats.npz') if args.stats else None
+    builder = DatasetBuilder(VOLUME_DIR, CLASS_DIRS, args.nnunet_raw, 100, 'SPINE', label_names=read_label_names(), workers=args.workers, manifest=manifest,
+                             run_report=run_report, stats_path=stats_path, crop_margin=args.crop_margin if args.crop else None)
+    builder.run()
+    write_run_report(run_report, 'build', args)
+
+def merge_shards(args):
+    # Gather the manifests (and statistics) written by the machines of a sharded run, before --crop or a plain re-run
+    for path in ['datasets/corrected/manifest.json', 'datasets/spine_segmentation_nnunet_v2/manifest.json']:
+        shard_paths = sorted(glob.glob(path.replace('.json', '.shard-*-of-*.json')))
+        if shard_paths:
+            Manifest.merge(path, shard_paths)
+
+    stats_path = 'datasets/corrected/label_stats.npz'
+    shard_paths = sorted(glob.glob(stats_path.replace('.npz', '.shard-*-of-*.npz')))
+    for path in shard_paths:
+        LabelStatsIndex.update(stats_path, LabelStatsIndex.load(path).to_case_stats(), read_label_names())
+    if shard_paths:
+        print(f"Merged {len(shard_paths)} shard statistics into {stats_path}")
+
+def read_label_names():
+    # The names of the labels 1 to 25, in the order of CLASS_DIRS
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils', 'dataset.json')) as f:
+        return [name for name, label in sorted(json.load(f)['labels'].items(), key=lambda item: item[1]) if label > 0]
+
+def make_manifest(path, args):
+    # The manifests make the re-runs incremental: only the new or modified cases are processed
+    return Manifest(path, use_hash=args.hash, force=args.force, prune=args.prune)
+
+def make_run_report(args):
+    # Only instrument the run when a report is asked for
+    if args.report is None:
+        return None
+    return RunReport(profile_case=args.profile_case, profile_dir=os.path.join(args.report, 'profiles'))
+
+def write_run_report(run_report, step, args):
+    if run_report is None:
+        return
+    run_report.print_summary()
+    run_report.write(os.path.join(args.report, f'{step}.json'))
+    run_report.write(os.path.join(args.report, f'{step}.csv'))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Prepare the spine dataset')
+    parser.add_argument('--merge', action='store_true', help='merge the vertebrae classes before correcting the metadata')
+    parser.add_argument('--single-pass', action='store_true', help='build the nnUNet dataset directly in one pass instead')
+    parser.add_argument('--nnunet-raw', default='datasets/nnunet_data/nnUNet_raw', help='nnUNet_raw directory for --single-pass')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes used to merge, all the cores by default')
+    parser.add_argument('--force', action='store_true', help='process every case again, even the up to date ones')
+    parser.add_argument('--hash', action='store_true', help='also compare the content of the inputs whose mtime changed')
+    parser.add_argument('--prune', action='store_true', help='delete the outputs of the cases that are no longer in the inputs')
+    parser.add_argument('--crop', action='store_true', help='crop the corrected volumes around the vertebrae to datasets/spine_segmentation_nnunet_v2_cropped, '
+                        'with --single-pass crop the nnUNet dataset while building it (crops.json in the dataset directory)')
+    parser.add_argument('--crop-margin', type=float, default=10, help='margin of the crop around the labels in millimetres')
+    parser.add_argument('--stats', action='store_true', help='write the per-label statistics (label_stats.npz) while merging or building')
+    parser.add_argument('--report', help='directory where the per-stage timings of every step are written (JSON and CSV)')
+    parser.add_argument('--memory-budget', help="memory the cases running at the same time may use, e.g. '48G' (estimated from the headers)")
+    parser.add_argument('--shard', help="only process the cases of shard 'i/N' (i from 0 to N - 1), every shard writes its own manifest")
+    parser.add_argument('--merge-shards', action='store_true', help='merge the manifests and statistics written by the shards, then exit')
+    parser.add_argument('--profile-case', nargs='+', help='case ids to run under cProfile, the stats go to REPORT/profiles (needs --report)')
+    args = parser.parse_args()
+    if args.shard and (args.single_pass or args.crop):
+        parser.error('--shard applies to the merge and metadata steps, run --crop or --single-pass after --merge-shards')
+    return args
 
 
 if __name__ == '__main__':
-    correct_metadata()
\ No newline at end of file
+    args = parse_args()
+    if args.merge_shards:
+        merge_shards(args)
+    elif args.single_pass:
+        build_dataset(args)
+    else:
+        if args.merge:
+            merge_nifties(args)
+        correct_metadata(args)
+        if args.crop:
+            crop_foreground(args)
\ No newline at end of file
@@ -0,0 +1,142 @@
+'''
+The Dice of `SegmentationEvaluator` must be the one of nnUNet (`compute_tp_fp_fn_tn` of
+`nnunetv2.evaluation.evaluate_predictions`, NaN when a label is in neither image), and the surface distances computed
+in the bounding box of a label must be the ones of the whole volume.
+'''
+
+import math
+
+import nibabel as nib
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from utils import SegmentationEvaluator
+from utils.evaluation import evaluate_case
+
+
+SPACING = (0.8, 0.6, 2.0)
+
+
+def save(path, data):
+    nib.save(nib.Nifti1Image(data.astype(np.uint8), np.diag(SPACING + (1.0,))), str(path))
+    return str(path)
+
+
+def nnunet_counts(reference, prediction, label, ignore_label=None):
+    # The counts of nnUNet, one boolean mask per label
+    mask_ref = reference == label
+    mask_pred = prediction == label
+    use = np.ones_like(mask_ref) if ignore_label is None else reference != ignore_label
+    tp = int(np.sum(mask_ref & mask_pred & use))
+    fp = int(np.sum(~mask_ref & mask_pred & use))
+    fn = int(np.sum(mask_ref & ~mask_pred & use))
+    tn = int(np.sum(~mask_ref & ~mask_pred & use))
+    dice = 2 * tp / (2 * tp + fp + fn) if tp + fp + fn > 0 else np.nan
+    return tp, fp, fn, tn, dice
+
+
+def random_pair(shape=(30, 26, 18), n_labels=5, seed=0):
+    # Blocks of labels, the prediction is the reference with shifted and dropped blocks and some noise
+    rng = np.random.default_rng(seed)
+    reference = np.zeros(shape, dtype=np.uint8)
+    prediction = np.zeros(shape, dtype=np.uint8)
+    for label in range(1, n_labels + 1):
+        start = rng.integers(0, np.array(shape) - 6)
+        size = rng.integers(3, 8, size=3)
+        box = tuple(slice(s, s + n) for s, n in zip(start, size))
+        reference[box] = label
+        shifted = tuple(slice(b.start + int(rng.integers(-1, 2)), b.stop + int(rng.integers(-1, 2))) for b in box)
+        if label != n_labels:
+            prediction[tuple(slice(max(s.start, 0), s.stop) for s in shifted)] = label
+    noise = rng.random(shape) < 0.01
+    prediction[noise] = rng.integers(1, n_labels + 1, size=int(noise.sum()))
+    return reference, prediction
+
+
+def test_known_counts(tmp_path):
+    reference = np.zeros((10, 10, 10), dtype=np.uint8)
+    prediction = np.zeros((10, 10, 10), dtype=np.uint8)
+    reference[2:4, 2:4, 2:4] = 1        # 8 voxels
+    prediction[2:4, 2:4, 2:3] = 1       # 4 of them
+    prediction[6, 6, 6:8] = 1           # and 2 outside
+    prediction[8, 8, 8] = 2             # label 2 only in the prediction
+
+    metrics = evaluate_case(save(tmp_path / 'ref.nii.gz', reference), save(tmp_path / 'pred.nii.gz', prediction), labels=[1, 2, 3])
+
+    assert (metrics[1]['tp'], metrics[1]['fp'], metrics[1]['fn'], metrics[1]['tn']) == (4, 2, 4, 990)
+    assert metrics[1]['dice'] == pytest.approx(8 / 14)
+    assert metrics[1]['iou'] == pytest.approx(4 / 10)
+    # Empty reference and non empty prediction: 0 like nnUNet, not NaN
+    assert metrics[2]['dice'] == 0
+    # Label in neither image: NaN like nnUNet, left out of the means
+    assert math.isnan(metrics[3]['dice'])
+    assert math.isnan(metrics[3]['iou'])
+    assert math.isnan(metrics[3]['hd95_mm'])
+
+
+@pytest.mark.parametrize('ignore_label', [None, 5])
+def test_dice_matches_nnunet(tmp_path, ignore_label):
+    reference, prediction = random_pair()
+    metrics = evaluate_case(save(tmp_path / 'ref.nii.gz', reference), save(tmp_path / 'pred.nii.gz', prediction),
+                            ignore_label=ignore_label, surface_distances=False)
+
+    labels = [label for label in range(1, 6) if label != ignore_label]
+    assert sorted(metrics) == labels
+    for label in labels:
+        tp, fp, fn, tn, dice = nnunet_counts(reference, prediction, label, ignore_label)
+        assert (metrics[label]['tp'], metrics[label]['fp'], metrics[label]['fn'], metrics[label]['tn']) == (tp, fp, fn, tn)
+        assert metrics[label]['dice'] == pytest.approx(dice)
+
+
+def test_summary_ignores_the_nan_cases(tmp_path):
+    reference_dir, prediction_dir = tmp_path / 'ref', tmp_path / 'pred'
+    reference_dir.mkdir()
+    prediction_dir.mkdir()
+    full = np.zeros((8, 8, 8), dtype=np.uint8)
+    full[2:6, 2:6, 2:6] = 1
+    half = full.copy()
+    half[2:6, 2:6, 2:4] = 0
+    # Label 1 in both cases, label 2 only in the first case, perfectly predicted
+    first_reference = full.copy()
+    first_reference[0, 0, 0] = 2
+    first_prediction = half.copy()
+    first_prediction[0, 0, 0] = 2
+    save(reference_dir / 'case_0.nii.gz', first_reference)
+    save(prediction_dir / 'case_0.nii.gz', first_prediction)
+    save(reference_dir / 'case_1.nii.gz', full)
+    save(prediction_dir / 'case_1.nii.gz', full)
+
+    summary = SegmentationEvaluator(str(reference_dir), str(prediction_dir), labels=[1, 2]).run()
+
+    assert summary['mean'][1]['dice'] == pytest.approx((2 / 3 + 1) / 2)
+    # The NaN of the second case is not averaged as 0
+    assert summary['mean'][2]['dice'] == pytest.approx(1)
+    assert summary['foreground_mean']['dice'] == pytest.approx(((2 / 3 + 1) / 2 + 1) / 2)
+
+
+def full_volume_distances(reference_mask, prediction_mask):
+    # The surface distances with the distance transforms of the whole volume
+    reference_surface = reference_mask & ~ndimage.binary_erosion(reference_mask)
+    prediction_surface = prediction_mask & ~ndimage.binary_erosion(prediction_mask)
+    to_reference = ndimage.distance_transform_edt(~reference_surface, sampling=SPACING)[prediction_surface]
+    to_prediction = ndimage.distance_transform_edt(~prediction_surface, sampling=SPACING)[reference_surface]
+    distances = np.concatenate([to_reference, to_prediction])
+    return distances.mean(), np.percentile(distances, 95)
+
+
+def test_surface_distances_match_the_whole_volume(tmp_path):
+    reference, prediction = random_pair(seed=1)
+    # A label touching the border of the volume
+    reference[:4, :5, :3] = 6
+    prediction[:5, :4, :3] = 6
+    metrics = evaluate_case(save(tmp_path / 'ref.nii.gz', reference), save(tmp_path / 'pred.nii.gz', prediction))
+
+    for label in range(1, 7):
+        reference_mask, prediction_mask = reference == label, prediction == label
+        if not reference_mask.any() or not prediction_mask.any():
+            assert math.isnan(metrics[label]['assd_mm'])
+            continue
+        assd, hd95 = full_volume_distances(reference_mask, prediction_mask)
+        assert metrics[label]['assd_mm'] == pytest.approx(assd)
+        assert metrics[label]['hd95_mm'] == pytest.approx(hd95)
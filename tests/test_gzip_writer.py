@@ -0,0 +1,95 @@
+'''
+The multi-member `.nii.gz` files of `ParallelGzipWriter` must stay readable by SimpleITK, which nnUNet's SimpleITKIO
+uses to read the datasets.
+'''
+
+import gzip
+import zlib
+
+import nibabel as nib
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from utils.gzip_writer import GZIP_SETTINGS, ParallelGzipWriter, save_nifti, write_sitk_image
+
+
+BLOCK_SIZE = 64 * 1024
+THREADS = 4
+# nibabel works in RAS, SimpleITK in LPS
+RAS_TO_LPS = np.diag([-1.0, -1.0, 1.0])
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    # save_nifti and write_sitk_image take the block size from the shared settings
+    monkeypatch.setitem(GZIP_SETTINGS, 'block_size', BLOCK_SIZE)
+
+
+def gzip_members(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    members = 0
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decompressor.decompress(data)
+        data = decompressor.unused_data
+        members += 1
+    return members
+
+
+def make_volume():
+    rng = np.random.default_rng(0)
+    return rng.integers(-1000, 2000, size=(64, 48, 40), dtype=np.int16)
+
+
+def test_parallel_gzip_writer_writes_several_members(tmp_path):
+    data = make_volume().tobytes()
+    path = str(tmp_path / 'data.gz')
+    with ParallelGzipWriter(path, compresslevel=1, threads=THREADS, block_size=BLOCK_SIZE) as f:
+        # Uneven writes, the output only depends on the block size
+        for start in range(0, len(data), 10000):
+            f.write(data[start:start + 10000])
+
+    assert gzip_members(path) == -(-len(data) // BLOCK_SIZE)
+    with gzip.open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_save_nifti_is_read_by_simpleitk(tmp_path, small_blocks):
+    volume = make_volume()
+    affine = np.array([
+        [0.0, -0.8, 0.0, 120.5],
+        [0.7, 0.0, 0.0, -30.25],
+        [0.0, 0.0, 2.5, 40.0],
+        [0.0, 0.0, 0.0, 1.0],
+    ])
+    path = str(tmp_path / 'volume.nii.gz')
+    save_nifti(nib.Nifti1Image(volume, affine), path, threads=THREADS)
+    assert gzip_members(path) > 1
+
+    image = sitk.ReadImage(path)
+    # SimpleITK arrays are indexed (z, y, x)
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(image).transpose(2, 1, 0), volume)
+
+    zooms = np.linalg.norm(affine[:3, :3], axis=0)
+    np.testing.assert_allclose(image.GetSpacing(), zooms, rtol=1e-6)
+    np.testing.assert_allclose(image.GetOrigin(), RAS_TO_LPS @ affine[:3, 3], atol=1e-4)
+    direction = np.array(image.GetDirection()).reshape(3, 3)
+    np.testing.assert_allclose(direction, RAS_TO_LPS @ (affine[:3, :3] / zooms), atol=1e-6)
+
+
+def test_write_sitk_image_round_trip(tmp_path, small_blocks):
+    image = sitk.GetImageFromArray(make_volume().transpose(2, 1, 0))
+    image.SetSpacing((0.8, 0.7, 2.5))
+    image.SetOrigin((-120.5, 30.25, 40.0))
+    image.SetDirection((0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0))
+    path = str(tmp_path / 'volume.nii.gz')
+    write_sitk_image(image, path, threads=THREADS)
+    assert gzip_members(path) > 1
+
+    read = sitk.ReadImage(path)
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(read), sitk.GetArrayFromImage(image))
+    np.testing.assert_allclose(read.GetSpacing(), image.GetSpacing(), rtol=1e-6)
+    np.testing.assert_allclose(read.GetOrigin(), image.GetOrigin(), atol=1e-4)
+    np.testing.assert_allclose(read.GetDirection(), image.GetDirection(), atol=1e-6)
@@ -0,0 +1,63 @@
+'''
+The parallel merge must write exactly the files of the serial merge, with and without slabs.
+'''
+
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from utils import MultiClassNiftiMerger
+
+
+N_CASES = 4
+N_CLASSES = 5
+SHAPE = (48, 40, 30)
+
+
+@pytest.fixture(scope='module')
+def dataset(tmp_path_factory):
+    # A column of voxels cut into one block per class along z, one slice of overlap between the blocks
+    root = str(tmp_path_factory.mktemp('raw'))
+    rng = np.random.default_rng(0)
+    volume_dir = os.path.join(root, 'volumes')
+    class_dirs = [os.path.join(root, f'class_{idx + 1}', 'segmentations') for idx in range(N_CLASSES)]
+    for directory in [volume_dir] + class_dirs:
+        os.makedirs(directory)
+
+    affine = np.diag([0.8, 0.8, 1.5, 1.0])
+    bounds = np.linspace(0, SHAPE[2], N_CLASSES + 1).astype(int)
+    for case in range(N_CASES):
+        filename = f'case_{case:03d}.nii.gz'
+        volume = rng.integers(-1000, 1000, size=SHAPE, dtype=np.int16)
+        nib.save(nib.Nifti1Image(volume, np.eye(4)), os.path.join(volume_dir, filename))
+        for idx, class_dir in enumerate(class_dirs):
+            mask = np.zeros(SHAPE, dtype=np.uint8)
+            mask[10 + case:30, 12:28, bounds[idx]:min(bounds[idx + 1] + 1, SHAPE[2])] = 1
+            nib.save(nib.Nifti1Image(mask, affine), os.path.join(class_dir, filename))
+    return volume_dir, class_dirs
+
+
+def merge(dataset, output_dir, workers, **kwargs):
+    volume_dir, class_dirs = dataset
+    results = MultiClassNiftiMerger.process_directories(volume_dir, class_dirs, str(output_dir), workers=workers, **kwargs)
+    assert results and all(error is None for error in results.values())
+
+    segmentation_dir = os.path.join(str(output_dir), 'segmentations')
+    files = {}
+    for filename in sorted(os.listdir(segmentation_dir)):
+        with open(os.path.join(segmentation_dir, filename), 'rb') as f:
+            files[filename] = f.read()
+    return files
+
+
+@pytest.mark.parametrize('slab_depth', [None, 7])
+def test_parallel_merge_matches_serial(dataset, tmp_path, slab_depth):
+    serial = merge(dataset, tmp_path / 'serial', workers=1, slab_depth=slab_depth)
+    parallel = merge(dataset, tmp_path / 'parallel', workers=3, slab_depth=slab_depth)
+
+    assert len(serial) == N_CASES
+    assert serial.keys() == parallel.keys()
+    for filename in serial:
+        assert serial[filename] == parallel[filename], filename
@@ -0,0 +1,43 @@
+'''
+A case of `DatasetBuilder` is only ever in one split, also when a re-run without a manifest moves it to the other one.
+'''
+
+import json
+import os
+
+from benchmarks.synthetic import make_dataset
+from utils import DatasetBuilder
+
+
+N_CASES = 8
+
+
+def split_names(dataset_dir):
+    names = {}
+    for split, directory in (('train', 'labelsTr'), ('test', 'labelsTs')):
+        for filename in os.listdir(os.path.join(dataset_dir, directory)):
+            names.setdefault(filename[:-len('.nii.gz')], []).append(split)
+    for split, directory in (('train', 'imagesTr'), ('test', 'imagesTs')):
+        for filename in os.listdir(os.path.join(dataset_dir, directory)):
+            names.setdefault(filename[:-len('_0000.nii.gz')], []).append(split)
+    return names
+
+
+def test_rebuild_with_another_seed_moves_the_cases(tmp_path):
+    volume_dir, class_dirs = make_dataset(str(tmp_path / 'raw'), n_cases=N_CASES, shape=(24, 24, 16), n_classes=2)
+    raw_dir = str(tmp_path / 'nnUNet_raw')
+
+    splits = []
+    for seed in (0, 1):
+        builder = DatasetBuilder(volume_dir, class_dirs, raw_dir, train_ratio=0.5, seed=seed)
+        builder.run()
+        with open(os.path.join(builder.dataset_dir, 'case_mapping.json')) as f:
+            mapping = json.load(f)
+        splits.append({name: entry['split'] for name, entry in mapping.items()})
+
+        names = split_names(builder.dataset_dir)
+        assert len(names) == N_CASES
+        # The image and the label of every case, in its split only
+        assert {name: sorted(found) for name, found in names.items()} == {name: [split] * 2 for name, split in splits[-1].items()}
+
+    assert splits[0] != splits[1]
@@ -0,0 +1,54 @@
+'''
+DataSplitter pairs the images and the labels on their case id, or on their sorted position when the names differ
+(`image_N` / `label_N`).
+'''
+
+import os
+
+import pytest
+
+from utils import DataSplitter
+
+
+def write_files(directory, names):
+    os.makedirs(directory, exist_ok=True)
+    for name in names:
+        with open(os.path.join(directory, name), 'w') as f:
+            # The number of the pair, to check that the image and the label end up together
+            f.write(name.split('_')[1].split('.')[0])
+
+
+def split_pairs(output_dir):
+    pairs = []
+    for split in ('train', 'valid', 'test'):
+        images_dir = os.path.join(output_dir, split, 'images')
+        labels_dir = os.path.join(output_dir, split, 'labels')
+        images = sorted(os.listdir(images_dir))
+        labels = sorted(os.listdir(labels_dir))
+        assert len(images) == len(labels)
+        for image, label in zip(images, labels):
+            with open(os.path.join(images_dir, image)) as f, open(os.path.join(labels_dir, label)) as g:
+                pairs.append((f.read(), g.read()))
+    return pairs
+
+
+@pytest.mark.parametrize('label_prefix', ['image', 'label'])
+def test_splitter_pairs_every_image_with_its_label(tmp_path, label_prefix):
+    write_files(str(tmp_path / 'images'), [f'image_{i}.png' for i in range(10)])
+    write_files(str(tmp_path / 'labels'), [f'{label_prefix}_{i}.png' for i in range(10)])
+
+    report = DataSplitter(str(tmp_path / 'images'), str(tmp_path / 'labels'), str(tmp_path / 'split'), link_mode='hardlink').run()
+    assert sum(report.methods.values()) == 20
+
+    pairs = split_pairs(str(tmp_path / 'split'))
+    assert len(pairs) == 10
+    assert all(image == label for image, label in pairs)
+
+
+def test_splitter_refuses_files_it_cannot_pair(tmp_path):
+    write_files(str(tmp_path / 'images'), [f'image_{i}.png' for i in range(10)])
+    write_files(str(tmp_path / 'labels'), [f'label_{i}.png' for i in range(9)])
+
+    splitter = DataSplitter(str(tmp_path / 'images'), str(tmp_path / 'labels'), str(tmp_path / 'split'))
+    with pytest.raises(ValueError, match='no case id in common'):
+        splitter.run()
@@ -1 +1,15 @@
-from .dataset import MetadataCopier, MultiClassNiftiMerger, DataSplitter, DataRenamer
\ No newline at end of file
+from .dataset import MetadataCopier, MultiClassNiftiMerger, DataSplitter, DataRenamer
+from .fusion import LabelFuser, LabelOverlapError
+from .manifest import Manifest
+from .pipeline import DatasetBuilder
+from .gzip_writer import ParallelGzipWriter, configure_gzip
+from .instrumentation import RunReport, CaseRecorder
+from .label_stats import LabelStats, LabelStatsIndex
+from .crop import ForegroundCropper, uncrop, uncrop_directory
+from .mesh import MeshExporter
+from .evaluation import SegmentationEvaluator
+from .integrity import DatasetScanner
+from .scheduler import CaseScheduler
+from .splits import SplitGenerator
+from .store import ArrayStore, ArrayStoreExporter
+from .postprocessing import ComponentFilter
\ No newline at end of file
@@ -0,0 +1,116 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import os
+
+
+NIFTI_EXTENSIONS = ('.nii.gz', '.nii')
+
+
+def case_id(filename, extensions=NIFTI_EXTENSIONS):
+    '''
+    Return the case id of a file, its name without the extension: `volume_001.nii.gz` -> `volume_001`.
+    '''
+    name = os.path.basename(filename)
+    for ext in extensions:
+        if ext and name.endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+
+class CaseIndex:
+    '''
+    Index a reference directory (the volumes) and a list of other directories (the classes, the segmentations...)
+    by case id. Every directory is listed only once and the files are matched on the exact case id, so `case_1` never
+    picks up `case_10` like a `case_1*` glob would.
+
+    The problems are collected while indexing so they can be reported before any case is processed:
+    - missing: the cases for which some directories have no file.
+    - ambiguous: the cases for which a directory has several files with the same case id (e.g. `a.nii` and `a.nii.gz`).
+    - unmatched: the files of the other directories that do not belong to any reference case.
+
+    ### Params
+    - reference_dir: the directory that defines the cases, usually the volumes.
+    - other_dirs: the list of directories to match against the reference cases.
+    - ext: the extension (or tuple of extensions) of the files to index, None to index every file.
+    - key_func: function giving the case id of a filename, `case_id` by default.
+
+    ### Example of usage
+
+    ```Python
+    from utils.case_index import CaseIndex
+
+    index = CaseIndex('datasets/volumes', ['datasets/vertebrae_C1/segmentations', 'datasets/vertebrae_C2/segmentations'])
+    index.report()
+    for case in index.cases:
+        volume_path, class_paths = index.paths(case)
+    ```
+    '''
+    def __init__(self, reference_dir, other_dirs, ext=NIFTI_EXTENSIONS, key_func=None):
+        self.reference_dir = reference_dir
+        self.other_dirs = list(other_dirs)
+        self.extensions = (ext,) if isinstance(ext, str) else ext
+        self.key_func = key_func or (lambda filename: case_id(filename, self.extensions or NIFTI_EXTENSIONS))
+
+        self.ambiguous = {}
+        self.unmatched = {}
+
+        reference = self.list_directory(reference_dir)
+        self.cases = sorted(reference)
+        self.references = {case: reference[case][0] for case in self.cases}
+
+        self.files = {case: [None] * len(self.other_dirs) for case in self.cases}
+        for dir_idx, directory in enumerate(self.other_dirs):
+            for case, paths in self.list_directory(directory).items():
+                if case in self.files:
+                    self.files[case][dir_idx] = paths[0]
+                else:
+                    self.unmatched.setdefault(directory, []).extend(paths)
+
+        self.missing = {
+            case: [self.other_dirs[dir_idx] for dir_idx, path in enumerate(paths) if path is None]
+            for case, paths in self.files.items()
+            if None in paths
+        }
+
+    def list_directory(self, directory):
+        # Single listing of the directory: case id -> sorted list of paths
+        entries = {}
+        with os.scandir(directory) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                if self.extensions and not entry.name.endswith(tuple(self.extensions)):
+                    continue
+                entries.setdefault(self.key_func(entry.name), []).append(entry.path)
+
+        for case, paths in entries.items():
+            paths.sort()
+            if len(paths) > 1:
+                self.ambiguous.setdefault(case, {})[directory] = paths
+        return entries
+
+    def paths(self, case):
+        '''
+        Return the reference path of a case and the list of its paths in the other directories (None where missing).
+        '''
+        return self.references[case], list(self.files[case])
+
+    def is_ambiguous(self, case):
+        return case in self.ambiguous
+
+    def complete_cases(self):
+        return [case for case in self.cases if case not in self.missing and case not in self.ambiguous]
+
+    def report(self):
+        for case, directories in self.missing.items():
+            print(f"Case {case} has no file in: {', '.join(directories)}")
+        for case, matches in self.ambiguous.items():
+            for directory, paths in matches.items():
+                print(f"Case {case} is ambiguous in {directory}: {', '.join(os.path.basename(p) for p in paths)}")
+        for directory, paths in self.unmatched.items():
+            print(f"{len(paths)} files of {directory} do not match any case of {self.reference_dir}")
+        print(f"Indexed {len(self.cases)} cases, {len(self.complete_cases())} complete, "
+              f"{len(self.missing)} with missing files, {len(self.ambiguous)} ambiguous")
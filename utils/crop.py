@@ -0,0 +1,263 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import json
+import math
+import os
+import nibabel as nib
+import numpy as np
+
+from .case_index import CaseIndex, case_id
+from .fileops import materialize
+from .gzip_writer import open_output, save_nifti
+from .instrumentation import recorder
+from .nifti_header import read_header
+from .parallel import CaseBatch, failed_results
+
+
+CROPS_FILENAME = 'crops.json'
+
+
+class ForegroundCropper:
+    '''
+    Crop the volumes and their segmentations to the bounding box of the labels plus a margin, so the voxels far from
+    the spine are not copied, compressed and preprocessed by nnUNet.
+
+    The crop is done on the raw data: the header of every file is kept as it is (data type, scaling, extensions) and
+    only its shape and the translation of its qform/sform change, so a voxel keeps its world position. The crop of
+    every case (start and stop indices, original shape and affine) is written to `crops.json`, next to the output
+    segmentations directory rather than inside it so the next steps can move or delete the segmentations, `uncrop`
+    pastes a prediction made on the cropped volume back into the original space.
+
+    The crops are keyed by the case ids of the inputs, `uncrop_directory` maps the nnUNet names of the predictions
+    back to them with a `case_mapping.json`. `DatasetBuilder(crop_margin=...)` crops while building the dataset and
+    keys its crops by the nnUNet names directly.
+
+    ### Params
+    - volume_dir: the directory of the volumes.
+    - segmentation_dir: the directory of the segmentations, matched to the volumes on their case id.
+    - output_volumes_dir: where the cropped volumes are written.
+    - output_segmentations_dir: where the cropped segmentations and `crops.json` are written.
+    - margin: the margin around the labels in millimetres, a number or one per axis, default=10
+    - workers: number of processes, `None` uses all the cores, default=1
+    - manifest: optional `Manifest` to skip the cases that are already cropped.
+    - crops_path: where the crops are written, default=`crops.json` in the parent of `output_segmentations_dir`
+
+    ### Example of usage
+
+    ```Python
+    from utils import ForegroundCropper, uncrop_directory
+
+    cropper = ForegroundCropper('datasets/corrected/volumes', 'datasets/corrected/segmentations',
+                                'datasets/cropped/volumes', 'datasets/cropped/segmentations', margin=15)
+    cropper.run()
+
+    # Later, back to the original volumes
+    uncrop_directory('predictions', 'datasets/cropped/crops.json', 'predictions_full', case_mapping='Dataset100_SPINE/case_mapping.json')
+    ```
+    '''
+    def __init__(self, volume_dir, segmentation_dir, output_volumes_dir, output_segmentations_dir, margin=10, workers=1, manifest=None, crops_path=None):
+        self.volume_dir = volume_dir
+        self.segmentation_dir = segmentation_dir
+        self.output_volumes_dir = output_volumes_dir
+        self.output_segmentations_dir = output_segmentations_dir
+        self.margin = margin
+        self.workers = workers
+        self.manifest = manifest
+        self.crops_path = crops_path or os.path.join(os.path.dirname(os.path.abspath(output_segmentations_dir)), CROPS_FILENAME)
+
+    def run(self):
+        os.makedirs(self.output_volumes_dir, exist_ok=True)
+        os.makedirs(self.output_segmentations_dir, exist_ok=True)
+
+        index = CaseIndex(self.volume_dir, [self.segmentation_dir])
+        index.report()
+
+        crops = load_crops(self.crops_path) if os.path.exists(self.crops_path) else {}
+        batch = CaseBatch(self.manifest)
+        for case in index.complete_cases():
+            volume_path, (segmentation_path,) = index.paths(case)
+            outputs = [os.path.join(self.output_volumes_dir, os.path.basename(volume_path)),
+                       os.path.join(self.output_segmentations_dir, os.path.basename(segmentation_path))]
+            # A tuple or an array of margins is recorded as a list, like it is read back from the manifest
+            params = {'margin': np.asarray(self.margin, dtype=float).tolist()}
+            job = (case, volume_path, segmentation_path, outputs[0], outputs[1], self.margin)
+            # Without its crop a case cannot be uncropped, it is not up to date
+            batch.add(case, job, [volume_path, segmentation_path], params, outputs, fresh=case in crops)
+
+        def add_crop(case, error, crop):
+            if error is None:
+                crops[case] = crop
+
+        try:
+            results = batch.run(_crop_case, index.cases, add_crop, self.workers, verb='cropping')
+        finally:
+            # The crops are needed to uncrop the predictions, they are saved whatever happens
+            save_crops(self.crops_path, {case: crop for case, crop in crops.items() if case in index.cases})
+
+        failed = failed_results(results)
+        for case, error in failed.items():
+            print(f"Failed to crop {case}: {error}")
+
+        original = sum(np.prod(crop['original_shape']) for case, crop in crops.items() if case in results)
+        cropped = sum(np.prod(np.subtract(crop['stop'], crop['start'])) for case, crop in crops.items() if case in results)
+        if original:
+            print(f"Cropped {len(results) - len(failed)}/{len(results)} cases, {100 * cropped / original:.1f} % of the voxels kept")
+        return results
+
+
+def _crop_case(case, volume_path, segmentation_path, output_volume_path, output_segmentation_path, margin):
+    # Module level so that it can be pickled by the process pool
+    try:
+        crop = crop_case(volume_path, segmentation_path, output_volume_path, output_segmentation_path, margin)
+        print(f"Cropped {case}: {crop['start']} -> {crop['stop']} of {crop['original_shape']}")
+    except Exception as e:
+        return case, f'{type(e).__name__}: {e}', None
+    return case, None, crop
+
+
+def crop_case(volume_path, segmentation_path, output_volume_path, output_segmentation_path, margin=10):
+    '''
+    Crop a volume and its segmentation to the bounding box of the labels plus `margin` millimetres, and return the
+    crop as a dict (see `ForegroundCropper`). A segmentation without any label is not cropped.
+    '''
+    rec = recorder()
+    with rec.stage('read'):
+        segmentation = nib.load(segmentation_path)
+        labels = np.asanyarray(segmentation.dataobj.get_unscaled() if nib.is_proxy(segmentation.dataobj) else segmentation.dataobj)
+    shape = labels.shape[:3]
+
+    volume_header = read_header(volume_path)
+    if volume_header is None or volume_header.get_data_shape()[:3] != shape:
+        raise ValueError(f'The volume {volume_path} does not match the shape {shape} of its segmentation')
+
+    start, stop = foreground_box(labels, segmentation.header.get_zooms()[:3], margin)
+    crop = {
+        'start': start,
+        'stop': stop,
+        'original_shape': list(shape),
+        'original_affine': segmentation.affine.tolist(),
+    }
+
+    if start == [0, 0, 0] and stop == list(shape):
+        if not labels.any():
+            print(f"No label in {segmentation_path}, the case is not cropped")
+        materialize(volume_path, output_volume_path, 'auto')
+        materialize(segmentation_path, output_segmentation_path, 'auto')
+        return crop
+
+    slices = tuple(slice(a, b) for a, b in zip(start, stop))
+    write_cropped(read_header(segmentation_path), labels[slices], start, output_segmentation_path)
+    del labels
+
+    with rec.stage('read'):
+        volume = nib.load(volume_path, mmap=True)
+        data = volume.dataobj.get_unscaled() if nib.is_proxy(volume.dataobj) else np.asanyarray(volume.dataobj)
+    write_cropped(volume_header, data[slices], start, output_volume_path)
+    return crop
+
+
+def foreground_box(labels, zooms, margin=10):
+    '''
+    Return the start and stop indices of the bounding box of the non zero voxels of `labels` grown by `margin`
+    millimetres (one value or one per axis) and clipped to the volume, the whole volume if there is no label.
+    '''
+    shape = labels.shape[:3]
+    margins = np.broadcast_to(np.asarray(margin, dtype=float), (3,))
+    start, stop = [], []
+    for axis in range(3):
+        # Project the foreground on the axis
+        other_axes = tuple(a for a in range(labels.ndim) if a != axis)
+        occupied = np.flatnonzero(np.any(labels != 0, axis=other_axes))
+        if occupied.size == 0:
+            return [0, 0, 0], list(shape)
+        pad = math.ceil(margins[axis] / zooms[axis]) if zooms[axis] > 0 else 0
+        start.append(max(int(occupied[0]) - pad, 0))
+        stop.append(min(int(occupied[-1]) + 1 + pad, shape[axis]))
+    return start, stop
+
+
+def shifted_header(header, start, shape):
+    '''
+    Return a copy of the on-disk `header` for the data cropped at voxel `start` with `shape`: the translations of the
+    qform and sform move to the world position of the new first voxel, everything else is kept.
+    '''
+    header = header.copy()
+    header.set_data_shape(tuple(shape) + tuple(header.get_data_shape()[3:]))
+    offset = np.asarray(start, dtype=np.float64)
+
+    qform = header.get_qform()
+    header['qoffset_x'], header['qoffset_y'], header['qoffset_z'] = qform[:3, :3] @ offset + qform[:3, 3]
+    sform = header.get_sform()
+    for row, field in enumerate(('srow_x', 'srow_y', 'srow_z')):
+        header[field][3] = sform[row, :3] @ offset + sform[row, 3]
+    return header
+
+
+def write_cropped(header, data, start, path):
+    # The raw data is written after the header like `combine_slabs` does, so the values are not rescaled
+    header = shifted_header(header, start, data.shape[:3])
+    with recorder().stage('write'), open_output(path) as f:
+        header.write_to(f)
+        f.write(b'\x00' * (int(header.get_data_offset()) - f.tell()))
+        f.write(np.asarray(data, dtype=header.get_data_dtype()).tobytes(order='F'))
+
+
+def load_crops(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_crops(path, crops):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(crops, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def uncrop(path, output_path, crop, fill=0):
+    '''
+    Paste the image `path` (a prediction made on a cropped volume) into an image of the original shape and affine of
+    `crop` (an entry of `crops.json`), the voxels outside of the crop are set to `fill`.
+    '''
+    image = nib.load(path)
+    data = np.asanyarray(image.dataobj)
+    expected = tuple(np.subtract(crop['stop'], crop['start']))
+    if data.shape[:3] != expected:
+        raise ValueError(f'{path} has the shape {data.shape[:3]}, the crop has the shape {expected}')
+
+    full = np.full(tuple(crop['original_shape']) + data.shape[3:], fill, dtype=data.dtype)
+    full[tuple(slice(a, b) for a, b in zip(crop['start'], crop['stop']))] = data
+
+    header = image.header.copy()
+    affine = np.array(crop['original_affine'])
+    uncropped = nib.Nifti1Image(full, affine, header)
+    uncropped.set_qform(affine, code=int(header['qform_code']) or 1)
+    uncropped.set_sform(affine, code=int(header['sform_code']) or 1)
+    save_nifti(uncropped, output_path)
+
+
+def uncrop_directory(prediction_dir, crops_path, output_dir, key_func=None, case_mapping=None):
+    '''
+    Uncrop every prediction of `prediction_dir` whose case id (see `case_id`, or `key_func`) is in `crops_path`. With
+    `case_mapping` (a `case_mapping.json` like the one of `DatasetBuilder`), the nnUNet names of the predictions are
+    mapped back to the case ids of the crops.
+    '''
+    crops = load_crops(crops_path)
+    if case_mapping is not None:
+        with open(case_mapping) as f:
+            mapping = json.load(f)
+        crops.update({name: crops[entry['case']] for name, entry in mapping.items() if entry['case'] in crops})
+    key_func = key_func or case_id
+    os.makedirs(output_dir, exist_ok=True)
+    for filename in sorted(os.listdir(prediction_dir)):
+        if not filename.endswith(('.nii', '.nii.gz')):
+            continue
+        case = key_func(filename)
+        if case not in crops:
+            print(f"No crop recorded for {filename}, skipping it")
+            continue
+        uncrop(os.path.join(prediction_dir, filename), os.path.join(output_dir, filename), crops[case])
+        print(f"Uncropped {filename}")
@@ -12,6 +12,16 @@ import random
 import logging
 import SimpleITK as sitk
 
+from .case_index import CaseIndex
+from .fileops import MaterializeReport, materialize, release_output
+from .fusion import LabelFuser
+from .gzip_writer import open_output, save_nifti, write_sitk_image
+from .instrumentation import case_recorder, recorder, report_case, timed_read
+from .label_stats import LabelStats, LabelStatsIndex, label_statistics, load_volume
+from .nifti_header import geometry_header, read_header, write_with_header
+from .parallel import CaseBatch, failed_results
+from .scheduler import STREAMING_MEMORY, CaseScheduler, image_nbytes
+
 
 class MultiClassNiftiMerger:
     '''
@@ -21,8 +31,16 @@ class MultiClassNiftiMerger:
     ### Params
     - volume_path: Path to the volume NIfTI file.
     - class_paths: List of paths to the class NIfTI files.
+    - labels: Label value of each class path, by default the position of the class path starting at 1.
     - output_dir: Directory where the merged files will be saved.
     - move_volumes: Flag to control whether to move corresponding volumes.
+    - overlap: What to do with voxels claimed by several classes: 'last' (default, the last class wins), 'first'
+    or 'error' (raise a `LabelOverlapError` with the number of overlapping voxels), see `LabelFuser`.
+    - slab_depth: If set, the case is merged in z-slabs of this many slices which are read from all the class files,
+    fused and appended to the output one after the other, so the peak memory is bounded by the slab size instead of the
+    volume size. Uncompressed `.nii` inputs are memory-mapped.
+    - label_stats: If True, the voxel count, bounding box, centroid and CT histogram of every label are computed
+    from the fused label map in the same pass and kept in `self.stats`, see `utils.label_stats.LabelStats`.
 
     ### Example of usage
 
@@ -34,18 +52,41 @@ class MultiClassNiftiMerger:
     class_dirs = ['datasets/hips/hip_right100/segmentations', 'datasets/hips/hip_left100/segmentations']
     output_dir = 'datasets/hips/merged'
     MultiClassNiftiMerger.process_directories(volume_dir, class_dirs, output_dir, move_volumes=True)
+
+    # Same thing but merging 8 cases at a time
+    MultiClassNiftiMerger.process_directories(volume_dir, class_dirs, output_dir, move_volumes=True, workers=8)
+
+    # Streaming 32 slices at a time, for volumes that do not fit in memory
+    MultiClassNiftiMerger.process_directories(volume_dir, class_dirs, output_dir, move_volumes=True, slab_depth=32)
+
+    # Also writing the statistics of every label to a columnar index, see `LabelStatsIndex`
+    MultiClassNiftiMerger.process_directories(volume_dir, class_dirs, output_dir, stats_path='datasets/hips/merged/label_stats.npz')
     ```
     '''
     
-    def __init__(self, volume_path, class_paths, output_dir, move_volumes=False):
+    def __init__(self, volume_path, class_paths, output_dir, move_volumes=False, overlap='last', slab_depth=None, labels=None, label_stats=False):
         self.volume_path = volume_path
         self.class_paths = class_paths
+        self.labels = list(labels) if labels is not None else list(range(1, len(class_paths) + 1))
         self.output_dir = output_dir
         self.move_volumes = move_volumes
+        self.overlap = overlap
+        self.slab_depth = slab_depth
+        self.label_stats = label_stats
+        self.stats = None
 
         self.segmentations_dir = os.path.join(output_dir, 'segmentations')
         self.volumes_dir = os.path.join(output_dir, 'volumes')
 
+        combined_filename = os.path.basename(self.volume_path).replace('volume', 'combined')
+        self.combined_path = os.path.join(self.segmentations_dir, combined_filename)
+
+    def output_paths(self):
+        paths = [self.combined_path]
+        if self.move_volumes:
+            paths.append(os.path.join(self.volumes_dir, os.path.basename(self.volume_path)))
+        return paths
+
     def check_files(self):
         # Check if files exist
         paths_to_check = [self.volume_path] + self.class_paths
@@ -61,47 +102,210 @@ class MultiClassNiftiMerger:
         if self.move_volumes:
             os.makedirs(self.volumes_dir, exist_ok=True)
 
-        # Initialize a combined array with zeros
-        first_nifti = nib.load(self.class_paths[0])
-        combined_classes = np.zeros(first_nifti.shape, dtype=np.int16)
+        combined_path = self.combined_path
+        release_output(combined_path)
+        rec = recorder()
 
-        # Assign new class labels
-        for idx, class_path in enumerate(self.class_paths):
-            class_nifti = nib.load(class_path)
-            class_data = class_nifti.get_fdata()
-            combined_classes[class_data > 0] = idx + 1
+        if self.slab_depth:
+            self.combine_slabs(combined_path)
+        else:
+            # Only the headers are read here, the masks are decoded one at a time by the fuser
+            with rec.stage('read'):
+                class_niftis = [nib.load(class_path) for class_path in self.class_paths]
+            labels = self.labels
 
-        # Create a new NIfTI image for the combined classes
-        combined_nifti = nib.Nifti1Image(combined_classes, affine=class_nifti.affine)
+            # Assign new class labels, the masks are read in their native dtype
+            fuser = LabelFuser(self.overlap)
+            with rec.stage('fuse'):
+                combined_classes = fuser.fuse(timed_read(class_nifti.dataobj for class_nifti in class_niftis), labels, class_niftis[0].shape)
+            fuser.check()
 
-        # Save the new NIfTI file
-        combined_filename = os.path.basename(self.volume_path).replace('volume', 'combined')
-        combined_path = os.path.join(self.segmentations_dir, combined_filename)
-        nib.save(combined_nifti, combined_path)
+            if self.label_stats:
+                with rec.stage('stats'):
+                    volume = load_volume(self.volume_path, combined_classes.shape)
+                    self.stats = label_statistics(combined_classes, class_niftis[-1].affine, max(labels) + 1, volume)
+
+            # Create a new NIfTI image for the combined classes
+            combined_nifti = nib.Nifti1Image(combined_classes, affine=class_niftis[-1].affine)
+
+            # Save the new NIfTI file, compressed with several threads
+            with rec.stage('write'):
+                save_nifti(combined_nifti, combined_path)
+
+        rec.add_file_bytes('read', *self.class_paths)
+        rec.add_file_bytes('write', combined_path)
 
         # Optionally move the volume file
         if self.move_volumes:
-            shutil.copy(self.volume_path, self.volumes_dir)
+            materialize(self.volume_path, self.volumes_dir, 'copy')
 
         print(f"Combined NIfTI file saved at: {combined_path}")
 
-    @staticmethod
-    def process_directories(volume_dir, class_dirs, output_dir, ext='.nii.gz', move_volumes=False):
-        volume_files = glob(os.path.join(volume_dir, f'*{ext}'))
+    def combine_slabs(self, combined_path):
+        # mmap only applies to uncompressed files, keep_file_open lets the gzip stream go forward slab after slab
+        # instead of being decompressed again from the start for every slab
+        rec = recorder()
+        with rec.stage('read'):
+            class_niftis = [nib.load(class_path, mmap=True, keep_file_open=True) for class_path in self.class_paths]
+        labels = self.labels
+        shape = class_niftis[0].shape
+        fuser = LabelFuser(self.overlap)
+
+        # The header is built from a zero-strided placeholder so nothing of the volume size is allocated, this gives
+        # the same file as nib.save on the fully fused array
+        placeholder = np.broadcast_to(np.zeros((), dtype=fuser.label_dtype(labels)), shape)
+        header = nib.Nifti1Image(placeholder, affine=class_niftis[-1].affine).header
+        header.set_slope_inter(1.0, 0.0)
+
+        stats = volume = None
+        if self.label_stats:
+            stats = LabelStats(max(labels) + 1, shape)
+            volume = load_volume(self.volume_path, shape)
+
+        try:
+            with open_output(combined_path) as f:
+                header.write_to(f)
+                f.write(b'\x00' * (int(header.get_data_offset()) - f.tell()))
+
+                # NIfTI data is stored in Fortran order, so z-slabs are contiguous in the file
+                for z_start in range(0, shape[2], self.slab_depth):
+                    z_stop = min(z_start + self.slab_depth, shape[2])
+                    with rec.stage('fuse'):
+                        slab = fuser.fuse(
+                            timed_read(class_nifti.dataobj[:, :, z_start:z_stop] for class_nifti in class_niftis),
+                            labels,
+                            shape[:2] + (z_stop - z_start,) + shape[3:]
+                        )
+                    if stats is not None:
+                        with rec.stage('stats'):
+                            stats.update(slab, z_start, volume[:, :, z_start:z_stop] if volume is not None else None)
+                    with rec.stage('write'):
+                        f.write(slab.tobytes(order='F'))
+            fuser.check()
+            if stats is not None:
+                self.stats = stats.finalize(class_niftis[-1].affine)
+        except Exception:
+            if os.path.exists(combined_path):
+                os.remove(combined_path)
+            raise
 
-        for volume_file in volume_files:
-            volume_filename = os.path.basename(volume_file)
-            class_paths = [glob(os.path.join(class_dir, f"{volume_filename.split('.')[0]}*{ext}")) for class_dir in class_dirs]
-            class_paths = [item for sublist in class_paths for item in sublist] # Flatten list
+    @staticmethod
+    def process_directories(volume_dir, class_dirs, output_dir, ext='.nii.gz', move_volumes=False, workers=1, overlap='last', slab_depth=None, manifest=None, run_report=None, stats_path=None, label_names=None,
+                            memory_budget=None, shard=None):
+        '''
+        Merge every case found in `volume_dir`. With `workers` > 1 the cases are merged in a process pool
+        (`workers=None` uses all the cores), every case goes through the same `combine_classes` call as the
+        serial path so the outputs are identical.
+
+        The class files are matched to the volumes on their exact case id through a `CaseIndex` (every directory is
+        listed once), the missing and ambiguous matches are reported before merging. The label of a class is the
+        position of its directory in `class_dirs`, so a case missing a class does not shift the other labels.
+        Ambiguous cases are not merged.
+
+        With a `Manifest`, the cases whose inputs and parameters did not change since the last run are skipped and
+        the merged cases are recorded in it. With a `RunReport` (`run_report`) every case is instrumented and its record is added to
+        the report.
+
+        With `stats_path`, the statistics of every label (see `LabelStats`) are computed while merging and written to
+        a `LabelStatsIndex` at this path, `label_names` being the names of the classes (`label_1`, `label_2`... by
+        default). The statistics of the skipped up to date cases are kept from the existing index.
+
+        With a process pool the cases run largest first (see `CaseScheduler`), with `memory_budget` ('48G') the memory
+        estimated from the headers of the running cases stays within the budget. With `shard` ('i/N') only the cases of this shard are
+        merged, give every shard its own manifest (`utils.scheduler.shard_path`) and merge them with `Manifest.merge`.
+
+        A failing case does not abort the batch, the returned dict maps each volume path to `None` on success
+        or to the error message on failure.
+        '''
+        index = CaseIndex(volume_dir, class_dirs, ext=ext)
+        index.report()
+        scheduler = CaseScheduler(workers, memory_budget, shard)
+
+        batch = CaseBatch(manifest)
+        case_stats = {}
+        job_cases = {}
+        cases = scheduler.select(index.cases)
+        for case in cases:
+            volume_file, class_paths = index.paths(case)
+            if index.is_ambiguous(case):
+                batch.results[volume_file] = f'Ambiguous class files for case {case}'
+                continue
+
+            labels = [idx + 1 for idx, path in enumerate(class_paths) if path is not None]
+            class_paths = [path for path in class_paths if path is not None]
 
             if class_paths:
-                merger = MultiClassNiftiMerger(
-                    volume_file,
-                    class_paths,
-                    output_dir,
-                    move_volumes
+                merger_kwargs = dict(
+                    output_dir=output_dir,
+                    move_volumes=move_volumes,
+                    overlap=overlap,
+                    slab_depth=slab_depth,
+                    labels=labels,
+                    label_stats=stats_path is not None
                 )
-                merger.combine_classes()
+
+                # The slab depth does not change the output, it is not part of the parameters
+                params = {'overlap': overlap, 'labels': labels, 'move_volumes': move_volumes}
+                if stats_path is not None:
+                    params['label_stats'] = True
+                outputs = MultiClassNiftiMerger(volume_file, class_paths, **merger_kwargs).output_paths()
+                instrument = run_report.options(case) if run_report is not None else None
+                job = (volume_file, class_paths, merger_kwargs, case, instrument)
+                if batch.add(volume_file, job, [volume_file] + class_paths, params, outputs, case=case):
+                    job_cases[volume_file] = case
+                    if workers != 1:
+                        batch.costs.append(merge_memory(volume_file, class_paths, slab_depth))
+
+        def add_case(volume_file, error, record, stats):
+            if stats is not None:
+                case_stats[job_cases[volume_file]] = stats
+            if run_report is not None:
+                run_report.add(record)
+
+        results = batch.run(_merge_case, cases, add_case, scheduler=scheduler, verb='merging')
+
+        if stats_path is not None:
+            label_names = label_names or [f'label_{i + 1}' for i in range(len(class_dirs))]
+            # The statistics of a case that failed this time are dropped rather than left stale
+            failed_cases = {job_cases[volume_file] for volume_file, error in results.items() if error is not None and volume_file in job_cases}
+            LabelStatsIndex.update(stats_path, case_stats, label_names, keep=set(cases) - failed_cases)
+            print(f"Label statistics of {len(case_stats)} cases written to {stats_path}")
+
+        failed = failed_results(results)
+        for volume_file, error in failed.items():
+            print(f"Failed to merge {volume_file}: {error}")
+        print(f"Merged {len(results) - len(failed)}/{len(results)} cases")
+
+        return results
+
+
+def merge_memory(volume_file, class_paths, slab_depth=None):
+    '''
+    Estimate the peak memory of merging a case from the headers: one decoded class mask, the label map, the mask of
+    the class being fused and the encoded output, for a slab of `slab_depth` slices if set.
+    '''
+    try:
+        shape = nib.load(volume_file).shape
+        mask_itemsize = nib.load(class_paths[0]).header.get_data_dtype().itemsize
+    except Exception:
+        # The case fails in its worker with a proper error
+        return 0
+    voxels = int(np.prod(shape, dtype=np.int64))
+    if slab_depth and len(shape) > 2 and shape[2] > 0:
+        voxels = voxels * min(slab_depth, shape[2]) // shape[2]
+    return voxels * (mask_itemsize + 3)
+
+
+def _merge_case(volume_file, class_paths, merger_kwargs, case=None, instrument=None):
+    # Module level so that it can be pickled by the process pool, the record of the case goes back with the result
+    rec = case_recorder(case, instrument)
+    try:
+        with rec:
+            merger = MultiClassNiftiMerger(volume_file, class_paths, **merger_kwargs)
+            merger.combine_classes()
+    except Exception as e:
+        return volume_file, f'{type(e).__name__}: {e}', rec.record(), None
+    return volume_file, None, rec.record(), merger.stats
 
 
 class DataSplitter:
@@ -145,6 +349,10 @@ class DataSplitter:
     - valid_ratio: the validation ratio, default=0.2
     - test_ratio: the test ratio, default=0.1
     - delete_input: whether you want to delete the input files after split, default=False
+    - link_mode: how the files are materialized in the split folders: 'copy' (default), 'hardlink', 'reflink',
+    'symlink' or 'auto' (hardlink, then reflink, then copy), every mode falls back to a copy when it is not possible,
+    see `utils.fileops.materialize`. 'symlink' cannot be combined with delete_input
+    - run_report: optional `RunReport`, every image/label pair is recorded as a case
 
     ### Example of usage:
     ```
@@ -156,8 +364,15 @@ class DataSplitter:
 
     splitter = DataSplitter(img, msk, output, 0.7, 0.2, 0.1, delete_input=False)
     splitter.run()
+
+    # Without duplicating the files on disk
+    splitter = DataSplitter(img, msk, output, 0.7, 0.2, 0.1, delete_input=False, link_mode='auto')
+    splitter.run()
     '''
-    def __init__(self, images_dir, labels_dir, output_dir, train_ratio=0.7, valid_ratio=0.2, test_ratio=0.1, delete_input=False):
+    def __init__(self, images_dir, labels_dir, output_dir, train_ratio=0.7, valid_ratio=0.2, test_ratio=0.1, delete_input=False, link_mode='copy', run_report=None):
+        if delete_input and link_mode == 'symlink':
+            raise ValueError("link_mode='symlink' cannot be used with delete_input=True, the links would be left dangling")
+
         self.images_dir = images_dir
         self.labels_dir = labels_dir
         self.output_dir = output_dir
@@ -165,6 +380,8 @@ class DataSplitter:
         self.valid_ratio = valid_ratio
         self.test_ratio = test_ratio
         self.delete_input = delete_input
+        self.link_mode = link_mode
+        self.run_report = run_report
         self.setup_directories()
 
     def setup_directories(self):
@@ -181,8 +398,26 @@ class DataSplitter:
                 os.makedirs(path, exist_ok=True)
 
     def get_filenames(self):
-        images = sorted(os.listdir(self.images_dir))
-        labels = sorted(os.listdir(self.labels_dir))
+        # Pair the images with the labels on their case id rather than on their sorted position, unless they do not
+        # share any case id
+        index = CaseIndex(self.images_dir, [self.labels_dir], ext=None)
+        index.report()
+
+        images, labels = [], []
+        for case in index.complete_cases():
+            image_path, (label_path,) = index.paths(case)
+            images.append(os.path.basename(image_path))
+            labels.append(os.path.basename(label_path))
+        if images:
+            return images, labels
+
+        # No case id in common, e.g. `image_0.png` and `label_0.png`: the files are paired on their sorted position
+        images = sorted(os.path.basename(index.references[case]) for case in index.cases)
+        labels = sorted(os.path.basename(path) for path in index.unmatched.get(self.labels_dir, []))
+        if not images or len(images) != len(labels):
+            raise ValueError(f"Cannot pair the {len(images)} images of {self.images_dir} (e.g. {images[:3]}) with the "
+                             f"{len(labels)} labels of {self.labels_dir} (e.g. {labels[:3]}): no case id in common")
+        print(f"No case id shared by the images and the labels, pairing the {len(images)} files on their sorted position")
         return images, labels
 
     def split_data(self, images, labels):
@@ -199,85 +434,202 @@ class DataSplitter:
         return {'train': train_data, 'valid': valid_data, 'test': test_data}
 
     def copy_files(self, split_data):
+        report = MaterializeReport()
         for split, data in split_data.items():
             for img, lbl in data:
-                shutil.copy(os.path.join(self.images_dir, img), self.dirs[split]['images'])
-                shutil.copy(os.path.join(self.labels_dir, lbl), self.dirs[split]['labels'])
+                img_path = os.path.join(self.images_dir, img)
+                lbl_path = os.path.join(self.labels_dir, lbl)
+                with report_case(self.run_report, img):
+                    report.add(img_path, *materialize(img_path, self.dirs[split]['images'], self.link_mode))
+                    report.add(lbl_path, *materialize(lbl_path, self.dirs[split]['labels'], self.link_mode))
                 logging.info(f'Copied {img} and {lbl} to {split} set')
+        # Printed like the summaries of the other steps, the scripts do not configure logging
+        print(report.summary())
+        return report
 
     def run(self):
+        '''
+        Split and materialize the files, return the `MaterializeReport` (files per method, bytes saved and copied).
+        '''
         images, labels = self.get_filenames()
         split_data = self.split_data(images, labels)
-        self.copy_files(split_data)
+        report = self.copy_files(split_data)
 
         if self.delete_input:
             shutil.rmtree(self.images_dir)
             shutil.rmtree(self.labels_dir)
             logging.info('Deleted original input directories')
+        return report
 
 
 class MetadataCopier:
     '''
+    Copy the geometry (origin, direction and spacing) of the segmentations to the volumes.
+
+    By default (`header_only=True`) only the NIfTI header of the volume is patched: its qform/sform and pixdim are
+    replaced by the ones of the segmentation while the data is streamed through without being decoded, and the
+    segmentation, which does not change, is hardlinked (or copied) instead of being encoded again. When the header
+    cannot be patched safely (non NIfTI input, shape mismatch...) the case goes through SimpleITK as before.
+
     # Example usage:
     copier = MetadataCopier('datasets/volumes', 'datasets/segmentations', 'datasets/new/volumes', 'datasets/new/segmentations')
     copier.load_and_copy_metadata()
+
+    With a `Manifest` (`manifest=Manifest('datasets/new/manifest.json')`) the cases that did not change since the last
+    run are skipped. With a `RunReport` (`run_report=RunReport()`) the read, write and copy times of every case are
+    recorded.
+
+    With `workers` > 1 the cases are copied in a process pool by a `CaseScheduler`, the largest first and within
+    `memory_budget` ('48G'), a header-only copy only holding its buffers. With `shard` ('i/N') only the cases of
+    this shard are copied.
     '''
-    def __init__(self, volume_dir, segmentation_dir, output_volumes_dir, output_segmentations_dir):
+    def __init__(self, volume_dir, segmentation_dir, output_volumes_dir, output_segmentations_dir, header_only=True, manifest=None, run_report=None,
+                 workers=1, memory_budget=None, shard=None):
         self.volume_dir = volume_dir
         self.segmentation_dir = segmentation_dir
         self.output_volumes_dir = output_volumes_dir
         self.output_segmentations_dir = output_segmentations_dir
+        self.header_only = header_only
+        self.manifest = manifest
+        self.run_report = run_report
+        self.scheduler = CaseScheduler(workers, memory_budget, shard)
 
     def load_and_copy_metadata(self):
         # Ensure the output directories exist
         os.makedirs(self.output_volumes_dir, exist_ok=True)
         os.makedirs(self.output_segmentations_dir, exist_ok=True)
         
-        # Get all NIfTI files in the volumes and segmentation directories
-        volume_files = [f for f in os.listdir(self.volume_dir) if f.endswith('.nii') or f.endswith('.nii.gz')]
-        segmentation_files = [f for f in os.listdir(self.segmentation_dir) if f.endswith('.nii') or f.endswith('.nii.gz')]
-
-        # Assuming filenames are the same for corresponding volume and segmentation
-        for volume_file in volume_files:
-            if volume_file in segmentation_files:
-                volume_path = os.path.join(self.volume_dir, volume_file)
-                segmentation_path = os.path.join(self.segmentation_dir, volume_file)
-
-                try:
-                    # Load the volume and segmentation
-                    volume = sitk.ReadImage(volume_path)
-                    segmentation = sitk.ReadImage(segmentation_path)
-
-                    # Copy metadata from segmentation to volume
-                    volume.SetOrigin(segmentation.GetOrigin())
-                    volume.SetDirection(segmentation.GetDirection())
-                    volume.SetSpacing(segmentation.GetSpacing())
-
-                    # Save the modified volume in the output volumes directory
-                    modified_volume_path = os.path.join(self.output_volumes_dir, volume_file)
-                    sitk.WriteImage(volume, modified_volume_path)
-                    print(f'Modified volume saved to: {modified_volume_path}')
-
-                    # Save the segmentation in the output segmentations directory without changing the filename
-                    modified_segmentation_path = os.path.join(self.output_segmentations_dir, volume_file)
-                    sitk.WriteImage(segmentation, modified_segmentation_path)
-                    print(f'Segmentation saved to: {modified_segmentation_path}')
-                    
-                except RuntimeError as e:
-                    print(f"Skipping {volume_file} due to error: {e}")
-
-            else:
-                print(f"No matching segmentation found for volume: {volume_file}")
+        # Index the NIfTI files of the volumes and segmentation directories, they are paired on their case id
+        index = CaseIndex(self.volume_dir, [self.segmentation_dir])
+        index.report()
+
+        cases = self.scheduler.select(index.cases)
+        batch = CaseBatch(self.manifest)
+        outputs = {}
+        for case in cases:
+            job = self.prepare_case(index, case)
+            if job is None:
+                continue
+            outputs[case] = list(job[3:5])
+            if batch.add(case, job, list(job[1:3]), {'header_only': self.header_only}, outputs[case]) and self.scheduler.workers != 1:
+                batch.costs.append(self.copy_memory(*job[1:3]))
+
+        def report_copy(case, error, record):
+            if self.run_report is not None:
+                self.run_report.add(record)
+            modified_volume_path, modified_segmentation_path = outputs[case]
+            if error is not None:
+                print(f"Skipping {os.path.basename(modified_volume_path)} due to error: {error}")
+                return
+            print(f'Modified volume saved to: {modified_volume_path}')
+            print(f'Segmentation saved to: {modified_segmentation_path}')
+
+        return batch.run(_copy_case, cases, report_copy, scheduler=self.scheduler, verb='copying')
+
+    def prepare_case(self, index, case):
+        # Return the job copying the case, None if it cannot be copied
+        volume_path, (segmentation_path,) = index.paths(case)
+        volume_file = os.path.basename(volume_path)
+
+        if index.is_ambiguous(case):
+            print(f"Skipping {volume_file} due to ambiguous files for case {case}")
+
+        elif segmentation_path is not None:
+            modified_volume_path = os.path.join(self.output_volumes_dir, volume_file)
+            modified_segmentation_path = os.path.join(self.output_segmentations_dir, volume_file)
+
+            instrument = self.run_report.options(case) if self.run_report is not None else None
+            return (case, volume_path, segmentation_path, modified_volume_path, modified_segmentation_path, self.header_only, instrument)
+
+        else:
+            print(f"No matching segmentation found for volume: {volume_file}")
+        return None
+
+    def copy_memory(self, volume_path, segmentation_path):
+        # A header-only copy streams the files, SimpleITK holds both images and their encoded copies
+        if self.header_only and volume_path.endswith('.gz') == segmentation_path.endswith('.gz'):
+            return STREAMING_MEMORY
+        try:
+            return 2 * (image_nbytes(volume_path) + image_nbytes(segmentation_path))
+        except Exception:
+            return 0
+
+    @staticmethod
+    def copy_header(volume_path, segmentation_path, modified_volume_path, modified_segmentation_path):
+        # Fast path, returns False when the header cannot be patched safely
+        if volume_path.endswith('.gz') != segmentation_path.endswith('.gz'):
+            return False
+
+        rec = recorder()
+        with rec.stage('read'):
+            volume_header = read_header(volume_path)
+            header = geometry_header(volume_header, read_header(segmentation_path))
+        if header is None:
+            return False
+
+        if header.binaryblock == volume_header.binaryblock:
+            # The geometry is already the right one, nothing to rewrite
+            materialize(volume_path, modified_volume_path, 'auto')
+        else:
+            with rec.stage('write'):
+                write_with_header(volume_path, modified_volume_path, header)
+
+        # The segmentation does not change
+        materialize(segmentation_path, modified_segmentation_path, 'auto')
+        return True
+
+    @staticmethod
+    def copy_image(volume_path, segmentation_path, modified_volume_path, modified_segmentation_path):
+        # Load the volume and segmentation
+        rec = recorder()
+        with rec.stage('read'):
+            volume = sitk.ReadImage(volume_path)
+            segmentation = sitk.ReadImage(segmentation_path)
+        rec.add_file_bytes('read', volume_path, segmentation_path)
+
+        # Copy metadata from segmentation to volume
+        volume.SetOrigin(segmentation.GetOrigin())
+        volume.SetDirection(segmentation.GetDirection())
+        volume.SetSpacing(segmentation.GetSpacing())
+
+        with rec.stage('write'):
+            # Save the modified volume in the output volumes directory
+            write_sitk_image(volume, modified_volume_path)
+
+            # Save the segmentation in the output segmentations directory without changing the filename
+            write_sitk_image(segmentation, modified_segmentation_path)
+        rec.add_file_bytes('write', modified_volume_path, modified_segmentation_path)
+
+
+def _copy_case(case, volume_path, segmentation_path, modified_volume_path, modified_segmentation_path, header_only, instrument=None):
+    # Module level so that it can be pickled by the process pool, a failing case is skipped without aborting the batch
+    rec = case_recorder(case, instrument)
+    try:
+        with rec:
+            if not (header_only and MetadataCopier.copy_header(volume_path, segmentation_path, modified_volume_path, modified_segmentation_path)):
+                MetadataCopier.copy_image(volume_path, segmentation_path, modified_volume_path, modified_segmentation_path)
+    except Exception as e:
+        return case, f'{type(e).__name__}: {e}', rec.record()
+    return case, None, rec.record()
 
 
 class DataRenamer:
     """
     If we use the pycad splitter to create the train/valid/test folders, then this class is adapted for that, and is waiting for the folders train and valid with the subforlders images and labels.
+
+    The `link_mode` ('copy', 'hardlink', 'reflink', 'symlink' or 'auto') controls how the files are materialized in the
+    nnUNet folders, see `utils.fileops.materialize`. With anything else than 'copy' the renamed files do not take any
+    extra space on disk.
+
+    With a `RunReport` (`run_report`) every renamed volume/segmentation pair is recorded as a case.
     """
 
-    def __init__(self, path_to_input, path_to_output, dataset_id, structure):
+    def __init__(self, path_to_input, path_to_output, dataset_id, structure, link_mode='copy', run_report=None):
         self.dataset_id = dataset_id
         self.structure = structure
+        self.link_mode = link_mode
+        self.report = MaterializeReport()
+        self.run_report = run_report
 
         self.path_to_train_image = glob(os.path.join(path_to_input, "train/images/*.nii.gz"))
         self.path_to_train_labels = glob(os.path.join(path_to_input, "train/labels/*.nii.gz"))
@@ -296,45 +648,48 @@ class DataRenamer:
     
     def rename_train_data(self):
         for i, (vol, seg) in enumerate(zip(self.path_to_train_image, self.path_to_train_labels)):
-
-            # Rename the training segmentations
-            print(f"Segmentation file: {seg}")
-            new_seg_filename = f"{self.structure}_{str(i).zfill(3)}.nii.gz"
-            new_seg_filepath = os.path.join(self.path_to_nnunet_labelsTr, new_seg_filename) 
-            print(f"new segmenation file: {new_seg_filepath}")
-
-            shutil.copy(seg, new_seg_filepath)
-
-            # Rename the training volumes
-            print(f"Volume file: {vol}")
-            new_volume_filename = f"{self.structure}_{str(i).zfill(3)}_0000.nii.gz"
-            new_volume_filepath = os.path.join(self.path_to_nnunet_imagesTr, new_volume_filename)
-            print(f"new volume file: {new_volume_filepath}") 
-
-            shutil.copy(vol, new_volume_filepath)
+            with report_case(self.run_report, os.path.basename(vol)):
+                # Rename the training segmentations
+                print(f"Segmentation file: {seg}")
+                new_seg_filename = f"{self.structure}_{str(i).zfill(3)}.nii.gz"
+                new_seg_filepath = os.path.join(self.path_to_nnunet_labelsTr, new_seg_filename) 
+                print(f"new segmenation file: {new_seg_filepath}")
+
+                self.report.add(seg, *materialize(seg, new_seg_filepath, self.link_mode))
+
+                # Rename the training volumes
+                print(f"Volume file: {vol}")
+                new_volume_filename = f"{self.structure}_{str(i).zfill(3)}_0000.nii.gz"
+                new_volume_filepath = os.path.join(self.path_to_nnunet_imagesTr, new_volume_filename)
+                print(f"new volume file: {new_volume_filepath}") 
+
+                self.report.add(vol, *materialize(vol, new_volume_filepath, self.link_mode))
     
     def rename_test_data(self):
         for i, (vol, seg) in enumerate(zip(self.path_to_test_image, self.path_to_test_labels)):
-
-            # Rename the testing volumes
-            print(f"Volume file: {vol}")
-            new_volume_filename = f"{self.structure}_{str(i).zfill(3)}_0000.nii.gz"
-            new_volume_filepath = os.path.join(self.path_to_nnunet_imagesTs, new_volume_filename)
-            print(f"new volume file: {new_volume_filepath}") 
-
-            shutil.copy(vol, new_volume_filepath)
-
-            # Rename the testing segmentations
-            print(f"segmentation file: {seg}")
-            new_seg_filename = f"{self.structure}_{str(i).zfill(3)}.nii.gz"
-            new_seg_filepath = os.path.join(self.path_to_nnunet_imagesTs, new_seg_filename)
-            print(f"new segmentation file: {new_seg_filepath}") 
-
-            shutil.copy(seg, new_seg_filepath)
+            with report_case(self.run_report, os.path.basename(vol)):
+                # Rename the testing volumes
+                print(f"Volume file: {vol}")
+                new_volume_filename = f"{self.structure}_{str(i).zfill(3)}_0000.nii.gz"
+                new_volume_filepath = os.path.join(self.path_to_nnunet_imagesTs, new_volume_filename)
+                print(f"new volume file: {new_volume_filepath}") 
+
+                self.report.add(vol, *materialize(vol, new_volume_filepath, self.link_mode))
+
+                # Rename the testing segmentations
+                print(f"segmentation file: {seg}")
+                new_seg_filename = f"{self.structure}_{str(i).zfill(3)}.nii.gz"
+                new_seg_filepath = os.path.join(self.path_to_nnunet_imagesTs, new_seg_filename)
+                print(f"new segmentation file: {new_seg_filepath}") 
+
+                self.report.add(seg, *materialize(seg, new_seg_filepath, self.link_mode))
     
     def run(self, rename_trainset=True, rename_testset=True):
         if rename_trainset:
             self.rename_train_data()
         
         if rename_testset:
-            self.rename_test_data()
\ No newline at end of file
+            self.rename_test_data()
+
+        print(self.report.summary())
+        return self.report
\ No newline at end of file
@@ -0,0 +1,276 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import csv
+import json
+import os
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+from .case_index import CaseIndex
+from .label_stats import STATS_SLAB_DEPTH
+from .parallel import failed_results, run_cases
+
+
+# Per-label metrics, in the order of the columns of the tables
+METRICS = [
+    'dice', 'iou', 'tp', 'fp', 'fn', 'tn', 'n_ref', 'n_pred',
+    'volume_ref_ml', 'volume_pred_ml', 'volume_difference_ml', 'relative_volume_difference',
+    'assd_mm', 'hd95_mm',
+]
+
+
+class SegmentationEvaluator:
+    '''
+    Evaluate the predictions of a folder against the reference segmentations, per case and per label: Dice and IoU
+    (computed like `nnUNetv2_evaluate_folder`, NaN when the label is in neither image), the confusion counts, the
+    volumes and their difference, the average symmetric surface distance (ASSD) and the 95th percentile Hausdorff
+    distance (HD95) in millimetres.
+
+    The counts of all the labels come from one confusion matrix per case, built with `np.bincount` over the
+    (reference, prediction) label pairs slab by slab. The surface distances of a label are computed with an exact
+    Euclidean distance transform restricted to the bounding box of the label in both images.
+
+    The tables are written to `output_dir`: `per_case.csv` (one row per case and label), `summary.csv` (the mean of
+    every metric per label) and `summary.json`, laid out like the `summary.json` of nnUNet.
+
+    ### Params
+    - reference_dir: the reference segmentations, e.g. `labelsTs`.
+    - prediction_dir: the predictions, matched to the references on their case id.
+    - labels: the label values to evaluate, by default the labels of `dataset_json` or all the labels found.
+    - dataset_json: the nnUNet `dataset.json`, for the labels and their names.
+    - ignore_label: the voxels with this label in the reference are not counted, default=None
+    - surface_distances: compute ASSD and HD95, default=True
+    - workers: number of processes, `None` uses all the cores, default=1
+
+    ### Example of usage
+
+    ```Python
+    from utils import SegmentationEvaluator
+
+    evaluator = SegmentationEvaluator('nnUNet_raw/Dataset100_SPINE/labelsTs', 'nnUNet_predictions',
+                                      dataset_json='nnUNet_raw/Dataset100_SPINE/dataset.json', workers=8)
+    summary = evaluator.run('evaluation')
+    print(summary['foreground_mean']['dice'])
+    ```
+    '''
+    def __init__(self, reference_dir, prediction_dir, labels=None, dataset_json=None, ignore_label=None, surface_distances=True, workers=1):
+        self.reference_dir = reference_dir
+        self.prediction_dir = prediction_dir
+        self.label_names = {}
+        if dataset_json is not None:
+            with open(dataset_json) as f:
+                dataset = json.load(f)
+            self.label_names = {int(value): name for name, value in dataset['labels'].items() if isinstance(value, int)}
+            if ignore_label is None and 'ignore' in dataset['labels']:
+                ignore_label = int(dataset['labels']['ignore'])
+                del self.label_names[ignore_label]
+        if labels is None and self.label_names:
+            labels = [value for value in self.label_names if value > 0]
+        self.labels = sorted(labels) if labels is not None else None
+        self.ignore_label = ignore_label
+        self.surface_distances = surface_distances
+        self.workers = workers
+
+    def run(self, output_dir=None):
+        '''
+        Evaluate every case with a prediction, write the tables if `output_dir` is given and return the summary.
+        '''
+        index = CaseIndex(self.reference_dir, [self.prediction_dir])
+        index.report()
+
+        jobs = []
+        for case in index.complete_cases():
+            reference_path, (prediction_path,) = index.paths(case)
+            jobs.append((case, reference_path, prediction_path, self.labels, self.ignore_label, self.surface_distances))
+
+        results = {}
+        case_metrics = {}
+        for case, error, metrics in run_cases(_evaluate_case, jobs, self.workers):
+            results[case] = error
+            if error is None:
+                case_metrics[case] = metrics
+
+        for case, error in failed_results(results).items():
+            print(f"Failed to evaluate {case}: {error}")
+
+        paths = {case: index.paths(case) for case in case_metrics}
+        summary = summarize(case_metrics, paths)
+        if output_dir is not None:
+            self.write(output_dir, case_metrics, summary)
+        print(f"Evaluated {len(case_metrics)}/{len(jobs)} cases, foreground mean Dice: {summary['foreground_mean'].get('dice', float('nan')):.4f}")
+        return summary
+
+    def label_name(self, label):
+        return self.label_names.get(label, str(label))
+
+    def write(self, output_dir, case_metrics, summary):
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, 'per_case.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['case', 'label', 'name'] + METRICS)
+            for case in sorted(case_metrics):
+                for label, metrics in case_metrics[case].items():
+                    writer.writerow([case, label, self.label_name(label)] + [metrics[name] for name in METRICS])
+
+        with open(os.path.join(output_dir, 'summary.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['label', 'name'] + METRICS)
+            for label, metrics in summary['mean'].items():
+                writer.writerow([label, self.label_name(label)] + [metrics[name] for name in METRICS])
+            writer.writerow(['foreground_mean', ''] + [summary['foreground_mean'][name] for name in METRICS])
+
+        with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+            json.dump(summary, f, indent=4, sort_keys=True)
+
+
+def _evaluate_case(case, reference_path, prediction_path, labels, ignore_label, surface_distances):
+    # Module level so that it can be pickled by the process pool
+    try:
+        metrics = evaluate_case(reference_path, prediction_path, labels, ignore_label, surface_distances)
+    except Exception as e:
+        return case, f'{type(e).__name__}: {e}', None
+    return case, None, metrics
+
+
+def load_label_map(path):
+    image = nib.load(path)
+    data = np.asanyarray(image.dataobj)
+    if not np.issubdtype(data.dtype, np.integer):
+        data = np.rint(data).astype(np.int32)
+    return data, image.header.get_zooms()[:3]
+
+
+def evaluate_case(reference_path, prediction_path, labels=None, ignore_label=None, surface_distances=True):
+    '''
+    Return a dict mapping every label to its metrics (see `METRICS`) for one case. Without `labels`, the labels
+    found in the reference or in the prediction are evaluated.
+    '''
+    reference, spacing = load_label_map(reference_path)
+    prediction, _ = load_label_map(prediction_path)
+    if reference.shape != prediction.shape:
+        raise ValueError(f'The prediction has the shape {prediction.shape}, the reference {reference.shape}')
+    if min(reference.min(initial=0), prediction.min(initial=0)) < 0:
+        raise ValueError('Negative labels cannot be evaluated')
+
+    n_labels = int(max(reference.max(initial=0), prediction.max(initial=0), max(labels or [0]))) + 1
+    if labels is None:
+        labels = [label for label in range(1, n_labels) if label != ignore_label]
+    matrix = confusion_matrix(reference, prediction, n_labels)
+    if ignore_label is not None and ignore_label < n_labels:
+        # The voxels ignored in the reference count for no label
+        matrix[ignore_label] = 0
+
+    voxel_ml = float(np.prod(spacing)) / 1000
+    reference_boxes = ndimage.find_objects(reference, max_label=n_labels - 1) if surface_distances else None
+    prediction_boxes = ndimage.find_objects(prediction, max_label=n_labels - 1) if surface_distances else None
+
+    total = int(matrix.sum())
+    metrics = {}
+    for label in labels:
+        tp = int(matrix[label, label])
+        fp = int(matrix[:, label].sum()) - tp
+        fn = int(matrix[label, :].sum()) - tp
+        n_ref, n_pred = tp + fn, tp + fp
+        metrics[label] = {
+            'dice': 2 * tp / (2 * tp + fp + fn) if tp + fp + fn > 0 else np.nan,
+            'iou': tp / (tp + fp + fn) if tp + fp + fn > 0 else np.nan,
+            'tp': tp,
+            'fp': fp,
+            'fn': fn,
+            'tn': total - tp - fp - fn,
+            'n_ref': n_ref,
+            'n_pred': n_pred,
+            'volume_ref_ml': n_ref * voxel_ml,
+            'volume_pred_ml': n_pred * voxel_ml,
+            'volume_difference_ml': (n_pred - n_ref) * voxel_ml,
+            'relative_volume_difference': (n_pred - n_ref) / n_ref if n_ref > 0 else np.nan,
+            'assd_mm': np.nan,
+            'hd95_mm': np.nan,
+        }
+        if surface_distances:
+            box = union_box(reference_boxes[label - 1], prediction_boxes[label - 1], reference.shape)
+            if box is not None:
+                assd, hd95 = surface_distance_metrics(reference[box] == label, prediction[box] == label, spacing)
+                metrics[label]['assd_mm'] = assd
+                metrics[label]['hd95_mm'] = hd95
+    return metrics
+
+
+def confusion_matrix(reference, prediction, n_labels, slab_depth=STATS_SLAB_DEPTH):
+    '''
+    Return the `n_labels x n_labels` matrix counting the voxels of every (reference, prediction) label pair, built
+    slab by slab so the temporary index array stays small.
+    '''
+    matrix = np.zeros(n_labels * n_labels, dtype=np.int64)
+    for z_start in range(0, reference.shape[2], slab_depth):
+        pairs = reference[:, :, z_start:z_start + slab_depth].astype(np.intp)
+        pairs *= n_labels
+        pairs += prediction[:, :, z_start:z_start + slab_depth]
+        matrix += np.bincount(pairs.ravel(), minlength=matrix.size)
+    return matrix.reshape(n_labels, n_labels)
+
+
+def union_box(box_a, box_b, shape):
+    '''
+    Return the slices of the union of two bounding boxes (`find_objects` slices or None) grown by one voxel, so the
+    surface voxels on the border of a label are found, or None if both are None.
+    '''
+    boxes = [box for box in (box_a, box_b) if box is not None]
+    if not boxes:
+        return None
+    return tuple(
+        slice(max(min(box[axis].start for box in boxes) - 1, 0), min(max(box[axis].stop for box in boxes) + 1, size))
+        for axis, size in enumerate(shape)
+    )
+
+
+def surface_distance_metrics(reference_mask, prediction_mask, spacing):
+    '''
+    Return the ASSD and the HD95 between the surfaces of two boolean masks in millimetres, NaN if one of them is
+    empty. The surface of a mask is its voxels with a face neighbour outside of it, HD95 is the 95th percentile of
+    the distances of both surfaces to the other one.
+    '''
+    if not reference_mask.any() or not prediction_mask.any():
+        return np.nan, np.nan
+    reference_surface = reference_mask & ~ndimage.binary_erosion(reference_mask)
+    prediction_surface = prediction_mask & ~ndimage.binary_erosion(prediction_mask)
+
+    to_reference = ndimage.distance_transform_edt(~reference_surface, sampling=spacing)[prediction_surface]
+    to_prediction = ndimage.distance_transform_edt(~prediction_surface, sampling=spacing)[reference_surface]
+    distances = np.concatenate([to_reference, to_prediction])
+    return float(distances.mean()), float(np.percentile(distances, 95))
+
+
+def summarize(case_metrics, paths=None):
+    '''
+    Aggregate the metrics of the cases like nnUNet: `mean` is the mean of every metric per label over the cases
+    (ignoring NaN), `foreground_mean` the mean of these means over the labels.
+    '''
+    labels = sorted({label for metrics in case_metrics.values() for label in metrics})
+    mean = {}
+    for label in labels:
+        values = [metrics[label] for metrics in case_metrics.values() if label in metrics]
+        mean[label] = {name: _nanmean([value[name] for value in values]) for name in METRICS}
+    foreground_mean = {name: float(np.mean([mean[label][name] for label in labels])) if labels else np.nan for name in METRICS}
+
+    metric_per_case = []
+    for case in sorted(case_metrics):
+        reference_path, prediction_paths = paths[case] if paths else (None, [None])
+        metric_per_case.append({
+            'case': case,
+            'reference_file': reference_path,
+            'prediction_file': prediction_paths[0],
+            'metrics': case_metrics[case],
+        })
+    return {'metric_per_case': metric_per_case, 'mean': mean, 'foreground_mean': foreground_mean}
+
+
+def _nanmean(values):
+    values = np.asarray(values, dtype=np.float64)
+    if np.isnan(values).all():
+        return np.nan
+    return float(np.nanmean(values))
@@ -0,0 +1,118 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import os
+import shutil
+
+from .instrumentation import recorder
+
+
+LINK_MODES = ('copy', 'hardlink', 'reflink', 'symlink', 'auto')
+
+# ioctl request to clone a file on Linux (btrfs, xfs, ...), from linux/fs.h
+FICLONE = 0x40049409
+
+
+def release_output(path):
+    '''
+    Remove `path` if it exists before writing a new file there. The outputs can be hardlinks or symlinks to other
+    files (see `materialize`), writing through them would silently modify the file they point to.
+    '''
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+def _hardlink(src, dst):
+    os.link(src, dst)
+
+
+def _reflink(src, dst):
+    import fcntl
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        os.remove(dst)
+        raise
+
+
+def _symlink(src, dst):
+    os.symlink(os.path.abspath(src), dst)
+
+
+# Methods tried in order for every mode, the copy is always the last resort
+_ATTEMPTS = {
+    'copy': (),
+    'hardlink': (('hardlink', _hardlink),),
+    'reflink': (('reflink', _reflink),),
+    'symlink': (('symlink', _symlink),),
+    'auto': (('hardlink', _hardlink), ('reflink', _reflink)),
+}
+
+
+def materialize(src, dst, link_mode='copy'):
+    '''
+    Make `src` available at `dst` (a file path or a directory like `shutil.copy`) without copying its content when
+    possible. Every mode falls back to a plain copy when it is not supported, e.g. a hardlink across filesystems or a
+    reflink on a filesystem without copy-on-write.
+
+    ### Params
+    - link_mode: 'copy', 'hardlink', 'reflink' (copy-on-write clone), 'symlink' (absolute link to `src`) or 'auto'
+    (hardlink, then reflink, then copy).
+
+    Return the path of the destination and the method that was actually used.
+    '''
+    if link_mode not in LINK_MODES:
+        raise ValueError(f"Unknown link mode '{link_mode}', expected one of {LINK_MODES}")
+
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.abspath(src) == os.path.abspath(dst):
+        raise ValueError(f"Cannot materialize {src} onto itself")
+
+    with recorder().stage('copy'):
+        for method, make_link in _ATTEMPTS[link_mode]:
+            release_output(dst)
+            try:
+                make_link(src, dst)
+                return dst, method
+            except (OSError, ImportError):
+                continue
+
+        release_output(dst)
+        shutil.copy(src, dst)
+        recorder().add_file_bytes('copy', dst)
+    return dst, 'copy'
+
+
+class MaterializeReport:
+    '''
+    Count the files materialized with each method and the bytes that were not duplicated on disk.
+
+    ### Example of usage
+
+    ```Python
+    report = MaterializeReport()
+    report.add(src, *materialize(src, dst, 'auto'))
+    report.summary()
+    ```
+    '''
+    def __init__(self):
+        self.methods = {}
+        self.bytes_saved = 0
+        self.bytes_copied = 0
+
+    def add(self, src, dst, method):
+        self.methods[method] = self.methods.get(method, 0) + 1
+        size = os.path.getsize(src)
+        if method == 'copy':
+            self.bytes_copied += size
+        else:
+            self.bytes_saved += size
+
+    def summary(self):
+        methods = ', '.join(f'{method}: {count}' for method, count in sorted(self.methods.items()))
+        return (f'Materialized {sum(self.methods.values())} files ({methods}), '
+                f'{self.bytes_saved / 1024 ** 2:.1f} MB saved, {self.bytes_copied / 1024 ** 2:.1f} MB copied')
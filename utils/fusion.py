@@ -0,0 +1,80 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import numpy as np
+
+
+OVERLAP_POLICIES = ('last', 'first', 'error')
+
+
+class LabelOverlapError(ValueError):
+    '''
+    Raised by the `error` overlap policy when two class masks claim the same voxels.
+    '''
+    def __init__(self, overlap_voxels):
+        self.overlap_voxels = overlap_voxels
+        super().__init__(f'{overlap_voxels} voxels are claimed by more than one class')
+
+
+class LabelFuser:
+    '''
+    Fuse binary class masks into one label map without going through float arrays.
+
+    The masks are read in their native dtype (through the nibabel `dataobj` proxies) one at a time, and written
+    into a uint8 label map (uint16 if there are more than 255 labels) with `np.copyto`, so the peak memory is the
+    label map plus one mask.
+
+    ### Params
+    - overlap: what to do when a voxel belongs to more than one class:
+        - 'last': the class that comes last wins (the historical behaviour of `combine_classes`)
+        - 'first': the class that comes first keeps the voxel
+        - 'error': raise a `LabelOverlapError` reporting the number of overlapping voxels
+
+    ### Example of usage
+
+    ```Python
+    import nibabel as nib
+    from utils.fusion import LabelFuser
+
+    images = [nib.load(path) for path in class_paths]
+    fuser = LabelFuser(overlap='first')
+    label_map = fuser.fuse((img.dataobj for img in images), labels=range(1, len(images) + 1), shape=images[0].shape)
+    fuser.check()
+    ```
+    '''
+    def __init__(self, overlap='last'):
+        if overlap not in OVERLAP_POLICIES:
+            raise ValueError(f"Unknown overlap policy '{overlap}', expected one of {OVERLAP_POLICIES}")
+        self.overlap = overlap
+        self.overlap_voxels = 0
+
+    @staticmethod
+    def label_dtype(labels):
+        return np.uint8 if max(labels, default=0) <= np.iinfo(np.uint8).max else np.uint16
+
+    def fuse(self, masks, labels, shape, out=None):
+        '''
+        `masks` can be any iterable of array-likes (arrays, nibabel proxies or slices of them), it is consumed lazily
+        so only one mask is held in memory at a time. Call `check` once all the blocks of a case have been fused.
+        '''
+        labels = list(labels)
+        if out is None:
+            out = np.zeros(shape, dtype=self.label_dtype(labels))
+
+        for mask, label in zip(masks, labels):
+            foreground = np.asanyarray(mask) > 0
+
+            if self.overlap == 'first':
+                foreground &= out == 0
+            elif self.overlap == 'error':
+                self.overlap_voxels += np.count_nonzero(foreground & (out != 0))
+
+            np.copyto(out, label, where=foreground, casting='unsafe')
+
+        return out
+
+    def check(self):
+        if self.overlap == 'error' and self.overlap_voxels:
+            raise LabelOverlapError(self.overlap_voxels)
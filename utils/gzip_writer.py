@@ -0,0 +1,178 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import gzip
+import io
+import os
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import SimpleITK as sitk
+
+from .fileops import release_output
+from .instrumentation import recorder
+
+
+# Used by every writer of the package, see `configure_gzip`
+GZIP_SETTINGS = {'compresslevel': 1, 'threads': None, 'block_size': 4 * 1024 * 1024}
+
+
+def configure_gzip(compresslevel=None, threads=None, block_size=None):
+    '''
+    Set the compression level (1 is nibabel's default, 9 the smallest files), the number of compression threads
+    (`None` uses all the cores) and the size of the uncompressed blocks used by all the `.nii.gz` writers.
+    '''
+    if compresslevel is not None:
+        GZIP_SETTINGS['compresslevel'] = compresslevel
+    if threads is not None:
+        GZIP_SETTINGS['threads'] = threads
+    if block_size is not None:
+        GZIP_SETTINGS['block_size'] = block_size
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    '''
+    Write-only gzip file compressed by several threads (zlib releases the GIL while compressing).
+
+    The data is cut into blocks of `block_size` bytes which are compressed concurrently and written in order, each
+    block being a complete gzip member. A file made of several members is standard gzip (RFC 1952) and is read as one
+    stream by gzip, zlib, nibabel and SimpleITK. The output only depends on the data, the level and the block size,
+    not on the number of threads or on how the data was passed to `write`.
+
+    ### Params
+    - fileobj: a path or a binary file object open for writing.
+    - compresslevel, threads, block_size: default to `GZIP_SETTINGS`.
+
+    ### Example of usage
+
+    ```Python
+    with ParallelGzipWriter('volume.nii.gz', compresslevel=6, threads=8) as f:
+        f.write(data)
+    ```
+    '''
+    def __init__(self, fileobj, compresslevel=None, threads=None, block_size=None):
+        super().__init__()
+        self.compresslevel = compresslevel if compresslevel is not None else GZIP_SETTINGS['compresslevel']
+        self.block_size = block_size or GZIP_SETTINGS['block_size']
+        threads = threads or GZIP_SETTINGS['threads'] or os.cpu_count() or 1
+
+        if isinstance(fileobj, (str, os.PathLike)):
+            self.name = os.fspath(fileobj)
+            self.fileobj = open(fileobj, 'wb')
+            self.owns_fileobj = True
+        else:
+            self.name = getattr(fileobj, 'name', None)
+            self.fileobj = fileobj
+            self.owns_fileobj = False
+
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = 2 * threads
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.position = 0
+        self.compressed_bytes = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # Only "seeking" to the current position is supported, it is what nibabel does before writing
+        if whence == io.SEEK_SET and offset == self.position:
+            return self.position
+        raise io.UnsupportedOperation('ParallelGzipWriter can only write sequentially')
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed file')
+        data = memoryview(data).cast('B')
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def submit(self, block):
+        self.pending.append((self.executor.submit(gzip.compress, block, self.compresslevel, mtime=0), len(block)))
+        while len(self.pending) >= self.max_pending:
+            self.write_member()
+
+    def write_member(self):
+        future, size = self.pending.popleft()
+        # Instrumented runs: the time waited for the compression threads is the `compress` stage
+        with recorder().stage('compress', size):
+            member = future.result()
+        self.fileobj.write(member)
+        self.compressed_bytes += len(member)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer or self.position == 0:
+                self.submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self.write_member()
+        finally:
+            self.executor.shutdown()
+            if self.owns_fileobj:
+                self.fileobj.close()
+            super().close()
+
+
+def open_output(path, compresslevel=None, threads=None):
+    '''
+    Open `path` for writing, through a `ParallelGzipWriter` if it ends with `.gz`.
+    '''
+    release_output(path)
+    if path.endswith('.gz'):
+        return ParallelGzipWriter(path, compresslevel, threads)
+    return open(path, 'wb')
+
+
+def save_nifti(nifti, path, compresslevel=None, threads=None):
+    '''
+    Drop-in replacement of `nib.save` compressing `.nii.gz` files with several threads.
+    '''
+    if not path.endswith('.gz'):
+        release_output(path)
+        nib.save(nifti, path)
+        return
+    with open_output(path, compresslevel, threads) as f:
+        nifti.to_file_map(nifti.make_file_map({'image': f, 'header': f}))
+
+
+def compress_file(src, dst, compresslevel=None, threads=None):
+    with open(src, 'rb') as fin, open_output(dst, compresslevel, threads) as fout:
+        shutil.copyfileobj(fin, fout, GZIP_SETTINGS['block_size'])
+
+
+def write_sitk_image(image, path, compresslevel=None, threads=None):
+    '''
+    Drop-in replacement of `sitk.WriteImage` for NIfTI files, `.nii.gz` files are written uncompressed by SimpleITK
+    to a temporary file next to `path` and then compressed with several threads.
+    '''
+    release_output(path)
+    if not path.endswith('.nii.gz'):
+        sitk.WriteImage(image, path)
+        return
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.nii', dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        sitk.WriteImage(image, tmp_path, useCompression=False)
+        compress_file(tmp_path, path, compresslevel, threads)
+    finally:
+        os.remove(tmp_path)
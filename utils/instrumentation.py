@@ -0,0 +1,377 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import cProfile
+import csv
+import json
+import os
+import time
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# The recorder of the case being processed in this process, see `recorder`
+_active = []
+# The peak RSS of this process before the last `reset_peak_rss`, in MB
+_peak_before_reset = 0.0
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullRecorder:
+    '''
+    Recorder used when the instrumentation is disabled, every call is a no-op.
+    '''
+    enabled = False
+    _stage = _NullStage()
+
+    def stage(self, name, nbytes=0):
+        return self._stage
+
+    def add_bytes(self, name, nbytes):
+        pass
+
+    def add_file_bytes(self, name, *paths):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def record(self):
+        return None
+
+
+NULL_RECORDER = NullRecorder()
+
+
+def recorder():
+    '''
+    Return the recorder of the case being processed, or the no-op `NULL_RECORDER` outside of an instrumented case.
+    '''
+    return _active[-1] if _active else NULL_RECORDER
+
+
+class _Stage:
+    def __init__(self, case_recorder, name, nbytes):
+        self.case_recorder = case_recorder
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.case_recorder.push(self.name, self.nbytes)
+        return self
+
+    def __exit__(self, *exc):
+        self.case_recorder.pop()
+        return False
+
+
+class CaseRecorder:
+    '''
+    Time and byte counters of the stages of one case.
+
+    The stages are exclusive: when a stage is entered inside another one (e.g. `compress` inside `write`), the time
+    goes to the inner stage only, so the stage times add up to the time of the case. The time spent outside of any
+    stage is reported as `other`.
+
+    The peak memory of the case (`peak_rss_mb`) is measured by resetting the peak RSS of the process when the case
+    starts (`/proc/self/clear_refs`, Linux), it is None where the peak cannot be reset. `process_peak_rss_mb` is the
+    peak of the process since it started, i.e. of all the cases it ran so far.
+
+    ### Params
+    - case: the case id.
+    - profile_path: if set, the case runs under cProfile and the stats are dumped to this file.
+    - run_report: if set, the record of the case is added to this `RunReport` when the case ends.
+
+    ### Example of usage
+
+    ```Python
+    with CaseRecorder('case_001') as rec:
+        with rec.stage('read', nbytes=os.path.getsize(path)):
+            image = nib.load(path).get_fdata()
+    print(rec.record())
+    ```
+    '''
+    enabled = True
+
+    def __init__(self, case, profile_path=None, run_report=None):
+        self.case = case
+        self.profile_path = profile_path
+        self.run_report = run_report
+        self.stages = {}
+        self.stack = []
+        self.seconds = 0.0
+        self.error = None
+        self.profiler = None
+        self.peak_reset = False
+
+    def stage(self, name, nbytes=0):
+        return _Stage(self, name, nbytes)
+
+    def add_bytes(self, name, nbytes):
+        self.counters(name)['bytes'] += nbytes
+
+    def add_file_bytes(self, name, *paths):
+        # Size on disk of the files read or written by the stage
+        self.add_bytes(name, sum(os.path.getsize(path) for path in paths if os.path.exists(path)))
+
+    def counters(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'seconds': 0.0, 'bytes': 0, 'calls': 0}
+        return self.stages[name]
+
+    def push(self, name, nbytes=0):
+        now = time.perf_counter()
+        if self.stack:
+            parent, start = self.stack[-1]
+            self.counters(parent)['seconds'] += now - start
+        counters = self.counters(name)
+        counters['bytes'] += nbytes
+        counters['calls'] += 1
+        self.stack.append((name, now))
+
+    def pop(self):
+        now = time.perf_counter()
+        name, start = self.stack.pop()
+        self.counters(name)['seconds'] += now - start
+        if self.stack:
+            self.stack[-1] = (self.stack[-1][0], now)
+
+    def __enter__(self):
+        _active.append(self)
+        if self.profile_path:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.peak_reset = reset_peak_rss()
+        self.start = time.perf_counter()
+        self.push('other')
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        while self.stack:
+            self.pop()
+        self.seconds = time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+            os.makedirs(os.path.dirname(os.path.abspath(self.profile_path)), exist_ok=True)
+            self.profiler.dump_stats(self.profile_path)
+        if exc is not None:
+            self.error = f'{exc_type.__name__}: {exc}'
+        _active.remove(self)
+        if self.run_report is not None:
+            self.run_report.add(self.record())
+        return False
+
+    def record(self):
+        return {
+            'case': self.case,
+            'seconds': self.seconds,
+            'peak_rss_mb': case_peak_rss_mb() if self.peak_reset else None,
+            'process_peak_rss_mb': peak_rss_mb(),
+            'pid': os.getpid(),
+            'error': self.error,
+            'profile': self.profile_path,
+            'stages': self.stages,
+        }
+
+
+def peak_rss_mb():
+    # Peak of the process since it started, the resets of `reset_peak_rss` included
+    if resource is None:
+        return None
+    # Kilobytes on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, _peak_before_reset)
+
+
+def reset_peak_rss():
+    '''
+    Reset the peak RSS of the process (VmHWM, which `ru_maxrss` follows) to its current RSS, return False where it is
+    not possible. The peak so far is kept for `peak_rss_mb`.
+    '''
+    global _peak_before_reset
+    peak = peak_rss_mb()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    _peak_before_reset = max(_peak_before_reset, peak or 0.0)
+    return True
+
+
+def case_peak_rss_mb():
+    # Peak since the last `reset_peak_rss`
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def timed_read(arrays):
+    '''
+    Wrap an iterable of array-likes (e.g. nibabel proxies consumed by `LabelFuser.fuse`) so that decoding each of
+    them is recorded in the `read` stage. Returned as it is when the instrumentation is disabled.
+    '''
+    rec = recorder()
+    if not rec.enabled:
+        return arrays
+    return _timed_read(arrays, rec)
+
+
+def _timed_read(arrays, rec):
+    for array in arrays:
+        with rec.stage('read'):
+            array = np.asanyarray(array)
+        yield array
+
+
+def case_recorder(case, options):
+    '''
+    Return a `CaseRecorder` for `case` with the `options` of `RunReport.options`, or the no-op recorder if they are
+    None (instrumentation disabled). Meant to be called in the process that runs the case.
+    '''
+    if options is None:
+        return NULL_RECORDER
+    return CaseRecorder(case, profile_path=options.get('profile'))
+
+
+def report_case(run_report, case):
+    '''
+    Return a recorder adding its record to `run_report` for a case processed in this process, or the no-op recorder
+    if `run_report` is None.
+    '''
+    if run_report is None:
+        return NULL_RECORDER
+    return run_report.case(case)
+
+
+class RunReport:
+    '''
+    Collect the records of the cases of a run (also the ones processed in worker processes) and write them as a JSON
+    or CSV report. Pass it as `run_report` to `MultiClassNiftiMerger.process_directories`, `MetadataCopier`,
+    `DataSplitter`, `DataRenamer` or `DatasetBuilder`, without a report these classes are not instrumented.
+
+    The stages are `read` (reading and decoding the inputs, the gzip decompression included), `fuse`, `compress`
+    (waiting for the gzip threads), `write`, `copy` (files copied or linked as they are) and `other`.
+
+    ### Params
+    - profile_case: a case id (or a list of case ids) to run under cProfile, the stats are written to
+    `profile_dir/{case}.prof` and can be opened with `snakeviz` or `pstats`.
+    - profile_dir: default='profiles'
+
+    ### Example of usage
+
+    ```Python
+    from utils import MultiClassNiftiMerger, RunReport
+
+    report = RunReport(profile_case='spine_007')
+    MultiClassNiftiMerger.process_directories(volume_dir, class_dirs, output_dir, workers=4, run_report=report)
+    report.print_summary()
+    report.write('merge_report.json')  # or .csv, one row per case
+    ```
+
+    For py-spy, run the case alone with `workers=1` so the sampled process is the one doing the work.
+    '''
+    def __init__(self, profile_case=None, profile_dir='profiles'):
+        if isinstance(profile_case, str):
+            profile_case = [profile_case]
+        self.profile_cases = set(profile_case or [])
+        self.profile_dir = profile_dir
+        self.records = []
+        self.start = time.perf_counter()
+
+    def options(self, case):
+        # Picklable, sent to the worker that runs the case
+        options = {}
+        if case in self.profile_cases:
+            options['profile'] = os.path.join(self.profile_dir, f'{case}.prof')
+        return options
+
+    def case(self, case):
+        return CaseRecorder(case, profile_path=self.options(case).get('profile'), run_report=self)
+
+    def add(self, record):
+        if record is not None:
+            self.records.append(record)
+
+    def stage_names(self):
+        names = []
+        for record in self.records:
+            names.extend(name for name in record['stages'] if name not in names)
+        return names
+
+    def totals(self):
+        totals = {}
+        for record in self.records:
+            for name, counters in record['stages'].items():
+                total = totals.setdefault(name, {'seconds': 0.0, 'bytes': 0, 'calls': 0})
+                for key in total:
+                    total[key] += counters[key]
+        return totals
+
+    def as_dict(self):
+        # The peak of the run is the one of its largest process, every case sees the peak of its process so far
+        peaks = [record['process_peak_rss_mb'] for record in self.records if record.get('process_peak_rss_mb') is not None]
+        return {
+            'wall_seconds': time.perf_counter() - self.start,
+            'cases': len(self.records),
+            'case_seconds': sum(record['seconds'] for record in self.records),
+            'peak_rss_mb': max(peaks, default=None),
+            'stages': self.totals(),
+            'records': self.records,
+        }
+
+    def write(self, path):
+        '''
+        Write the report as JSON, or as CSV (one row per case) if `path` ends with `.csv`.
+        '''
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if not path.endswith('.csv'):
+            with open(path, 'w') as f:
+                json.dump(self.as_dict(), f, indent=4)
+            return
+
+        names = self.stage_names()
+        columns = ['case', 'seconds', 'peak_rss_mb', 'process_peak_rss_mb', 'pid', 'error']
+        for name in names:
+            columns += [f'{name}_seconds', f'{name}_bytes']
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for record in self.records:
+                row = {column: record.get(column) for column in columns[:6]}
+                for name in names:
+                    counters = record['stages'].get(name, {'seconds': 0.0, 'bytes': 0})
+                    row[f'{name}_seconds'] = counters['seconds']
+                    row[f'{name}_bytes'] = counters['bytes']
+                writer.writerow(row)
+
+    def print_summary(self):
+        report = self.as_dict()
+        case_seconds = report['case_seconds'] or 1.0
+        print(f"{report['cases']} cases in {report['wall_seconds']:.2f} s (wall), {report['case_seconds']:.2f} s (sum of the cases)")
+        for name, total in sorted(report['stages'].items(), key=lambda item: -item[1]['seconds']):
+            throughput = total['bytes'] / 1024 ** 2 / total['seconds'] if total['seconds'] else 0.0
+            print(f"  {name:<9} {total['seconds']:8.2f} s {100 * total['seconds'] / case_seconds:5.1f} % "
+                  f"{total['bytes'] / 1024 ** 2:10.1f} MB {throughput:8.1f} MB/s")
+        if report['peak_rss_mb'] is not None:
+            print(f"  peak RSS {report['peak_rss_mb']:.1f} MB")
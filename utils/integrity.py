@@ -0,0 +1,230 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import csv
+import json
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib
+import numpy as np
+
+from .case_index import CaseIndex, case_id
+
+
+DATASET_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dataset.json')
+
+
+class DatasetScanner:
+    '''
+    Check a dataset of volumes and segmentations in seconds by reading only the NIfTI headers (the data of a
+    `.nii.gz` is not decompressed), before `MetadataCopier` or `nnUNetv2_plan_and_preprocess` find the problems one
+    case at a time:
+    - pairing: volumes without a segmentation, segmentations without a volume, ambiguous case ids.
+    - header: unreadable files, images that are not 3D.
+    - shape, spacing and affine: the segmentation must be on the grid of its volume (within `tolerance` millimetres).
+    - dtype: the segmentation must store integers without scaling, in a type that holds all the labels.
+
+    The headers are read by a thread pool. With `deep_sample` the labels of a random sample of the segmentations
+    are also read and checked against the labels of `dataset.json`.
+
+    ### Params
+    - volume_dir: the directory of the volumes (or nnUNet `imagesTr`).
+    - segmentation_dir: the directory of the segmentations (or nnUNet `labelsTr`).
+    - dataset_json: the file giving the labels, default=`utils/dataset.json`
+    - channel_suffix: suffix of the volume names removed to pair them with the segmentations, e.g. '_0000' for the
+    nnUNet layout, default=None
+    - tolerance: the largest difference allowed between the affines (and spacings), in millimetres, default=1e-3
+    - deep_sample: the fraction (a float, 1.0 for all) or the number (an int) of segmentations whose labels are read,
+    default=0 (none)
+    - workers: number of threads, default=16
+    - seed: the seed of the deep sample, default=0
+
+    ### Example of usage
+
+    ```Python
+    from utils import DatasetScanner
+
+    scanner = DatasetScanner('nnUNet_raw/Dataset100_SPINE/imagesTr', 'nnUNet_raw/Dataset100_SPINE/labelsTr',
+                             channel_suffix='_0000', deep_sample=0.1)
+    if not scanner.run():
+        scanner.write('integrity.csv')  # or .json
+    ```
+    '''
+    def __init__(self, volume_dir, segmentation_dir, dataset_json=DATASET_JSON, channel_suffix=None, tolerance=1e-3, deep_sample=0, workers=16, seed=0):
+        self.volume_dir = volume_dir
+        self.segmentation_dir = segmentation_dir
+        self.channel_suffix = channel_suffix
+        self.tolerance = tolerance
+        self.deep_sample = deep_sample
+        self.workers = workers
+        self.seed = seed
+        with open(dataset_json) as f:
+            labels = json.load(f)['labels']
+        self.labels = sorted(int(value) for value in labels.values() if isinstance(value, int))
+        self.records = []
+        self.issues = []
+
+    def key(self, filename):
+        name = case_id(filename)
+        if self.channel_suffix and name.endswith(self.channel_suffix):
+            name = name[:-len(self.channel_suffix)]
+        return name
+
+    def run(self):
+        '''
+        Scan the dataset, print the report and return True if no error was found.
+        '''
+        self.records = []
+        self.issues = []
+        index = CaseIndex(self.volume_dir, [self.segmentation_dir], key_func=self.key)
+
+        for case, directories in index.missing.items():
+            self.add_issue(case, 'error', 'pairing', f"no segmentation in {', '.join(directories)}")
+        for case, matches in index.ambiguous.items():
+            for directory, paths in matches.items():
+                self.add_issue(case, 'error', 'pairing', f"several files in {directory}: {', '.join(os.path.basename(p) for p in paths)}")
+        for directory, paths in index.unmatched.items():
+            for path in paths:
+                self.add_issue(self.key(os.path.basename(path)), 'error', 'pairing', f'{os.path.basename(path)} has no volume')
+
+        pairs = [(case, index.paths(case)[0], index.paths(case)[1][0]) for case in index.complete_cases()]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for record, issues in executor.map(lambda pair: check_pair(*pair, self.labels, self.tolerance), pairs):
+                self.records.append(record)
+                self.issues.extend(issues)
+
+            sampled = self.sample([record for record in self.records if record['readable']])
+            for record, issues in zip(sampled, executor.map(lambda record: check_labels(record['case'], record['segmentation'], self.labels), sampled)):
+                record['labels_checked'] = True
+                self.issues.extend(issues)
+
+        self.print_report()
+        return not self.errors()
+
+    def sample(self, records):
+        if not self.deep_sample:
+            return []
+        if isinstance(self.deep_sample, float) and self.deep_sample <= 1:
+            count = int(np.ceil(self.deep_sample * len(records)))
+        else:
+            count = int(self.deep_sample)
+        return random.Random(self.seed).sample(records, min(count, len(records)))
+
+    def add_issue(self, case, severity, check, message):
+        self.issues.append(make_issue(case, severity, check, message))
+
+    def errors(self):
+        return [issue for issue in self.issues if issue['severity'] == 'error']
+
+    def print_report(self):
+        for issue in sorted(self.issues, key=lambda issue: (issue['case'], issue['check'])):
+            print(f"{issue['severity'].upper():<8} {issue['case']}: {issue['check']}: {issue['message']}")
+        deep = sum(record.get('labels_checked', False) for record in self.records)
+        print(f"Scanned {len(self.records)} pairs ({deep} with their labels read): {len(self.errors())} errors, "
+              f"{len(self.issues) - len(self.errors())} warnings")
+
+    def write(self, path):
+        '''
+        Write the issues as CSV if `path` ends with `.csv` (one row per issue), otherwise the issues and the header
+        summary of every pair as JSON.
+        '''
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=['case', 'severity', 'check', 'message'])
+                writer.writeheader()
+                writer.writerows(self.issues)
+        else:
+            with open(path, 'w') as f:
+                json.dump({'issues': self.issues, 'cases': self.records}, f, indent=4)
+
+
+def make_issue(case, severity, check, message):
+    return {'case': case, 'severity': severity, 'check': check, 'message': message}
+
+
+def read_image_header(path):
+    # Only the header is read, the data stays on disk behind the proxy, which keeps the scaling of the file
+    image = nib.load(path)
+    scaling = (getattr(image.dataobj, 'slope', 1.0), getattr(image.dataobj, 'inter', 0.0))
+    return image.header, image.affine, scaling
+
+
+def check_pair(case, volume_path, segmentation_path, labels, tolerance=1e-3):
+    '''
+    Check the headers of a volume and its segmentation, return the summary of the pair and the list of its issues.
+    '''
+    record = {'case': case, 'volume': volume_path, 'segmentation': segmentation_path, 'readable': False}
+    issues = []
+    try:
+        volume_header, volume_affine, _ = read_image_header(volume_path)
+        segmentation_header, segmentation_affine, (slope, inter) = read_image_header(segmentation_path)
+    except Exception as e:
+        return record, [make_issue(case, 'error', 'header', f'{type(e).__name__}: {e}')]
+
+    volume_shape = volume_header.get_data_shape()
+    segmentation_shape = segmentation_header.get_data_shape()
+    record.update({
+        'readable': True,
+        'shape': list(volume_shape),
+        'spacing': [float(zoom) for zoom in volume_header.get_zooms()[:3]],
+        'volume_dtype': str(volume_header.get_data_dtype()),
+        'segmentation_dtype': str(segmentation_header.get_data_dtype()),
+    })
+
+    for name, shape in (('volume', volume_shape), ('segmentation', segmentation_shape)):
+        if len(shape) != 3 and not (len(shape) == 4 and shape[3] == 1):
+            issues.append(make_issue(case, 'error', 'shape', f'the {name} is not 3D: {shape}'))
+
+    if volume_shape[:3] != segmentation_shape[:3]:
+        issues.append(make_issue(case, 'error', 'shape', f'volume {volume_shape[:3]}, segmentation {segmentation_shape[:3]}'))
+
+    volume_spacing = np.array(volume_header.get_zooms()[:3], dtype=np.float64)
+    segmentation_spacing = np.array(segmentation_header.get_zooms()[:3], dtype=np.float64)
+    if not np.allclose(volume_spacing, segmentation_spacing, rtol=0, atol=tolerance):
+        issues.append(make_issue(case, 'error', 'spacing', f'volume {volume_spacing.round(4).tolist()}, segmentation {segmentation_spacing.round(4).tolist()}'))
+    elif not np.allclose(volume_affine, segmentation_affine, rtol=0, atol=tolerance):
+        difference = np.abs(volume_affine - segmentation_affine).max()
+        issues.append(make_issue(case, 'error', 'affine', f'the affines differ by up to {difference:.4g} mm'))
+
+    for name, header in (('volume', volume_header), ('segmentation', segmentation_header)):
+        if int(header['qform_code']) == 0 and int(header['sform_code']) == 0:
+            issues.append(make_issue(case, 'warning', 'affine', f'the {name} has no qform nor sform, its orientation is unknown'))
+
+    dtype = segmentation_header.get_data_dtype()
+    if not np.issubdtype(dtype, np.integer):
+        issues.append(make_issue(case, 'warning', 'dtype', f'the segmentation is stored as {dtype}, not as integers'))
+    elif np.iinfo(dtype).max < max(labels):
+        issues.append(make_issue(case, 'error', 'dtype', f'{dtype} cannot hold the labels up to {max(labels)}'))
+    if slope != 1 or inter != 0:
+        issues.append(make_issue(case, 'warning', 'dtype', f'the segmentation is scaled (slope {slope}, intercept {inter})'))
+    return record, issues
+
+
+def check_labels(case, segmentation_path, labels):
+    '''
+    Read a segmentation and return the issues of its label values: non integer values or values that are not labels
+    of the dataset.
+    '''
+    try:
+        data = np.asanyarray(nib.load(segmentation_path).dataobj)
+    except Exception as e:
+        return [make_issue(case, 'error', 'labels', f'{type(e).__name__}: {e}')]
+
+    if not np.issubdtype(data.dtype, np.integer):
+        rounded = np.rint(data)
+        if not np.array_equal(rounded, data):
+            return [make_issue(case, 'error', 'labels', 'the segmentation has non integer values')]
+        data = rounded.astype(np.int64)
+
+    if data.min(initial=0) < 0:
+        values = np.unique(data)
+    else:
+        values = np.flatnonzero(np.bincount(data.ravel()))
+    unknown = sorted(set(values.tolist()) - set(labels))
+    if unknown:
+        return [make_issue(case, 'error', 'labels', f'values that are not labels of the dataset: {unknown}')]
+    return []
@@ -0,0 +1,280 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import os
+import nibabel as nib
+import numpy as np
+
+
+# CT intensities in Hounsfield units, the values outside of the range go to the first or the last bin
+HISTOGRAM_RANGE = (-1024, 3072)
+HISTOGRAM_BINS = 256
+
+# Number of slices reduced at a time, bounds the size of the temporary index arrays
+STATS_SLAB_DEPTH = 16
+
+
+class LabelStats:
+    '''
+    Accumulate the statistics of every label of a label map, z-slab by z-slab, with a few `np.bincount` per slab:
+    the number of voxels of every label along each axis (from which the voxel counts, bounding boxes and centroids
+    are derived) and, if the CT volume is given, the histogram of its intensities under every label.
+
+    Only arrays of `n_labels x axis length` are kept between the slabs, so it can follow `combine_slabs` without
+    holding the volume in memory.
+
+    ### Params
+    - n_labels: the number of label values, the labels are 0 (background) to `n_labels - 1`.
+    - shape: the shape of the label map.
+    - histogram_range, histogram_bins: default to `HISTOGRAM_RANGE` and `HISTOGRAM_BINS`.
+
+    ### Example of usage
+
+    ```Python
+    stats = LabelStats(26, label_map.shape)
+    stats.update(label_map, volume=ct)
+    case_stats = stats.finalize(affine)
+    ```
+    '''
+    def __init__(self, n_labels, shape, histogram_range=HISTOGRAM_RANGE, histogram_bins=HISTOGRAM_BINS):
+        self.n_labels = n_labels
+        self.shape = tuple(shape[:3])
+        self.histogram_range = histogram_range
+        self.histogram_bins = histogram_bins
+        self.projections = [np.zeros((n_labels, size), dtype=np.int64) for size in self.shape]
+        self.histogram = np.zeros((n_labels, histogram_bins), dtype=np.int64)
+
+    def update(self, label_slab, z_start=0, volume=None):
+        '''
+        Add the slab `label_slab` starting at slice `z_start`, with the matching slab of the CT `volume` if given.
+        '''
+        labels = np.asarray(label_slab).astype(np.intp)
+        if labels.max(initial=0) >= self.n_labels:
+            raise ValueError(f'Label {labels.max()} is out of the {self.n_labels} labels of the statistics')
+
+        nx, ny, nz = labels.shape
+        # Index of (label, position along the axis) for every voxel
+        self.add_projection(0, labels * nx + np.arange(nx)[:, None, None])
+        self.add_projection(1, labels * ny + np.arange(ny)[None, :, None])
+        self.add_projection(2, labels * self.shape[2] + np.arange(z_start, z_start + nz)[None, None, :])
+
+        if volume is not None:
+            low, high = self.histogram_range
+            bins = np.asarray(volume).astype(np.int64)
+            bins -= low
+            bins *= self.histogram_bins
+            bins //= high - low
+            np.clip(bins, 0, self.histogram_bins - 1, out=bins)
+            bins += labels * self.histogram_bins
+            self.histogram += np.bincount(bins.ravel(), minlength=self.histogram.size).reshape(self.histogram.shape)
+
+    def add_projection(self, axis, index):
+        projection = self.projections[axis]
+        projection += np.bincount(index.ravel(), minlength=projection.size).reshape(projection.shape)
+
+    def finalize(self, affine):
+        '''
+        Return the statistics of the case as a dict of arrays indexed by label: `voxel_count`, `bbox_min` and
+        `bbox_max` (inclusive voxel indices, -1 for absent labels), `centroid_voxel` and `centroid_world` (NaN for
+        absent labels), `histogram`, `shape` and `spacing`.
+        '''
+        affine = np.asarray(affine, dtype=np.float64)
+        voxel_count = self.projections[2].sum(axis=1)
+        present = voxel_count > 0
+
+        bbox_min = np.full((self.n_labels, 3), -1, dtype=np.int32)
+        bbox_max = np.full((self.n_labels, 3), -1, dtype=np.int32)
+        centroid = np.full((self.n_labels, 3), np.nan)
+        for axis, projection in enumerate(self.projections):
+            occupied = projection > 0
+            size = projection.shape[1]
+            bbox_min[present, axis] = occupied.argmax(axis=1)[present]
+            bbox_max[present, axis] = (size - 1 - occupied[:, ::-1].argmax(axis=1))[present]
+            centroid[present, axis] = (projection @ np.arange(size))[present] / voxel_count[present]
+
+        return {
+            'voxel_count': voxel_count,
+            'bbox_min': bbox_min,
+            'bbox_max': bbox_max,
+            'centroid_voxel': centroid.astype(np.float32),
+            'centroid_world': (centroid @ affine[:3, :3].T + affine[:3, 3]).astype(np.float32),
+            'histogram': self.histogram,
+            'shape': np.array(self.shape, dtype=np.int32),
+            'spacing': np.sqrt((affine[:3, :3] ** 2).sum(axis=0)).astype(np.float32),
+        }
+
+
+def label_statistics(label_map, affine, n_labels, volume=None, slab_depth=STATS_SLAB_DEPTH):
+    '''
+    Statistics of a label map held in memory, see `LabelStats`. `volume` can be a nibabel proxy, only one slab of
+    it is read at a time.
+    '''
+    stats = LabelStats(n_labels, label_map.shape)
+    for z_start in range(0, label_map.shape[2], slab_depth):
+        z_stop = min(z_start + slab_depth, label_map.shape[2])
+        volume_slab = volume[:, :, z_start:z_stop] if volume is not None else None
+        stats.update(label_map[:, :, z_start:z_stop], z_start, volume_slab)
+    return stats.finalize(affine)
+
+
+def load_volume(volume_path, shape):
+    '''
+    Return the proxy of the CT volume for the histograms, or None if it does not match the label map.
+    '''
+    volume = nib.load(volume_path, mmap=True, keep_file_open=True)
+    if volume.shape[:3] != tuple(shape[:3]):
+        print(f"Skipping the intensity histograms of {volume_path}: shape {volume.shape} instead of {tuple(shape)}")
+        return None
+    return volume.dataobj
+
+
+# Per-case columns of the index, their trailing shape and dtype
+INDEX_COLUMNS = {
+    'voxel_count': np.int64,
+    'bbox_min': np.int32,
+    'bbox_max': np.int32,
+    'centroid_voxel': np.float32,
+    'centroid_world': np.float32,
+    'histogram': np.int64,
+}
+
+
+class LabelStatsIndex:
+    '''
+    Columnar index of the label statistics of a whole dataset, stored as one `.npz` file. Every column is an array
+    whose first axis is the case and second axis the label (0 being the background), so questions about the dataset
+    are answered with numpy without reading any NIfTI file.
+
+    The labels can be given by value or by name, a name matches exactly or on its suffix after an underscore, so
+    'C1' finds 'vertebrae_C1'.
+
+    ### Params
+    - cases: the case ids.
+    - label_names: the names of the labels 1 to N.
+    - columns: dict of arrays, see `LabelStats.finalize`, plus `shape` and `spacing`.
+    - histogram_edges: the edges of the intensity histogram bins.
+
+    ### Example of usage
+
+    ```Python
+    from utils.label_stats import LabelStatsIndex
+
+    index = LabelStatsIndex.load('datasets/corrected/label_stats.npz')
+    index.cases_with('C1', 'S1')
+    index.cases_missing('L5')
+    index.voxel_counts('T12')  # {case: voxels}
+    ```
+    '''
+    def __init__(self, cases, label_names, columns, histogram_edges):
+        self.cases = list(cases)
+        self.label_names = list(label_names)
+        self.columns = columns
+        self.histogram_edges = histogram_edges
+        self.rows = {case: i for i, case in enumerate(self.cases)}
+
+    @classmethod
+    def from_cases(cls, case_stats, label_names, histogram_range=HISTOGRAM_RANGE, histogram_bins=HISTOGRAM_BINS):
+        '''
+        Build the index from a dict mapping every case id to its `LabelStats.finalize` dict.
+        '''
+        cases = sorted(case_stats)
+        n_labels = len(label_names) + 1
+        columns = {}
+        for name, dtype in INDEX_COLUMNS.items():
+            fill = np.nan if np.issubdtype(dtype, np.floating) else (-1 if name.startswith('bbox') else 0)
+            trailing = (histogram_bins,) if name == 'histogram' else (() if name == 'voxel_count' else (3,))
+            column = np.full((len(cases), n_labels) + trailing, fill, dtype=dtype)
+            for row, case in enumerate(cases):
+                values = case_stats[case][name][:n_labels]
+                column[row, :len(values)] = values
+            columns[name] = column
+        for name in ('shape', 'spacing'):
+            columns[name] = np.array([case_stats[case][name] for case in cases]).reshape(len(cases), 3)
+        edges = np.linspace(histogram_range[0], histogram_range[1], histogram_bins + 1)
+        return cls(cases, label_names, columns, edges)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            columns = {name: data[name] for name in list(INDEX_COLUMNS) + ['shape', 'spacing']}
+            return cls(data['cases'].tolist(), data['label_names'].tolist(), columns, data['histogram_edges'])
+
+    def save(self, path):
+        # Written next to the index and renamed, a failed run does not leave a truncated index
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(
+            tmp_path,
+            cases=np.array(self.cases, dtype=str),
+            label_names=np.array(self.label_names, dtype=str),
+            histogram_edges=self.histogram_edges,
+            **self.columns
+        )
+        os.replace(tmp_path, path)
+
+    def to_case_stats(self):
+        return {case: {name: column[row] for name, column in self.columns.items()} for case, row in self.rows.items()}
+
+    @classmethod
+    def update(cls, path, case_stats, label_names, keep=None):
+        '''
+        Add (or replace) the statistics of `case_stats` in the index at `path` and save it. The cases already in the
+        index are kept if they are in `keep` (all of them by default), so an incremental run that skipped up to date
+        cases does not lose their statistics.
+        '''
+        merged = {}
+        if os.path.exists(path):
+            existing = cls.load(path)
+            if existing.label_names == list(label_names):
+                merged = {case: stats for case, stats in existing.to_case_stats().items() if keep is None or case in keep}
+        merged.update(case_stats)
+        index = cls.from_cases(merged, label_names)
+        index.save(path)
+        return index
+
+    def label(self, label):
+        '''
+        Return the value of a label given by value or by name.
+        '''
+        if isinstance(label, (int, np.integer)):
+            if not 0 <= label <= len(self.label_names):
+                raise KeyError(f'Unknown label {label}')
+            return int(label)
+        for value, name in enumerate(self.label_names, start=1):
+            if name == label or name.endswith(f'_{label}'):
+                return value
+        raise KeyError(f"Unknown label '{label}'")
+
+    def presence(self, *labels):
+        # Boolean array (cases, labels) telling whether every label is in every case
+        values = [self.label(label) for label in labels]
+        return self.columns['voxel_count'][:, values] > 0
+
+    def cases_with(self, *labels):
+        return [case for case, present in zip(self.cases, self.presence(*labels).all(axis=1)) if present]
+
+    def cases_missing(self, *labels):
+        '''
+        Cases missing at least one of the labels (any label but the background if none are given).
+        '''
+        labels = labels or range(1, len(self.label_names) + 1)
+        return [case for case, present in zip(self.cases, self.presence(*labels).all(axis=1)) if not present]
+
+    def voxel_counts(self, label):
+        return dict(zip(self.cases, self.columns['voxel_count'][:, self.label(label)].tolist()))
+
+    def label_frequency(self):
+        '''
+        Number of cases containing every label, by name.
+        '''
+        counts = (self.columns['voxel_count'][:, 1:] > 0).sum(axis=0)
+        return dict(zip(self.label_names, counts.tolist()))
+
+    def case(self, case):
+        '''
+        Statistics of one case as a dict of per-label arrays.
+        '''
+        row = self.rows[case]
+        return {name: column[row] for name, column in self.columns.items()}
@@ -0,0 +1,153 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import hashlib
+import json
+import os
+
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def json_params(params):
+    # The parameters as they come back from the JSON file, e.g. a tuple becomes a list
+    return json.loads(json.dumps(params))
+
+
+class Manifest:
+    '''
+    JSON record of what a batch step produced: for every case the inputs (size, mtime and optionally a sha1), the
+    parameters used and the outputs. A re-run skips the cases whose inputs, parameters and outputs did not change,
+    so only the new or modified cases are processed.
+
+    ### Params
+    - path: the JSON file, usually inside the output directory.
+    - use_hash: also store a sha1 of the inputs, a file whose mtime changed but whose content did not is then still
+    considered up to date (the hash is only computed when the size and mtime are not enough to decide).
+    - force: consider every case out of date, they are all processed again.
+    - prune: at the end of a run, delete the outputs of the cases that are no longer in the inputs.
+
+    ### Example of usage
+
+    ```Python
+    from utils import Manifest, MultiClassNiftiMerger
+
+    manifest = Manifest('datasets/corrected/manifest.json')
+    MultiClassNiftiMerger.process_directories(volume_dir, class_dirs, 'datasets/corrected', manifest=manifest)
+    ```
+    '''
+    def __init__(self, path, use_hash=False, force=False, prune=False):
+        self.path = path
+        self.use_hash = use_hash
+        self.force = force
+        self.prune_stale = prune
+        self.entries = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f).get('cases', {})
+
+    def signature(self, path, with_hash=False):
+        stat = os.stat(path)
+        signature = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if with_hash:
+            signature['sha1'] = file_hash(path)
+        return signature
+
+    def input_unchanged(self, path, recorded):
+        if not os.path.exists(path):
+            return False
+        current = self.signature(path)
+        if current['path'] != recorded['path'] or current['size'] != recorded['size']:
+            return False
+        if current['mtime_ns'] == recorded['mtime_ns']:
+            return True
+        if self.use_hash and 'sha1' in recorded and file_hash(path) == recorded['sha1']:
+            # Touched but not modified, remember the new mtime so the file is not hashed again next time
+            recorded['mtime_ns'] = current['mtime_ns']
+            return True
+        return False
+
+    def is_fresh(self, key, inputs, params, outputs):
+        '''
+        Return True if `key` was produced from the same `inputs` with the same `params` and all its `outputs` exist.
+        The parameters are compared as JSON values, so a tuple matches the list it was recorded as.
+        '''
+        if self.force or key not in self.entries:
+            return False
+
+        entry = self.entries[key]
+        if entry['params'] != json_params(params) or len(entry['inputs']) != len(inputs):
+            return False
+        if sorted(entry['outputs']) != sorted(os.path.abspath(output) for output in outputs):
+            return False
+        if not all(os.path.exists(output) for output in outputs):
+            return False
+        return all(self.input_unchanged(path, recorded) for path, recorded in zip(inputs, entry['inputs']))
+
+    def record(self, key, inputs, params, outputs):
+        self.entries[key] = {
+            'inputs': [self.signature(path, self.use_hash) for path in inputs],
+            'params': json_params(params),
+            'outputs': [os.path.abspath(output) for output in outputs],
+        }
+
+    def discard_outputs(self, key, keep=()):
+        '''
+        Delete the recorded outputs of `key` that are not in `keep`, e.g. when a case moves to another folder.
+        '''
+        keep = {os.path.abspath(path) for path in keep}
+        for output in self.entries.get(key, {}).get('outputs', []):
+            if output not in keep and os.path.lexists(output):
+                os.remove(output)
+
+    def prune(self, keys):
+        '''
+        Forget the cases that are not in `keys` and delete their outputs, return the deleted paths.
+        '''
+        keys = set(keys)
+        deleted = []
+        for key in [key for key in self.entries if key not in keys]:
+            for output in self.entries.pop(key)['outputs']:
+                if os.path.lexists(output):
+                    os.remove(output)
+                    deleted.append(output)
+        return deleted
+
+    def finish(self, keys):
+        # End of a batch run: prune the stale cases if asked and save
+        if self.prune_stale:
+            for path in self.prune(keys):
+                print(f"Removed stale output: {path}")
+        self.save()
+
+    @classmethod
+    def merge(cls, path, shard_paths):
+        '''
+        Gather the manifests written by the shards of a run (see `CaseScheduler`) into the manifest at `path`, the
+        entries of the shards replace the ones already in it. Return the merged manifest.
+        '''
+        manifest = cls(path)
+        for shard_path in shard_paths:
+            with open(shard_path) as f:
+                manifest.entries.update(json.load(f).get('cases', {}))
+        manifest.save()
+        print(f"Merged {len(shard_paths)} shard manifests into {path} ({len(manifest.entries)} cases)")
+        return manifest
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'cases': self.entries}, f, indent=1)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,214 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import importlib.util
+import os
+import nibabel as nib
+import numpy as np
+
+from .case_index import NIFTI_EXTENSIONS, case_id
+from .label_stats import label_statistics
+from .parallel import failed_results, run_cases
+
+
+def _require_vtk():
+    # vtk is only needed to build the meshes, the other utilities do not depend on it
+    if importlib.util.find_spec('vtkmodules') is None:
+        raise ImportError('The mesh export needs vtk, install it with `pip install vtk`')
+
+
+class MeshExporter:
+    '''
+    Extract the surface of every label of multi-label NIfTI files (segmentations or nnUNet predictions) and write
+    one binary STL per label, named `{case}_{label:02d}.stl` like the meshes of `demos/assets/stls`.
+
+    The bounding boxes of all the labels are found in one pass (see `utils.label_stats`) and every surface is
+    extracted with vtk's discrete flying edges from the box of its label only, instead of thresholding the whole
+    volume once per label. The points are then mapped to world coordinates with the affine of the NIfTI file, so
+    the meshes line up with the volume in any viewer.
+
+    With several files the cases are meshed in parallel, with a single file (or fewer files than workers) its labels
+    are.
+
+    ### Params
+    - output_dir: where the STL files are written.
+    - labels: the labels to export, all the labels present by default.
+    - smoothing_iterations: iterations of windowed sinc smoothing, 0 (default) to keep the voxel staircase.
+    - decimation: the fraction of the triangles to remove with quadric decimation, e.g. 0.8, default=0 (none).
+    - workers: number of processes, `None` uses all the cores, default=1
+
+    ### Example of usage
+
+    ```Python
+    from utils import MeshExporter
+
+    exporter = MeshExporter('demos/assets/stls', smoothing_iterations=20, decimation=0.5, workers=8)
+    exporter.export('predictions/SPINE_000.nii.gz')
+    exporter.export_directory('predictions')
+    ```
+    '''
+    def __init__(self, output_dir, labels=None, smoothing_iterations=0, decimation=0.0, workers=1):
+        if not 0 <= decimation < 1:
+            raise ValueError(f'decimation must be in [0, 1), got {decimation}')
+        self.output_dir = output_dir
+        self.labels = list(labels) if labels is not None else None
+        self.smoothing_iterations = smoothing_iterations
+        self.decimation = decimation
+        self.workers = workers
+
+    def options(self):
+        return {'smoothing_iterations': self.smoothing_iterations, 'decimation': self.decimation}
+
+    def export(self, path):
+        return self.export_files([path])
+
+    def export_directory(self, input_dir, ext=NIFTI_EXTENSIONS):
+        paths = sorted(os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith(ext))
+        return self.export_files(paths)
+
+    def export_files(self, paths):
+        '''
+        Mesh every file of `paths`, return a dict mapping every STL path to `None` or to the error message.
+        '''
+        os.makedirs(self.output_dir, exist_ok=True)
+        workers = self.workers or os.cpu_count() or 1
+
+        results = {}
+        if len(paths) >= workers:
+            # Enough cases to keep all the workers busy, every worker reads and meshes a whole case
+            jobs = [(path, self.output_dir, self.labels, self.options()) for path in paths]
+            for case_results in run_cases(_mesh_case, jobs, self.workers):
+                results.update(case_results)
+        else:
+            # The labels of a case are meshed in parallel, the case is read once here
+            for path in paths:
+                jobs = label_jobs(path, self.output_dir, self.labels, self.options())
+                for stl_path, error in run_cases(_mesh_label, jobs, self.workers):
+                    results[stl_path] = error
+
+        failed = failed_results(results)
+        for stl_path, error in failed.items():
+            print(f"Failed to mesh {stl_path}: {error}")
+        print(f"Wrote {len(results) - len(failed)} meshes from {len(paths)} files to {self.output_dir}")
+        return results
+
+
+def label_jobs(path, output_dir, labels, options):
+    '''
+    Read the label map of `path` and return one job per label: the box of the label (with a border of one voxel so
+    the surface is closed), its position in the volume, the affine and the STL path.
+    '''
+    image = nib.load(path)
+    label_map = np.asanyarray(image.dataobj)
+    if label_map.ndim != 3:
+        raise ValueError(f'{path} is not a 3D label map')
+
+    stats = label_statistics(label_map, image.affine, int(label_map.max(initial=0)) + 1)
+    present = np.flatnonzero(stats['voxel_count'][1:]) + 1
+    if labels is not None:
+        present = [label for label in present if label in labels]
+
+    name = case_id(path)
+    jobs = []
+    for label in present:
+        start = stats['bbox_min'][label]
+        stop = stats['bbox_max'][label] + 1
+        mask = label_map[tuple(slice(a, b) for a, b in zip(start, stop))] == label
+        mask = np.pad(mask, 1).view(np.uint8)
+        stl_path = os.path.join(output_dir, f'{name}_{int(label):02d}.stl')
+        jobs.append((mask, start - 1, image.affine, stl_path, options))
+    return jobs
+
+
+def _mesh_case(path, output_dir, labels, options):
+    # Module level so that it can be pickled by the process pool
+    try:
+        jobs = label_jobs(path, output_dir, labels, options)
+    except Exception as e:
+        return {path: f'{type(e).__name__}: {e}'}
+    return dict(_mesh_label(*job) for job in jobs)
+
+
+def _mesh_label(mask, origin, affine, stl_path, options):
+    try:
+        write_stl(label_surface(mask, origin, affine, **options), stl_path)
+    except Exception as e:
+        return stl_path, f'{type(e).__name__}: {e}'
+    return stl_path, None
+
+
+def label_surface(mask, origin, affine, smoothing_iterations=0, decimation=0.0):
+    '''
+    Return the surface of the binary `mask` (uint8, 1 inside) as a vtkPolyData in world coordinates. `origin` is the
+    voxel index of the first voxel of `mask` in the volume whose `affine` maps voxel indices to world coordinates.
+    '''
+    _require_vtk()
+    from vtkmodules.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+    from vtkmodules.vtkCommonCore import vtkPoints
+    from vtkmodules.vtkCommonDataModel import vtkImageData
+    from vtkmodules.vtkFiltersCore import vtkQuadricDecimation, vtkWindowedSincPolyDataFilter
+    from vtkmodules.vtkFiltersGeneral import vtkDiscreteFlyingEdges3D
+
+    # vtk images are stored x fastest, which is the Fortran order of the (x, y, z) numpy array
+    image = vtkImageData()
+    image.SetDimensions(*mask.shape)
+    image.SetOrigin(*[float(o) for o in origin])
+    image.GetPointData().SetScalars(numpy_to_vtk(mask.ravel(order='F'), deep=True))
+
+    surface = vtkDiscreteFlyingEdges3D()
+    surface.SetInputData(image)
+    surface.SetValue(0, 1)
+    surface.ComputeNormalsOff()
+    surface.ComputeGradientsOff()
+    surface.ComputeScalarsOff()
+    output = surface
+
+    # Smoothing and decimation run in voxel space where the surface is well conditioned
+    if smoothing_iterations:
+        smoother = vtkWindowedSincPolyDataFilter()
+        smoother.SetInputConnection(output.GetOutputPort())
+        smoother.SetNumberOfIterations(smoothing_iterations)
+        smoother.SetPassBand(0.05)
+        smoother.BoundarySmoothingOff()
+        smoother.NonManifoldSmoothingOn()
+        smoother.NormalizeCoordinatesOn()
+        output = smoother
+
+    if decimation:
+        decimator = vtkQuadricDecimation()
+        decimator.SetInputConnection(output.GetOutputPort())
+        decimator.SetTargetReduction(decimation)
+        output = decimator
+
+    output.Update()
+    polydata = output.GetOutput()
+
+    # Voxel indices to world coordinates
+    affine = np.asarray(affine, dtype=np.float64)
+    points = vtk_to_numpy(polydata.GetPoints().GetData()).astype(np.float64)
+    world = vtkPoints()
+    world.SetData(numpy_to_vtk(points @ affine[:3, :3].T + affine[:3, 3], deep=True))
+    polydata.SetPoints(world)
+
+    # A mirrored affine (negative determinant, e.g. LAS images) turns the triangles inside out
+    if np.linalg.det(affine[:3, :3]) < 0:
+        # The connectivity array is a view, the triangles are reversed in place
+        triangles = vtk_to_numpy(polydata.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+        triangles[:, [1, 2]] = triangles[:, [2, 1]]
+        polydata.GetPolys().Modified()
+    return polydata
+
+
+def write_stl(polydata, path):
+    _require_vtk()
+    from vtkmodules.vtkIOGeometry import vtkSTLWriter
+
+    writer = vtkSTLWriter()
+    writer.SetFileName(path)
+    writer.SetInputData(polydata)
+    writer.SetFileTypeToBinary()
+    if not writer.Write():
+        raise IOError(f'Could not write {path}')
+
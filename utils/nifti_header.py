@@ -0,0 +1,89 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import shutil
+import nibabel as nib
+from nibabel.openers import ImageOpener
+
+from .fileops import release_output
+from .gzip_writer import open_output
+from .instrumentation import recorder
+
+
+# Header fields that define the geometry (origin, direction and spacing) of a NIfTI image
+GEOMETRY_FIELDS = (
+    'qform_code', 'sform_code',
+    'quatern_b', 'quatern_c', 'quatern_d',
+    'qoffset_x', 'qoffset_y', 'qoffset_z',
+    'srow_x', 'srow_y', 'srow_z',
+)
+
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+def read_header(path):
+    '''
+    Return the header of a NIfTI file as it is on disk, or None for non NIfTI files. Unlike `nib.load(path).header`
+    the consumable fields (vox_offset, scl_slope, scl_inter) are kept, so it can be written back as it is.
+    '''
+    try:
+        image = nib.load(path)
+    except Exception:
+        return None
+    if not isinstance(image, nib.Nifti1Image):
+        return None
+    with ImageOpener(path, 'rb') as f:
+        return image.header_class.from_fileobj(f)
+
+
+def geometry_header(volume_header, reference_header):
+    '''
+    Return a copy of `volume_header` carrying the geometry (qform, sform, pixdim and spatial units) of
+    `reference_header`, or None if the header cannot be patched safely: missing headers, different NIfTI versions
+    or a shape mismatch.
+    '''
+    if volume_header is None or type(volume_header) is not type(reference_header):
+        return None
+    if volume_header.get_data_shape()[:3] != reference_header.get_data_shape()[:3]:
+        return None
+
+    header = volume_header.copy()
+    for field in GEOMETRY_FIELDS:
+        header[field] = reference_header[field]
+    header['pixdim'][:4] = reference_header['pixdim'][:4]
+    header.set_xyzt_units(xyz=reference_header.get_xyzt_units()[0])
+    return header
+
+
+def write_with_header(src, dst, header):
+    '''
+    Copy the NIfTI file `src` to `dst` replacing its header block by `header`, the extensions and the data are copied
+    as they are. Between uncompressed files the file is copied and patched in place, otherwise it is streamed through
+    (decompressed and/or compressed chunk by chunk with `ParallelGzipWriter`, following the extensions of `src` and
+    `dst`) without ever decoding the image.
+    '''
+    block = header.binaryblock
+    release_output(dst)
+    rec = recorder()
+
+    if not src.endswith('.gz') and not dst.endswith('.gz'):
+        with rec.stage('copy'):
+            shutil.copyfile(src, dst)
+            with open(dst, 'r+b') as f:
+                f.write(block)
+        rec.add_file_bytes('copy', dst)
+    else:
+        with ImageOpener(src, 'rb') as fin, open_output(dst) as fout:
+            fin.read(len(block))
+            fout.write(block)
+            while True:
+                with rec.stage('read'):
+                    chunk = fin.read(COPY_BUFFER_SIZE)
+                if not chunk:
+                    break
+                with rec.stage('write'):
+                    fout.write(chunk)
+        rec.add_file_bytes('read', src)
+        rec.add_file_bytes('write', dst)
@@ -0,0 +1,124 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .gzip_writer import GZIP_SETTINGS, configure_gzip
+
+
+def run_cases(func, jobs, workers=1):
+    '''
+    Yield the result of `func(*job)` for every job, in a process pool when `workers` != 1 (`None` uses all the
+    cores). `func` must be defined at module level so that it can be pickled, and should catch its own errors so
+    that one failing case does not abort the batch.
+
+    Unless set explicitly with `configure_gzip`, the compression threads are shared between the worker processes so
+    that the pool does not oversubscribe the cores.
+    '''
+    if workers == 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield func(*job)
+    else:
+        with process_pool(workers) as executor:
+            futures = [executor.submit(func, *job) for job in jobs]
+            for future in as_completed(futures):
+                yield future.result()
+
+
+def process_pool(workers):
+    '''
+    Return a `ProcessPoolExecutor` of `workers` processes (`None` uses all the cores) whose gzip writers share the
+    cores, see `run_cases`.
+    '''
+    cores = os.cpu_count() or 1
+    threads = GZIP_SETTINGS['threads'] or max(1, cores // (workers or cores))
+    gzip_settings = (GZIP_SETTINGS['compresslevel'], threads, GZIP_SETTINGS['block_size'])
+    return ProcessPoolExecutor(max_workers=workers, initializer=configure_gzip, initargs=gzip_settings)
+
+
+class CaseBatch:
+    '''
+    The jobs of a batch step and their manifest entries, shared by the drivers (`MultiClassNiftiMerger`,
+    `DatasetBuilder`, `ForegroundCropper`...): every case is added with its job, inputs, parameters and outputs, the
+    cases that the `Manifest` says are up to date are skipped, the others run through `run_cases` (or a
+    `CaseScheduler`) and are recorded in the manifest when they succeed. The manifest is saved if the run is
+    interrupted, and pruned (if asked) and saved at the end.
+
+    Every job returns a tuple starting with its key and its error (`None` on success).
+
+    ### Params
+    - manifest: optional `Manifest`, without it every case runs.
+
+    ### Example of usage
+
+    ```Python
+    batch = CaseBatch(manifest)
+    for case in cases:
+        batch.add(case, (case, input_path, output_path), inputs=[input_path], params={'margin': 10}, outputs=[output_path])
+    results = batch.run(_process_case, cases, workers=8, verb='processing')
+    ```
+    '''
+    def __init__(self, manifest=None):
+        self.manifest = manifest
+        self.jobs = []
+        self.costs = []
+        self.records = {}
+        self.results = {}
+        self.skipped = 0
+
+    def add(self, key, job, inputs, params, outputs, case=None, fresh=True, discard=False):
+        '''
+        Queue `job`, whose result has the key `key`, unless its case (`case`, by default the key) is up to date in the
+        manifest. With `fresh=False` the case runs anyway (e.g. a side file of the case is missing), with `discard`
+        its recorded outputs that are not in `outputs` are deleted (e.g. the case moved to another folder). Return
+        True if the job is queued.
+        '''
+        case = key if case is None else case
+        if self.manifest is not None:
+            if fresh and self.manifest.is_fresh(case, inputs, params, outputs):
+                self.results[key] = None
+                self.skipped += 1
+                return False
+            if discard:
+                self.manifest.discard_outputs(case, keep=outputs)
+            self.records[key] = (case, inputs, params, outputs)
+        self.jobs.append(job)
+        return True
+
+    def run(self, func, cases, on_result=None, workers=1, scheduler=None, verb='processing'):
+        '''
+        Run `func(*job)` for the queued jobs, with `run_cases` or, if set, in `scheduler` (a `CaseScheduler`) given
+        the memory estimates appended to `costs`. `on_result(*result)` is called with the result of every job before it is recorded.
+        `cases` are all the cases of the run, the manifest entries of the others are pruned if the manifest asks for
+        it. Return the dict mapping every key to `None` on success (or skipped) or to the error message.
+        '''
+        if self.manifest is not None:
+            print(f"Skipping {self.skipped} up to date cases, {verb} {len(self.jobs)}")
+
+        try:
+            if scheduler is not None:
+                outputs = scheduler.run(func, self.jobs, self.costs or None)
+            else:
+                outputs = run_cases(func, self.jobs, workers)
+            for result in outputs:
+                key, error = result[:2]
+                self.results[key] = error
+                if on_result is not None:
+                    on_result(*result)
+                if error is None and self.manifest is not None:
+                    self.manifest.record(*self.records[key])
+        except BaseException:
+            if self.manifest is not None:
+                self.manifest.save()
+            raise
+
+        if self.manifest is not None:
+            self.manifest.finish(cases)
+        return self.results
+
+
+def failed_results(results):
+    return {path: error for path, error in results.items() if error is not None}
@@ -0,0 +1,314 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import hashlib
+import json
+import os
+import nibabel as nib
+import numpy as np
+import SimpleITK as sitk
+
+from .case_index import CaseIndex
+from .crop import CROPS_FILENAME, foreground_box, load_crops, save_crops, write_cropped
+from .fusion import LabelFuser
+from .gzip_writer import save_nifti, write_sitk_image
+from .instrumentation import case_recorder, recorder, timed_read
+from .label_stats import LabelStatsIndex, label_statistics, load_volume
+from .nifti_header import geometry_header, read_header, write_with_header
+from .parallel import CaseBatch, failed_results
+
+
+class DatasetBuilder:
+    '''
+    Build the nnUNet raw dataset in a single pass, instead of chaining `MultiClassNiftiMerger`, `MetadataCopier`,
+    `DataSplitter` and `DataRenamer` which each read and write the whole dataset.
+
+    For every case the class masks are read once and fused, the fused segmentation is written to `labelsTr` (or
+    `labelsTs`), and the volume is streamed once to `imagesTr` (or `imagesTs`) with the geometry of the segmentation
+    patched in its header. The files get their final `{structure}_XXX[_0000].nii.gz` names. The `dataset.json` (with
+    the right `numTraining`) and a `case_mapping.json` giving the original case id of every name are written at the
+    end.
+
+    With `crop_margin`, the volume and the segmentation of every case are cropped around the labels while they are
+    written (see `ForegroundCropper`), and the crops are written to `crops.json` in the dataset directory, keyed by
+    the nnUNet names, so `uncrop_directory` pastes the predictions of `imagesTs` back without any mapping.
+
+    Adding or removing cases does not move the other ones: the split of a case only depends on a seeded hash of its
+    id, and its name is read back from the existing `case_mapping.json`, the new cases getting the next free numbers.
+    A case whose split changes (another `seed` or `train_ratio`) is removed from its previous split.
+
+    ### Params
+    - volume_dir: the directory of the volumes.
+    - class_dirs: the list of class directories, the label of a class is its position in the list starting at 1.
+    - nnunet_raw_dir: the nnUNet_raw directory, the dataset is written to `Dataset{dataset_id}_{structure}` inside it.
+    - dataset_id: the nnUNet dataset id, default=100
+    - structure: the dataset name, used as the prefix of the files, default='SPINE'
+    - label_names: the name of every class for the dataset.json, `label_1`, `label_2`... by default.
+    - train_ratio: the expected ratio of the cases that go to imagesTr/labelsTr, the others go to imagesTs/labelsTs,
+    default=0.8
+    - seed: the seed of the split, default=0
+    - overlap: the overlap policy of the fusion, see `LabelFuser`, default='last'
+    - ext: the extension of the input files, default='.nii.gz'
+    - workers: number of processes, `None` uses all the cores, default=1
+    - manifest: optional `Manifest` to skip the cases that are already built.
+    - run_report: optional `RunReport` recording the stages of every case, also in the worker processes.
+    - stats_path: if set, the statistics of every label (see `utils.label_stats`) are computed from the fused label
+    maps and written to a `LabelStatsIndex` at this path, indexed by the original case ids.
+    - crop_margin: crop the cases to their labels plus this margin in millimetres, default=None (no crop)
+
+    ### Example of usage
+
+    ```Python
+    from utils import DatasetBuilder
+
+    builder = DatasetBuilder('datasets/volumes', class_dirs, '/workspace/datasets/nnunet_data/nnUNet_raw', 100, 'SPINE', label_names=names)
+    builder.run()
+    ```
+    '''
+    def __init__(self, volume_dir, class_dirs, nnunet_raw_dir, dataset_id=100, structure='SPINE', label_names=None,
+                 train_ratio=0.8, seed=0, overlap='last', ext='.nii.gz', workers=1, manifest=None, run_report=None, stats_path=None,
+                 crop_margin=None):
+        self.volume_dir = volume_dir
+        self.class_dirs = list(class_dirs)
+        self.structure = structure
+        self.label_names = list(label_names) if label_names is not None else [f'label_{i + 1}' for i in range(len(self.class_dirs))]
+        self.train_ratio = train_ratio
+        self.seed = seed
+        self.overlap = overlap
+        self.ext = ext
+        self.workers = workers
+        self.manifest = manifest
+        self.run_report = run_report
+        self.stats_path = stats_path
+        self.crop_margin = crop_margin
+
+        if len(self.label_names) != len(self.class_dirs):
+            raise ValueError(f"Got {len(self.label_names)} label names for {len(self.class_dirs)} class directories")
+
+        self.dataset_dir = os.path.join(nnunet_raw_dir, f'Dataset{dataset_id}_{structure}')
+        self.crops_path = os.path.join(self.dataset_dir, CROPS_FILENAME)
+        self.dirs = {
+            'train': {'images': os.path.join(self.dataset_dir, 'imagesTr'), 'labels': os.path.join(self.dataset_dir, 'labelsTr')},
+            'test': {'images': os.path.join(self.dataset_dir, 'imagesTs'), 'labels': os.path.join(self.dataset_dir, 'labelsTs')},
+        }
+
+    def assign_splits(self, cases):
+        # Every case is placed on its own, so the other cases never change its split
+        return {case: 'train' if case_fraction(case, self.seed) < self.train_ratio else 'test' for case in cases}
+
+    def case_name(self, position):
+        return f'{self.structure}_{str(position).zfill(3)}'
+
+    def assign_names(self, cases):
+        '''
+        Return the name of every case: the one of the existing `case_mapping.json`, or the next free number for the
+        cases it does not know.
+        '''
+        names = {}
+        used = set()
+        mapping_path = os.path.join(self.dataset_dir, 'case_mapping.json')
+        if os.path.exists(mapping_path):
+            with open(mapping_path) as f:
+                for name, entry in json.load(f).items():
+                    used.add(name)
+                    if entry['case'] in cases:
+                        names[entry['case']] = name
+
+        position = 0
+        for case in sorted(cases):
+            if case in names:
+                continue
+            while self.case_name(position) in used:
+                position += 1
+            names[case] = self.case_name(position)
+            used.add(names[case])
+        return names
+
+    def target_paths(self, name, split):
+        return (
+            os.path.join(self.dirs[split]['images'], f'{name}_0000.nii.gz'),
+            os.path.join(self.dirs[split]['labels'], f'{name}.nii.gz'),
+        )
+
+    def run(self):
+        for split_dirs in self.dirs.values():
+            for path in split_dirs.values():
+                os.makedirs(path, exist_ok=True)
+
+        index = CaseIndex(self.volume_dir, self.class_dirs, ext=self.ext)
+        index.report()
+
+        cases = [case for case in index.cases if not index.is_ambiguous(case)]
+        splits = self.assign_splits(cases)
+        names = self.assign_names(cases)
+
+        batch = CaseBatch(self.manifest)
+        case_stats = {}
+        mapping = {}
+        crops = load_crops(self.crops_path) if self.crop_margin is not None and os.path.exists(self.crops_path) else {}
+        for case in cases:
+            volume_path, class_paths = index.paths(case)
+            labels = [idx + 1 for idx, path in enumerate(class_paths) if path is not None]
+            class_paths = [path for path in class_paths if path is not None]
+            if not class_paths:
+                continue
+
+            name = names[case]
+            split = splits[case]
+            image_path, label_path = self.target_paths(name, split)
+            mapping[name] = {'case': case, 'split': split}
+            # A case moved to the other split (new seed or ratio) must not stay in it, the test cases would leak into
+            # the training ones. Done with or without a manifest, the name of a case does not change
+            for path in self.target_paths(name, 'test' if split == 'train' else 'train'):
+                if os.path.lexists(path):
+                    os.remove(path)
+
+            params = {'labels': labels, 'overlap': self.overlap, 'name': name, 'split': split}
+            if self.stats_path is not None:
+                params['label_stats'] = True
+            if self.crop_margin is not None:
+                params['crop_margin'] = self.crop_margin
+            instrument = self.run_report.options(case) if self.run_report is not None else None
+            job = (case, volume_path, class_paths, labels, image_path, label_path, self.overlap, instrument, self.stats_path is not None,
+                   self.crop_margin)
+            # Without its crop a case cannot be uncropped, it is not up to date
+            batch.add(case, job, [volume_path] + class_paths, params, [image_path, label_path],
+                      fresh=self.crop_margin is None or name in crops, discard=True)
+
+        def add_case(case, error, record, stats, crop):
+            if stats is not None:
+                case_stats[case] = stats
+            if crop is not None:
+                crops[names[case]] = crop
+            if self.run_report is not None:
+                self.run_report.add(record)
+
+        try:
+            results = batch.run(_build_case, cases, add_case, self.workers, verb='building')
+        finally:
+            if self.crop_margin is not None:
+                # The crops are needed to uncrop the predictions, they are saved whatever happens
+                save_crops(self.crops_path, {name: crop for name, crop in crops.items() if name in mapping})
+
+        failed = failed_results(results)
+        for case, error in failed.items():
+            print(f"Failed to build {case}: {error}")
+
+        if self.stats_path is not None:
+            LabelStatsIndex.update(self.stats_path, case_stats, self.label_names, keep=set(cases) - set(failed))
+            print(f"Label statistics of {len(case_stats)} cases written to {self.stats_path}")
+
+        num_training = sum(1 for case, error in results.items() if error is None and splits[case] == 'train')
+        self.write_dataset_json(num_training)
+        with open(os.path.join(self.dataset_dir, 'case_mapping.json'), 'w') as f:
+            json.dump(mapping, f, indent=4)
+
+        print(f"Built {len(results) - len(failed)}/{len(results)} cases ({num_training} for training) in {self.dataset_dir}")
+        return results
+
+    def write_dataset_json(self, num_training):
+        labels = {'background': 0}
+        labels.update({name: idx + 1 for idx, name in enumerate(self.label_names)})
+        dataset = {
+            'channel_names': {'0': 'CT'},
+            'labels': labels,
+            'numTraining': num_training,
+            'file_ending': '.nii.gz',
+            'overwrite_image_reader_writer': 'SimpleITKIO',
+        }
+        with open(os.path.join(self.dataset_dir, 'dataset.json'), 'w') as f:
+            json.dump(dataset, f, indent=4)
+
+
+def case_fraction(case, seed=0):
+    '''
+    Return a number in [0, 1) given by a seeded sha1 of the case id, stable across machines and Python runs.
+    '''
+    digest = hashlib.sha1(f'{seed}:{case}'.encode()).hexdigest()
+    return int(digest, 16) / 16 ** len(digest)
+
+
+def _build_case(case, volume_path, class_paths, labels, image_path, label_path, overlap, instrument=None, label_stats=False, crop_margin=None):
+    # Module level so that it can be pickled by the process pool, the record, the statistics and the crop of the case
+    # go back with the result
+    rec = case_recorder(case, instrument)
+    try:
+        with rec:
+            stats, crop = _build_case_files(volume_path, class_paths, labels, image_path, label_path, overlap, label_stats, crop_margin)
+        print(f"Built {case}: {image_path}, {label_path}")
+    except Exception as e:
+        return case, f'{type(e).__name__}: {e}', rec.record(), None, None
+    return case, None, rec.record(), stats, crop
+
+
+def _build_case_files(volume_path, class_paths, labels, image_path, label_path, overlap, label_stats=False, crop_margin=None):
+    rec = recorder()
+
+    # Fuse the classes, every mask is read once
+    with rec.stage('read'):
+        class_niftis = [nib.load(class_path) for class_path in class_paths]
+    fuser = LabelFuser(overlap)
+    with rec.stage('fuse'):
+        fused = fuser.fuse(timed_read(class_nifti.dataobj for class_nifti in class_niftis), labels, class_niftis[0].shape)
+    fuser.check()
+    rec.add_file_bytes('read', *class_paths)
+
+    stats = None
+    if label_stats:
+        with rec.stage('stats'):
+            stats = label_statistics(fused, class_niftis[-1].affine, max(labels) + 1, load_volume(volume_path, fused.shape))
+
+    crop = None
+    slices = None
+    if crop_margin is not None:
+        start, stop = foreground_box(fused, class_niftis[-1].header.get_zooms()[:3], crop_margin)
+        crop = {
+            'start': start,
+            'stop': stop,
+            'original_shape': list(fused.shape[:3]),
+            'original_affine': class_niftis[-1].affine.tolist(),
+        }
+        if start != [0, 0, 0] or stop != list(fused.shape[:3]):
+            slices = tuple(slice(a, b) for a, b in zip(start, stop))
+
+    label_nifti = nib.Nifti1Image(fused, affine=class_niftis[-1].affine)
+    label_nifti.update_header()
+    if slices is None:
+        with rec.stage('write'):
+            save_nifti(label_nifti, label_path)
+    else:
+        write_cropped(label_nifti.header, fused[slices], crop['start'], label_path)
+    rec.add_file_bytes('write', label_path)
+
+    # Stream the volume to its final place with the geometry of the segmentation
+    with rec.stage('read'):
+        header = geometry_header(read_header(volume_path), label_nifti.header)
+    if header is not None and slices is not None:
+        with rec.stage('read'):
+            volume = nib.load(volume_path, mmap=True)
+            data = volume.dataobj.get_unscaled() if nib.is_proxy(volume.dataobj) else np.asanyarray(volume.dataobj)
+        # The raw data keeps the scaling of the header
+        write_cropped(header, data[slices], crop['start'], image_path)
+    elif header is not None:
+        with rec.stage('write'):
+            write_with_header(volume_path, image_path, header)
+    else:
+        with rec.stage('read'):
+            reference = sitk.ImageFileReader()
+            reference.SetFileName(label_path)
+            reference.ReadImageInformation()
+            volume = sitk.ReadImage(volume_path)
+        rec.add_file_bytes('read', volume_path)
+
+        if slices is not None:
+            # The index order of SimpleITK is the one of nibabel, the geometry below is the one of the cropped label
+            volume = volume[slices]
+        volume.SetOrigin(reference.GetOrigin())
+        volume.SetDirection(reference.GetDirection())
+        volume.SetSpacing(reference.GetSpacing())
+        with rec.stage('write'):
+            write_sitk_image(volume, image_path)
+        rec.add_file_bytes('write', image_path)
+    return stats, crop
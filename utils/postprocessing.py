@@ -0,0 +1,187 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import csv
+import os
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+from .case_index import CaseIndex
+from .fileops import materialize
+from .gzip_writer import save_nifti
+from .parallel import CaseBatch, failed_results
+
+
+REPORT_FILENAME = 'postprocessing.csv'
+REPORT_COLUMNS = ['case', 'label', 'components', 'kept_components', 'kept_voxels', 'removed_voxels']
+
+
+class ComponentFilter:
+    '''
+    Remove the stray islands of the predictions: for every label only the largest connected component is kept, or
+    with `min_voxels` the components of at least this size (the largest one is always kept, so a label never
+    disappears). The removed voxels become background.
+
+    The bounding boxes of all the labels come from one `find_objects` pass over the prediction, the components of a
+    label are then labelled inside its box only, so a vertebra costs the size of the vertebra and not of the volume.
+    A case without anything to remove is hardlinked (or copied) instead of being encoded again.
+
+    The removed voxels of every case and label are written to `postprocessing.csv` in `output_dir`.
+
+    ### Params
+    - prediction_dir: the predictions, e.g. the output of `nnUNetv2_predict`.
+    - output_dir: where the cleaned predictions and the report are written.
+    - labels: the labels to clean, all the labels found by default.
+    - min_voxels: keep the components of at least this number of voxels instead of only the largest, default=None
+    - connectivity: 1 for the face neighbours, 2 with the edges and 3 with the corners, default=1
+    - workers: number of processes, `None` uses all the cores, default=1
+    - manifest: optional `Manifest` to skip the cases that are already cleaned.
+
+    ### Example of usage
+
+    ```Python
+    from utils import ComponentFilter
+
+    cleaner = ComponentFilter('nnUNet_predictions', 'nnUNet_predictions_cleaned', workers=8)
+    cleaner.run()
+    ```
+    '''
+    def __init__(self, prediction_dir, output_dir, labels=None, min_voxels=None, connectivity=1, workers=1, manifest=None):
+        if connectivity not in (1, 2, 3):
+            raise ValueError(f'The connectivity must be 1, 2 or 3, got {connectivity}')
+        self.prediction_dir = prediction_dir
+        self.output_dir = output_dir
+        self.labels = sorted(labels) if labels is not None else None
+        self.min_voxels = min_voxels
+        self.connectivity = connectivity
+        self.workers = workers
+        self.manifest = manifest
+        self.report_path = os.path.join(output_dir, REPORT_FILENAME)
+
+    def run(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        index = CaseIndex(self.prediction_dir, [])
+        rows = load_report(self.report_path) if os.path.exists(self.report_path) else {}
+
+        batch = CaseBatch(self.manifest)
+        params = {'labels': self.labels, 'min_voxels': self.min_voxels, 'connectivity': self.connectivity}
+        for case in index.cases:
+            prediction_path, _ = index.paths(case)
+            output_path = os.path.join(self.output_dir, os.path.basename(prediction_path))
+            job = (case, prediction_path, output_path, self.labels, self.min_voxels, self.connectivity)
+            # The report of a case is needed to count its removed voxels, without it the case is not up to date
+            batch.add(case, job, [prediction_path], params, [output_path], fresh=case in rows)
+
+        def add_rows(case, error, case_rows):
+            if error is None:
+                rows[case] = case_rows
+
+        try:
+            results = batch.run(_filter_case, index.cases, add_rows, self.workers, verb='cleaning')
+        finally:
+            save_report(self.report_path, {case: case_rows for case, case_rows in rows.items() if case in index.cases})
+
+        failed = failed_results(results)
+        for case, error in failed.items():
+            print(f"Failed to clean {case}: {error}")
+
+        removed = sum(row['removed_voxels'] for case in results if case in rows for row in rows[case])
+        changed = sum(1 for case in results if any(row['removed_voxels'] for row in rows.get(case, [])))
+        print(f"Cleaned {len(results) - len(failed)}/{len(results)} cases, {removed} voxels removed in {changed} cases")
+        return results
+
+
+def _filter_case(case, prediction_path, output_path, labels, min_voxels, connectivity):
+    # Module level so that it can be pickled by the process pool
+    try:
+        rows = filter_case(prediction_path, output_path, labels, min_voxels, connectivity)
+    except Exception as e:
+        return case, f'{type(e).__name__}: {e}', None
+    for row in rows:
+        row['case'] = case
+    return case, None, rows
+
+
+def filter_case(prediction_path, output_path, labels=None, min_voxels=None, connectivity=1):
+    '''
+    Clean one prediction and write it to `output_path`, return one row per label with its number of components and
+    its kept and removed voxels.
+    '''
+    image = nib.load(prediction_path)
+    data = np.asanyarray(image.dataobj)
+    if not np.issubdtype(data.dtype, np.integer):
+        raise ValueError(f'The prediction is stored as {data.dtype}, not as labels')
+
+    rows = filter_components(data, labels, min_voxels, connectivity)
+    if any(row['removed_voxels'] for row in rows):
+        cleaned = image.__class__(data, image.affine, image.header)
+        save_nifti(cleaned, output_path)
+    else:
+        # Nothing removed, the file does not change
+        materialize(prediction_path, output_path, 'auto')
+    return rows
+
+
+def filter_components(data, labels=None, min_voxels=None, connectivity=1):
+    '''
+    Remove in place the components of every label of the label map `data` that are not kept (see `ComponentFilter`)
+    and return one row per label present.
+    '''
+    if data.min(initial=0) < 0:
+        raise ValueError('Negative labels cannot be filtered')
+    structure = ndimage.generate_binary_structure(data.ndim, connectivity)
+    boxes = ndimage.find_objects(data, max_label=int(data.max(initial=0)))
+
+    rows = []
+    for label, box in enumerate(boxes, start=1):
+        if box is None or (labels is not None and label not in labels):
+            continue
+        crop = data[box]
+        components, count = ndimage.label(crop == label, structure=structure)
+        sizes = np.bincount(components.ravel(), minlength=count + 1)
+        sizes[0] = 0
+
+        keep = np.zeros(count + 1, dtype=bool)
+        keep[np.argmax(sizes)] = True
+        if min_voxels is not None:
+            keep |= sizes >= min_voxels
+        keep[0] = False
+
+        removed = 0
+        if count > 1:
+            # The view of the box writes through to `data`
+            removed_mask = (components > 0) & ~keep[components]
+            removed = int(np.count_nonzero(removed_mask))
+            crop[removed_mask] = 0
+        rows.append({
+            'label': label,
+            'components': int(count),
+            'kept_components': int(keep.sum()),
+            'kept_voxels': int(sizes[keep].sum()),
+            'removed_voxels': removed,
+        })
+    return rows
+
+
+def load_report(path):
+    rows = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            case_row = {name: row[name] if name == 'case' else int(row[name]) for name in REPORT_COLUMNS}
+            rows.setdefault(row['case'], []).append(case_row)
+    return rows
+
+
+def save_report(path, rows):
+    # Written next to the report and renamed, a failed run does not leave a truncated report
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS)
+        writer.writeheader()
+        for case in sorted(rows):
+            writer.writerows(rows[case])
+    os.replace(tmp_path, path)
@@ -0,0 +1,171 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import hashlib
+import os
+import re
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+import nibabel as nib
+import numpy as np
+
+from .parallel import process_pool
+
+
+# Memory of a case that streams its files (header patch, copy), only buffers are held
+STREAMING_MEMORY = 64 * 1024 ** 2
+
+MEMORY_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+class CaseScheduler:
+    '''
+    Run the cases of a batch in a process pool, the largest first, without the estimated memory of the running cases
+    going over `memory_budget`: when the next largest case does not fit, the largest pending case that fits starts
+    instead, so the cores stay busy with the small cases while a big CT waits for memory. A case larger than the
+    whole budget runs alone.
+
+    The cost of a case is estimated by the caller from the NIfTI headers (see `image_voxels` and `image_nbytes`),
+    without reading any data. Without costs the jobs keep their order, the batch drivers only estimate them for a
+    process pool (`workers` != 1) since the order of a serial run does not change its time nor its memory.
+
+    With `shard`, only the cases of one shard out of N are processed, so several machines can share a dataset. A
+    case goes to shard `sha1(case id) % N`, which does not depend on the listing order nor on the other cases, each
+    machine writes its own manifest (`shard_path`) and `Manifest.merge` gathers them afterwards.
+
+    ### Params
+    - workers: number of processes, `None` uses all the cores, default=1
+    - memory_budget: the memory the running cases may use, in bytes or as a string like '48G', default=None (no limit)
+    - shard: 'i/N' (i from 0 to N - 1) or (i, N), default=None (all the cases)
+
+    ### Example of usage
+
+    ```Python
+    from utils.scheduler import CaseScheduler, image_nbytes
+
+    scheduler = CaseScheduler(workers=8, memory_budget='48G', shard='0/4')
+    cases = scheduler.select(cases)
+    jobs = [(case,) for case in cases]
+    costs = [2 * image_nbytes(volume_paths[case]) for case in cases]
+    for result in scheduler.run(process_case, jobs, costs):
+        ...
+    ```
+    '''
+    def __init__(self, workers=1, memory_budget=None, shard=None):
+        self.workers = workers
+        self.memory_budget = parse_memory(memory_budget)
+        self.shard = parse_shard(shard)
+
+    def select(self, cases):
+        '''
+        Return the cases of `cases` that belong to the shard, all of them without shard.
+        '''
+        if self.shard is None:
+            return list(cases)
+        index, count = self.shard
+        selected = [case for case in cases if shard_index(case, count) == index]
+        print(f"Shard {index}/{count}: {len(selected)} of {len(cases)} cases")
+        return selected
+
+    def order(self, costs):
+        # Largest first, the cases of the same cost keep their order
+        return sorted(range(len(costs)), key=lambda i: -costs[i])
+
+    def run(self, func, jobs, costs=None):
+        '''
+        Yield the result of `func(*job)` for every job as they complete, like `run_cases`. `costs` is the estimated
+        memory of every job in bytes.
+        '''
+        costs = list(costs) if costs is not None else [0] * len(jobs)
+        order = self.order(costs)
+        if self.workers == 1 or len(jobs) <= 1:
+            for i in order:
+                yield func(*jobs[i])
+            return
+
+        max_workers = self.workers or os.cpu_count() or 1
+        pending = deque(order)
+        running = {}
+        with process_pool(self.workers) as executor:
+            while pending or running:
+                while pending and len(running) < max_workers:
+                    i = self.next_job(pending, costs, sum(running.values()), bool(running))
+                    if i is None:
+                        break
+                    running[executor.submit(func, *jobs[i])] = costs[i]
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                    yield future.result()
+
+    def next_job(self, pending, costs, in_use, busy):
+        '''
+        Take the largest pending job that fits in the memory left, None if none does. When nothing runs the largest
+        job starts whatever its cost.
+        '''
+        for position, i in enumerate(pending):
+            if not busy or self.memory_budget is None or in_use + costs[i] <= self.memory_budget:
+                del pending[position]
+                return i
+        return None
+
+
+def parse_memory(value):
+    '''
+    Return a memory size in bytes from a number of bytes or a string like '512M', '48G' or '1.5T', None stays None.
+    '''
+    if value is None or isinstance(value, (int, float)):
+        return value
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)i?B?\s*', value.upper())
+    if match is None:
+        raise ValueError(f"Invalid memory size '{value}', expected e.g. '512M' or '48G'")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
+
+
+def parse_shard(shard):
+    '''
+    Return a shard as `(index, count)` from 'i/N' or a pair, None stays None.
+    '''
+    if shard is None:
+        return None
+    if isinstance(shard, str):
+        match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', shard)
+        if match is None:
+            raise ValueError(f"Invalid shard '{shard}', expected 'i/N'")
+        shard = (int(match.group(1)), int(match.group(2)))
+    index, count = shard
+    if not 0 <= index < count:
+        raise ValueError(f'Invalid shard {index}/{count}, the index goes from 0 to {count - 1}')
+    return index, count
+
+
+def shard_index(case, count):
+    # Stable across machines and Python runs, unlike hash()
+    return int(hashlib.sha1(case.encode()).hexdigest(), 16) % count
+
+
+def shard_path(path, shard):
+    '''
+    Return the path of the file of a shard, e.g. `manifest.json` -> `manifest.shard-0-of-4.json`, `path` without shard.
+    '''
+    shard = parse_shard(shard)
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard-{shard[0]}-of-{shard[1]}{ext}'
+
+
+def image_voxels(path):
+    # Only the header is read
+    return int(np.prod(nib.load(path).header.get_data_shape(), dtype=np.int64))
+
+
+def image_nbytes(path):
+    '''
+    Size of the decoded data of a NIfTI file, from its header.
+    '''
+    header = nib.load(path).header
+    return int(np.prod(header.get_data_shape(), dtype=np.int64)) * header.get_data_dtype().itemsize
@@ -0,0 +1,158 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import json
+import math
+import os
+import random
+import numpy as np
+
+from .case_index import CaseIndex
+from .label_stats import LabelStatsIndex
+
+
+STRATIFY_MODES = ('coverage', 'size')
+
+
+class SplitGenerator:
+    '''
+    Generate the cross-validation splits of an nnUNet dataset and write them as `splits_final.json`, without reading
+    nor moving any image: the cases are the file names of `labelsTr`, so a new split takes milliseconds whatever the
+    size of the dataset (unlike `DataSplitter`, which copies every file).
+
+    The splits are seeded and do not depend on the listing order. With `folds` the cases are dealt into k folds
+    (nnUNet uses fold i as validation and the others for training), with `holdout` a single split keeps this ratio
+    of the cases for validation.
+
+    With `stratify`, the cases are sorted on a key read from a `LabelStatsIndex` (see `--stats` of `prepare.py`)
+    before being dealt, so every fold gets its share of every kind of case:
+    - 'coverage': which vertebrae are in the scan, e.g. the cervical-only scans are spread over the folds.
+    - 'size': the number of voxels of the scan.
+
+    ### Params
+    - labels_dir: the `labelsTr` directory of the dataset.
+    - folds: the number of folds, default=5
+    - holdout: the ratio of the cases used for validation in a single split instead of the folds, default=None
+    - seed: the seed of the split, default=12345
+    - stratify: None (default), 'coverage' or 'size'.
+    - stats_path: the `label_stats.npz` of the dataset, needed to stratify.
+    - case_mapping: the `case_mapping.json` written by `DatasetBuilder` when the statistics use the original case
+    ids, by default the one next to `labels_dir` if it exists.
+
+    ### Example of usage
+
+    ```Python
+    from utils import SplitGenerator
+
+    generator = SplitGenerator('nnUNet_raw/Dataset100_SPINE/labelsTr', folds=5, stratify='coverage',
+                               stats_path='nnUNet_raw/Dataset100_SPINE/label_stats.npz')
+    generator.write('nnUNet_preprocessed/Dataset100_SPINE/splits_final.json')
+    ```
+    '''
+    def __init__(self, labels_dir, folds=5, holdout=None, seed=12345, stratify=None, stats_path=None, case_mapping=None):
+        if stratify is not None and stratify not in STRATIFY_MODES:
+            raise ValueError(f"Unknown stratify '{stratify}', expected one of {STRATIFY_MODES}")
+        if stratify is not None and stats_path is None:
+            raise ValueError('Stratifying the splits needs the label statistics (stats_path)')
+        if holdout is None and folds < 2:
+            raise ValueError(f'At least 2 folds are needed, got {folds}')
+        if holdout is not None and not 0 < holdout < 1:
+            raise ValueError(f'The holdout ratio must be between 0 and 1, got {holdout}')
+
+        self.labels_dir = labels_dir
+        self.folds = folds
+        self.holdout = holdout
+        self.seed = seed
+        self.stratify = stratify
+        self.stats_path = stats_path
+        if case_mapping is None:
+            default_mapping = os.path.join(os.path.dirname(os.path.abspath(labels_dir)), 'case_mapping.json')
+            case_mapping = default_mapping if os.path.exists(default_mapping) else None
+        self.case_mapping = case_mapping
+
+    def cases(self):
+        # Only the directory is listed
+        return CaseIndex(self.labels_dir, []).cases
+
+    def stratum_keys(self, cases):
+        '''
+        Return the key of every case used to stratify, read from the statistics index.
+        '''
+        index = LabelStatsIndex.load(self.stats_path)
+        names = {case: case for case in cases}
+        if self.case_mapping is not None:
+            with open(self.case_mapping) as f:
+                mapping = json.load(f)
+            names.update({name: entry['case'] for name, entry in mapping.items() if name in names})
+
+        missing = [case for case in cases if names[case] not in index.rows]
+        if missing:
+            raise KeyError(f"{len(missing)} cases have no statistics in {self.stats_path}, e.g. {missing[:3]}")
+
+        rows = [index.rows[names[case]] for case in cases]
+        if self.stratify == 'coverage':
+            present = index.columns['voxel_count'][rows, 1:] > 0
+            return {case: tuple(row.tolist()) for case, row in zip(cases, present)}
+        voxels = np.prod(index.columns['shape'][rows].astype(np.int64), axis=1)
+        return dict(zip(cases, voxels.tolist()))
+
+    def order(self, cases):
+        '''
+        Return the cases shuffled with the seed and, when stratifying, stably sorted on their key, so the similar
+        cases are next to each other and dealt to different folds.
+        '''
+        ordered = sorted(cases)
+        random.Random(self.seed).shuffle(ordered)
+        if self.stratify is not None:
+            keys = self.stratum_keys(ordered)
+            ordered.sort(key=keys.get)
+        return ordered
+
+    def assign(self, cases):
+        '''
+        Return a dict mapping every case to its fold, or to 0 (validation) and 1 (training) with `holdout`.
+        '''
+        ordered = self.order(cases)
+        rng = random.Random(self.seed + 1)
+        assignment = {}
+        if self.holdout is not None:
+            # Systematic sampling of the ordered cases, the validation cases are spread over all the strata
+            offset = rng.random()
+            for i, case in enumerate(ordered):
+                position = (i + offset) * self.holdout
+                assignment[case] = 0 if math.floor(position + self.holdout) > math.floor(position) else 1
+            return assignment
+
+        # Every block of `folds` consecutive cases goes to all the folds in a random order
+        for start in range(0, len(ordered), self.folds):
+            folds = list(range(self.folds))
+            rng.shuffle(folds)
+            for case, fold in zip(ordered[start:start + self.folds], folds):
+                assignment[case] = fold
+        return assignment
+
+    def splits(self):
+        '''
+        Return the splits in the format of nnUNet's `splits_final.json`: a list of `{'train': [...], 'val': [...]}`.
+        '''
+        cases = self.cases()
+        assignment = self.assign(cases)
+        n_splits = 1 if self.holdout is not None else self.folds
+        splits = []
+        for fold in range(n_splits):
+            splits.append({
+                'train': sorted(case for case in cases if assignment[case] != fold),
+                'val': sorted(case for case in cases if assignment[case] == fold),
+            })
+        return splits
+
+    def write(self, path):
+        splits = self.splits()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(splits, f, indent=4)
+        sizes = ', '.join(f"{len(split['train'])}/{len(split['val'])}" for split in splits)
+        print(f"Wrote {len(splits)} splits (train/val: {sizes}) to {path}")
+        return splits
@@ -0,0 +1,209 @@
+# Copyright (c) 2023 PYCAD
+# This file is part of the PYCAD library and is released under the MIT License:
+# https://github.com/amine0110/pycad/blob/main/LICENSE
+
+
+import json
+import os
+import nibabel as nib
+import numpy as np
+
+from .case_index import CaseIndex
+from .label_stats import STATS_SLAB_DEPTH
+from .parallel import CaseBatch, failed_results
+
+
+ARRAYS = ('image', 'label')
+GEOMETRY_FILENAME = 'geometry.json'
+
+
+class ArrayStoreExporter:
+    '''
+    Export the volumes and their fused segmentations to an uncompressed store that can be memory-mapped: every case
+    is a directory holding `image.npy`, `label.npy` and `geometry.json` (affine, shape, spacing and the source files).
+    A patch sampler, a QA script or a viewer then reads a region with `ArrayStore.read_roi` and only touches the pages
+    of that region, instead of decompressing the whole `.nii.gz`.
+
+    The arrays are filled slab by slab from the NIfTI files (z-slabs are contiguous in both), so the memory used does
+    not depend on the size of the volume. The data keeps its type on disk, a scaled volume is stored as float32.
+
+    ### Params
+    - volume_dir: the directory of the volumes.
+    - segmentation_dir: the directory of the segmentations, matched to the volumes on their case id.
+    - output_dir: the directory of the store.
+    - slab_depth: number of slices copied at once, default=`STATS_SLAB_DEPTH`
+    - workers: number of processes, `None` uses all the cores, default=1
+    - manifest: optional `Manifest` to skip the cases that are already exported.
+
+    ### Example of usage
+
+    ```Python
+    from utils import ArrayStore, ArrayStoreExporter
+
+    ArrayStoreExporter('datasets/corrected/volumes', 'datasets/corrected/segmentations', 'datasets/store', workers=8).run()
+
+    store = ArrayStore('datasets/store')
+    patch, affine = store.read_roi(store.cases[0], (slice(100, 228), slice(80, 208), slice(40, 104)))
+    ```
+    '''
+    def __init__(self, volume_dir, segmentation_dir, output_dir, slab_depth=STATS_SLAB_DEPTH, workers=1, manifest=None):
+        self.volume_dir = volume_dir
+        self.segmentation_dir = segmentation_dir
+        self.output_dir = output_dir
+        self.slab_depth = slab_depth
+        self.workers = workers
+        self.manifest = manifest
+
+    def run(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        index = CaseIndex(self.volume_dir, [self.segmentation_dir])
+        index.report()
+
+        batch = CaseBatch(self.manifest)
+        for case in index.complete_cases():
+            volume_path, (segmentation_path,) = index.paths(case)
+            case_dir = os.path.join(self.output_dir, case)
+            outputs = [os.path.join(case_dir, f'{name}.npy') for name in ARRAYS] + [os.path.join(case_dir, GEOMETRY_FILENAME)]
+            job = (case, volume_path, segmentation_path, case_dir, self.slab_depth)
+            batch.add(case, job, [volume_path, segmentation_path], {}, outputs)
+
+        results = batch.run(_export_case, index.cases, workers=self.workers, verb='exporting')
+
+        failed = failed_results(results)
+        for case, error in failed.items():
+            print(f"Failed to export {case}: {error}")
+        print(f"Exported {len(results) - len(failed)}/{len(results)} cases to {self.output_dir}")
+        return results
+
+
+def _export_case(case, volume_path, segmentation_path, case_dir, slab_depth):
+    # Module level so that it can be pickled by the process pool
+    try:
+        export_case(volume_path, segmentation_path, case_dir, slab_depth)
+    except Exception as e:
+        return case, f'{type(e).__name__}: {e}'
+    return case, None
+
+
+def stored_dtype(proxy):
+    # The type on disk, unless the values are scaled when they are read
+    if getattr(proxy, 'slope', 1.0) != 1 or getattr(proxy, 'inter', 0.0) != 0:
+        return np.dtype(np.float32)
+    return proxy.dtype
+
+
+def export_case(volume_path, segmentation_path, case_dir, slab_depth=STATS_SLAB_DEPTH):
+    '''
+    Write the volume and the segmentation of a case to `case_dir` as `.npy` files and their geometry as JSON.
+    '''
+    # keep_file_open lets the gzip stream go forward slab after slab, see `combine_slabs`
+    images = {
+        'image': nib.load(volume_path, mmap=True, keep_file_open=True),
+        'label': nib.load(segmentation_path, mmap=True, keep_file_open=True),
+    }
+    shape = images['image'].shape
+    if len(shape) != 3 or images['label'].shape != shape:
+        raise ValueError(f"The volume {shape} and the segmentation {images['label'].shape} must be 3D of the same shape")
+
+    os.makedirs(case_dir, exist_ok=True)
+    geometry = {
+        'shape': list(shape),
+        'affine': images['label'].affine.tolist(),
+        'spacing': [float(zoom) for zoom in images['label'].header.get_zooms()[:3]],
+        'sources': {'image': os.path.abspath(volume_path), 'label': os.path.abspath(segmentation_path)},
+        'dtypes': {},
+    }
+
+    for name, image in images.items():
+        dtype = stored_dtype(image.dataobj)
+        geometry['dtypes'][name] = str(dtype)
+        path = os.path.join(case_dir, f'{name}.npy')
+        tmp_path = os.path.join(case_dir, f'{name}.tmp.npy')
+        # Fortran order like the NIfTI data, every slab is one contiguous write
+        array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape, fortran_order=True)
+        for z_start in range(0, shape[2], slab_depth):
+            array[:, :, z_start:z_start + slab_depth] = image.dataobj[:, :, z_start:z_start + slab_depth]
+        array.flush()
+        del array
+        os.replace(tmp_path, path)
+
+    # Written last, a case without its geometry is not complete
+    with open(os.path.join(case_dir, GEOMETRY_FILENAME), 'w') as f:
+        json.dump(geometry, f, indent=4)
+
+
+class ArrayStore:
+    '''
+    Read the cases written by `ArrayStoreExporter`. The arrays are memory-mapped, so reading a region only reads the
+    pages it covers.
+
+    ### Params
+    - path: the directory of the store.
+
+    ### Example of usage
+
+    ```Python
+    from utils import ArrayStore
+
+    store = ArrayStore('datasets/store')
+    for case in store.cases:
+        labels, affine = store.read_roi(case, ((0, 96), (0, 96), (10, 42)), 'label')
+    ```
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.cases = sorted(
+            entry.name for entry in os.scandir(path)
+            if entry.is_dir() and os.path.exists(os.path.join(entry.path, GEOMETRY_FILENAME))
+        )
+        self.geometries = {}
+        self.arrays = {}
+
+    def geometry(self, case):
+        if case not in self.geometries:
+            with open(os.path.join(self.path, case, GEOMETRY_FILENAME)) as f:
+                self.geometries[case] = json.load(f)
+        return self.geometries[case]
+
+    def affine(self, case):
+        return np.array(self.geometry(case)['affine'])
+
+    def array(self, case, name='image'):
+        '''
+        Return the read-only memory map of the `name` ('image' or 'label') array of a case.
+        '''
+        if name not in ARRAYS:
+            raise ValueError(f"Unknown array '{name}', expected one of {ARRAYS}")
+        if (case, name) not in self.arrays:
+            self.arrays[case, name] = np.load(os.path.join(self.path, case, f'{name}.npy'), mmap_mode='r')
+        return self.arrays[case, name]
+
+    def read_roi(self, case, roi, name='image'):
+        '''
+        Return a copy of the region `roi` of an array of a case and the affine of the region. `roi` gives every axis
+        as a slice with a step of 1 or as a `(start, stop)` pair.
+        '''
+        array = self.array(case, name)
+        slices = roi_slices(roi, array.shape)
+        start = np.array([s.start for s in slices], dtype=np.float64)
+
+        affine = self.affine(case)
+        affine[:3, 3] += affine[:3, :3] @ start
+        return np.array(array[slices]), affine
+
+
+def roi_slices(roi, shape):
+    '''
+    Return `roi` as a tuple of slices clipped to `shape`.
+    '''
+    if len(roi) != len(shape):
+        raise ValueError(f'The ROI has {len(roi)} axes, the array {len(shape)}')
+    slices = []
+    for bounds, size in zip(roi, shape):
+        bounds = bounds if isinstance(bounds, slice) else slice(*bounds)
+        start, stop, step = bounds.indices(size)
+        if step != 1:
+            raise ValueError('The ROI slices must have a step of 1')
+        slices.append(slice(start, max(start, stop)))
+    return tuple(slices)